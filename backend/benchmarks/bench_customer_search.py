@@ -0,0 +1,109 @@
+"""
+Benchmark: admin customer search on 100k synthetic customers
+Seeds a throwaway database, then compares the old admin flow (newest 1000
+customers via to_list, filtered client-side) with the indexed
+/admin/customers/search endpoint for phone prefixes, name prefixes and
+deep keyset pages.
+
+Needs a running MongoDB. Run from backend/:
+    MONGO_URL=mongodb://localhost:27017 python benchmarks/bench_customer_search.py
+The database named by BENCH_DB_NAME (default titan_bench) is dropped first.
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import jwt
+from fastapi.security import HTTPAuthorizationCredentials
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "titan_bench")
+
+import server  # noqa: E402
+
+CUSTOMERS = int(os.environ.get("BENCH_CUSTOMERS", 100_000))
+REPEAT = 20
+
+FIRST_NAMES = ["Ahmet", "Mehmet", "Ayşe", "Fatma", "Şeyma", "İsmail", "Işıl", "Çağla", "Gökhan", "Ümit", "Özge", "Burak"]
+LAST_NAMES = ["Yılmaz", "Kaya", "Demir", "Şahin", "Çelik", "Yıldız", "Öztürk", "Aydın", "Güneş", "Doğan", "Kılıç", "Arslan"]
+
+
+async def seed():
+    await server.client.drop_database(os.environ["DB_NAME"])
+    now = datetime.utcnow()
+    rng = random.Random(42)
+    batch = []
+    for i in range(CUSTOMERS):
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+        batch.append({
+            "name": name,
+            "phone": f"05{rng.randint(300000000, 599999999)}",
+            "email": None,
+            "address": "İstanbul",
+            "loyalty_points": rng.randint(0, 400),
+            "total_bookings": rng.randint(0, 20),
+            "referral_code": f"R{i:07d}",
+            "referred_by": None,
+            "name_tokens": server.name_search_tokens(name),
+            "created_at": (now - timedelta(seconds=CUSTOMERS - i)).isoformat()
+        })
+        if len(batch) == 5000:
+            await server.db.customers.insert_many(batch)
+            batch = []
+    if batch:
+        await server.db.customers.insert_many(batch)
+    await server.create_indexes()
+
+
+async def timed(label, make_call):
+    samples = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        result = await make_call()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    print(f"{label:<44} p50: {samples[len(samples) // 2] * 1000:8.2f} ms  p95: {samples[int(len(samples) * 0.95) - 1] * 1000:8.2f} ms")
+    return result
+
+
+async def main():
+    print(f"Seeding {CUSTOMERS} customers...")
+    await seed()
+    token = jwt.encode({"username": "bench"}, server.JWT_SECRET, algorithm="HS256")
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+    async def old_flow(term):
+        customers = await server.db.customers.find().sort("created_at", -1).to_list(1000)
+        return [c for c in customers if term in c["phone"] or term.lower() in c["name"].lower()]
+
+    async def search(q=None, cursor=None):
+        return await server.search_customers(q=q, cursor=cursor, limit=50, credentials=credentials)
+
+    await timed("old: newest 1000 + client filter (phone)", lambda: old_flow("05312"))
+    await timed("old: newest 1000 + client filter (name)", lambda: old_flow("yıl"))
+    await timed("search: phone prefix 05312", lambda: search("05312"))
+    await timed("search: name prefix 'yil'", lambda: search("yil"))
+    await timed("search: two-word name 'seyma oz'", lambda: search("seyma oz"))
+
+    # Walk 20 pages deep, then time the page after
+    cursor = None
+    for _ in range(20):
+        page = await search(cursor=cursor)
+        cursor = server.orjson.loads(page.body)["next_cursor"]
+    await timed("search: page 21 of unfiltered list", lambda: search(cursor=cursor))
+
+    plan = await server.db.customers.find(
+        {"$and": [{"name_tokens": {"$regex": "^yil"}}]}, server.CUSTOMER_LIST_PROJECTION
+    ).sort("_id", -1).limit(51).explain()
+    print("name search plan:", plan["queryPlanner"]["winningPlan"])
+
+    await server.client.drop_database(os.environ["DB_NAME"])
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,135 @@
+"""
+Micro-benchmark: per-request cost of the Prometheus instrumentation
+Drives a trivial ASGI app directly, with and without MetricsMiddleware, so
+the difference is the middleware's own overhead (send wrapper, request
+context, DB call headers, in-flight gauge, counter and histogram update).
+Then times the command listener's work per MongoDB command, the JSON access
+log line as the request pays for it (the queue handler; encoding and writing
+happen on the listener thread) and rendering /metrics for a realistic number
+of route series.
+
+Run from backend/: python benchmarks/bench_metrics.py
+"""
+
+import asyncio
+import io
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jsonlog import AccessLog, configure_logging  # noqa: E402
+from metrics import CommandMetrics, HTTPMetrics, MetricsMiddleware, Registry, RequestContext  # noqa: E402
+
+REQUESTS = 200_000
+ROUTES = 45
+START = {"type": "http.response.start", "status": 200, "headers": []}
+BODY = {"type": "http.response.body", "body": b"{}"}
+HEADERS = [
+    (b"host", b"api.example.com"), (b"user-agent", b"okhttp/4.9.2"), (b"accept", b"application/json"),
+    (b"accept-encoding", b"gzip"), (b"authorization", b"Bearer x"), (b"connection", b"keep-alive")
+]
+
+
+class Route:
+    def __init__(self, path):
+        self.path = path
+
+
+ROUTE_OBJECTS = [Route(f"/api/route{i}/{{item_id}}") for i in range(ROUTES)]
+
+
+async def app(scope, receive, send):
+    # Stands in for the router, which leaves the matched route in the scope
+    scope["route"] = ROUTE_OBJECTS[scope["n"] % ROUTES]
+    await send(START)
+    await send(BODY)
+
+
+async def receive():
+    return {"type": "http.request", "body": b""}
+
+
+async def send(message):
+    pass
+
+
+async def drive(handler, n):
+    start = time.perf_counter()
+    for i in range(n):
+        await handler({"type": "http", "method": "GET", "path": "/", "headers": HEADERS, "n": i}, receive, send)
+    return time.perf_counter() - start
+
+
+async def main():
+    registry = Registry()
+    instrumented = MetricsMiddleware(app, HTTPMetrics(registry))
+    await drive(app, 10_000)
+    await drive(instrumented, 10_000)
+
+    # Interleaved runs, best of five, to keep noise out of the difference
+    bare, timed = [], []
+    for _ in range(5):
+        bare.append(await drive(app, REQUESTS))
+        timed.append(await drive(instrumented, REQUESTS))
+    overhead = (min(timed) - min(bare)) / REQUESTS * 1e6
+    print(f"bare app:        {min(bare) / REQUESTS * 1e6:.2f} us/request")
+    print(f"instrumented:    {min(timed) / REQUESTS * 1e6:.2f} us/request")
+    print(f"overhead:        {overhead:.2f} us/request")
+
+    metrics = HTTPMetrics(Registry())
+    rng = random.Random(1)
+    values = [rng.expovariate(20) for _ in range(REQUESTS)]
+    labels = [("GET", ROUTE_OBJECTS[i % ROUTES].path, "200") for i in range(REQUESTS)]
+    start = time.perf_counter()
+    for value, label in zip(values, labels):
+        metrics.requests.inc(label)
+        metrics.duration.observe(value, label)
+    print(f"counter+histogram update: {(time.perf_counter() - start) / REQUESTS * 1e6:.2f} us")
+
+    listener = CommandMetrics(Registry())
+    started = [SimpleNamespace(
+        command={"find": "bookings", "filter": {"customer_phone": "0"}}, command_name="find",
+        connection_id=("localhost", 27017), request_id=i
+    ) for i in range(REQUESTS)]
+    succeeded = [SimpleNamespace(
+        command_name="find", connection_id=("localhost", 27017), request_id=i,
+        duration_micros=800, reply={"cursor": {"firstBatch": [{}] * 5}}
+    ) for i in range(REQUESTS)]
+    start = time.perf_counter()
+    for begin, end in zip(started, succeeded):
+        listener.started(begin)
+        listener.succeeded(end)
+    print(f"command listener: {(time.perf_counter() - start) / REQUESTS * 1e6:.2f} us/command")
+
+    listener = configure_logging(stream=io.StringIO(), queue_size=REQUESTS, registry=Registry())
+    access_log = AccessLog({"/api/location/update": 1})
+    contexts = []
+    for i in range(REQUESTS):
+        context = RequestContext({"type": "http", "method": "POST", "path": "/", "headers": HEADERS})
+        context.scope["route"] = ROUTE_OBJECTS[i % ROUTES]
+        contexts.append(context)
+    start = time.perf_counter()
+    for context in contexts:
+        access_log(context, 200, 0.012)
+    print(f"access log line: {(time.perf_counter() - start) / REQUESTS * 1e6:.2f} us/request")
+    context.scope["route"] = Route("/api/location/update")
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        access_log(context, 200, 0.012)
+    print(f"rate-limited route: {(time.perf_counter() - start) / REQUESTS * 1e6:.2f} us/request")
+    listener.stop()
+
+    for status in ("200", "400", "404", "500"):
+        for route in ROUTE_OBJECTS:
+            registry.metrics["http_request_duration_seconds"].observe(0.01, ("GET", route.path, status))
+    start = time.perf_counter()
+    body = registry.render()
+    print(f"render {ROUTES * 4} series: {(time.perf_counter() - start) * 1000:.1f} ms, {len(body) / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,159 @@
+"""
+Benchmark: allocate sessions for thousands of package subscriptions at once
+First times the pure in-memory allocation pass on synthetic slots, then, if
+MongoDB is reachable, seeds a throwaway database with availability, existing
+bookings and subscriptions and times one full schedule_subscriptions run
+(range load, allocation, bulk commit) against booking the same sessions one
+create_booking-style lookup at a time.
+
+Run from backend/:
+    MONGO_URL=mongodb://localhost:27017 python benchmarks/bench_package_scheduler.py
+The database named by BENCH_DB_NAME (default titan_bench) is dropped first.
+"""
+
+import asyncio
+import os
+import random
+import sys
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ["DB_NAME"] = os.environ.get("BENCH_DB_NAME", "titan_bench")
+
+from scheduling import allocate_sessions, schedule_subscriptions, FREQUENCY_DAYS  # noqa: E402
+
+SUBSCRIPTIONS = int(os.environ.get("BENCH_SUBSCRIPTIONS", 3000))
+DAYS = 365
+TIMES = [f"{h:02d}:{m:02d}" for h in range(8, 20) for m in (0, 30)]
+EXISTING_BOOKINGS = 2000
+CREWS = int(os.environ.get("BENCH_CREWS", 2))
+START = date(2030, 1, 1)
+
+
+def synthetic_requests(rng):
+    requests = []
+    for _ in range(SUBSCRIPTIONS):
+        frequency = rng.choice(["weekly", "biweekly", "monthly"])
+        requests.append({
+            "start": START.toordinal() + rng.randrange(DAYS - 90),
+            "interval": FREQUENCY_DAYS[frequency],
+            "sessions": rng.choice([2, 4]),
+            "preferred_time": rng.choice(TIMES + [None])
+        })
+    return requests
+
+
+def bench_in_memory():
+    rng = random.Random(42)
+    # Sundays closed
+    open_slots = {
+        START.toordinal() + d: list(TIMES)
+        for d in range(DAYS) if date.fromordinal(START.toordinal() + d).weekday() != 6
+    }
+    reserved = Counter()
+    for _ in range(EXISTING_BOOKINGS):
+        reserved[(START.toordinal() + rng.randrange(DAYS), rng.choice(TIMES))] += 1
+    capacity = {(day, t): CREWS for day in open_slots for t in TIMES}
+    requests = synthetic_requests(rng)
+    sessions = sum(r["sessions"] for r in requests)
+
+    start = time.perf_counter()
+    allocations = allocate_sessions(requests, open_slots, reserved, capacity)
+    elapsed = time.perf_counter() - start
+    print(f"in-memory: {SUBSCRIPTIONS} subscriptions, {sessions} sessions over {len(open_slots) * len(TIMES)} slots x {CREWS} crews")
+    print(f"  allocated {len(allocations)} in {elapsed * 1000:.1f} ms ({len(allocations) / elapsed:,.0f} sessions/s)")
+
+
+async def seed(db, rng):
+    await db.client.drop_database(os.environ["DB_NAME"])
+    service = await db.services.insert_one({"name": "Ev Temizliği", "price": 1000.0, "active": True})
+    packages = []
+    for frequency in FREQUENCY_DAYS:
+        result = await db.packages.insert_one({
+            "name": f"{frequency} paket", "service_id": str(service.inserted_id),
+            "frequency": frequency, "total_sessions": 4, "price": 3200.0, "active": True
+        })
+        packages.append(str(result.inserted_id))
+    existing = Counter()
+    for _ in range(EXISTING_BOOKINGS):
+        day = START + timedelta(days=rng.randrange(DAYS))
+        if day.weekday() != 6:
+            existing[(day.isoformat(), rng.choice(TIMES))] += 1
+    existing = {slot: min(count, CREWS) for slot, count in existing.items()}
+    await db.bookings.insert_many([{
+        "booking_date": d, "booking_time": t, "status": "confirmed", "customer_phone": "0000"
+    } for (d, t), count in existing.items() for _ in range(count)])
+    days = [(START + timedelta(days=d)).isoformat() for d in range(DAYS) if (START + timedelta(days=d)).weekday() != 6]
+    await db.availability.insert_many([{
+        "date": d, "available": True, "time_slots": TIMES, "capacity": CREWS,
+        "reserved": {t: existing.get((d, t), 0) for t in TIMES}
+    } for d in days])
+    await db.customers.insert_many([{"phone": f"05{i:09d}", "name": f"Müşteri {i}", "address": "İstanbul"} for i in range(SUBSCRIPTIONS)])
+    now = datetime.utcnow()
+    await db.subscriptions.insert_many([{
+        "customer_phone": f"05{i:09d}", "package_id": rng.choice(packages), "package_name": "paket",
+        "sessions_remaining": 4, "total_sessions": 4, "price_paid": 3200.0, "status": "active",
+        "start_date": (START + timedelta(days=rng.randrange(DAYS - 90))).isoformat(),
+        "preferred_time": rng.choice(TIMES), "created_at": (now + timedelta(seconds=i)).isoformat()
+    } for i in range(SUBSCRIPTIONS)])
+    await db.availability.create_index("date")
+    await db.subscriptions.create_index("schedule_run")
+
+
+async def one_at_a_time(db, subscriptions, limit):
+    """Old flow: per session, read the day's availability and scan each slot's bookings"""
+    booked = 0
+    for sub in subscriptions[:limit]:
+        day = date.fromisoformat(sub["start_date"])
+        for _ in range(sub["sessions_remaining"]):
+            availability = await db.availability.find_one({"date": day.isoformat()})
+            for slot in (availability or {}).get("time_slots", []):
+                taken = await db.bookings.find_one({"booking_date": day.isoformat(), "booking_time": slot, "status": {"$in": ["pending", "confirmed"]}})
+                if not taken:
+                    booked += 1
+                    break
+            day += timedelta(days=7)
+    return booked
+
+
+async def bench_database():
+    from motor.motor_asyncio import AsyncIOMotorClient
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"], serverSelectionTimeoutMS=2000)
+    try:
+        await client.admin.command("ping")
+    except Exception as e:
+        print(f"database: skipped, MongoDB not reachable ({e.__class__.__name__})")
+        return
+    db = client[os.environ["DB_NAME"]]
+    rng = random.Random(7)
+    print(f"Seeding {SUBSCRIPTIONS} subscriptions...")
+    await seed(db, rng)
+    subscriptions = await db.subscriptions.find().sort("created_at", 1).to_list(None)
+
+    sample = 100
+    start = time.perf_counter()
+    await one_at_a_time(db, subscriptions, sample)
+    per_sub = (time.perf_counter() - start) / sample
+    print(f"one lookup per session: {per_sub * 1000:.1f} ms per subscription, ~{per_sub * SUBSCRIPTIONS:.1f} s projected for all (read-only)")
+
+    start = time.perf_counter()
+    bookings = await schedule_subscriptions(db, subscriptions, today=START - timedelta(days=1))
+    elapsed = time.perf_counter() - start
+    print(f"batch scheduler: {len(bookings)} bookings for {SUBSCRIPTIONS} subscriptions in {elapsed:.2f} s")
+
+    overbooked = await db.bookings.aggregate([
+        {"$match": {"status": {"$in": ["pending", "confirmed"]}}},
+        {"$group": {"_id": {"d": "$booking_date", "t": "$booking_time"}, "n": {"$sum": 1}}},
+        {"$match": {"n": {"$gt": CREWS}}},
+        {"$count": "slots"}
+    ]).to_list(1)
+    print(f"slots holding more bookings than crews: {overbooked[0]['slots'] if overbooked else 0}")
+    await client.drop_database(os.environ["DB_NAME"])
+
+
+if __name__ == "__main__":
+    bench_in_memory()
+    asyncio.run(bench_database())
@@ -0,0 +1,95 @@
+"""
+Benchmark: push delivery throughput against the local fake gateway
+Seeds pending notifications with one device token per customer, starts
+benchmarks/fake_push_server.py in-process and drains the queue with
+PushDeliveryWorker, reporting deliveries per second.
+
+Needs a running MongoDB. Run from backend/:
+    MONGO_URL=mongodb://localhost:27017 python benchmarks/bench_push_delivery.py
+The database named by BENCH_DB_NAME (default titan_bench) is dropped first.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+import uvicorn
+from motor.motor_asyncio import AsyncIOMotorClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from push import ExpoPushTransport, PushDeliveryWorker  # noqa: E402
+from fake_push_server import create_app  # noqa: E402
+
+NOTIFICATIONS = int(os.environ.get("BENCH_NOTIFICATIONS", 20_000))
+CUSTOMERS = 2_000
+PORT = 8099
+FAILURE_RATE = float(os.environ.get("BENCH_FAILURE_RATE", 0.02))
+
+
+async def seed(db):
+    await db.push_tokens.insert_many([
+        {"token": f"ExponentPushToken[{i}]", "target_key": f"customer-{i}"} for i in range(CUSTOMERS)
+    ])
+    now = datetime.utcnow()
+    batch = []
+    for i in range(NOTIFICATIONS):
+        batch.append({
+            "title": "Randevunuz onaylandı",
+            "message": "Ev Temizliği - 2026-01-01 10:00",
+            "type": "customer",
+            "target_id": f"customer-{i % CUSTOMERS}",
+            "read": False,
+            "push_status": "pending",
+            "push_attempts": 0,
+            "push_next_attempt_at": now
+        })
+        if len(batch) == 5000:
+            await db.notifications.insert_many(batch)
+            batch = []
+    if batch:
+        await db.notifications.insert_many(batch)
+    await db.notifications.create_index([("push_status", 1), ("push_next_attempt_at", 1)])
+    await db.push_tokens.create_index("target_key")
+
+
+async def main():
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    db_name = os.environ.get("BENCH_DB_NAME", "titan_bench")
+    await client.drop_database(db_name)
+    db = client[db_name]
+    await seed(db)
+
+    gateway = create_app(failure_rate=FAILURE_RATE)
+    server = uvicorn.Server(uvicorn.Config(gateway, host="127.0.0.1", port=PORT, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    transport = ExpoPushTransport(f"http://127.0.0.1:{PORT}/--/api/v2/push/send")
+    # No backoff, so retries are drained within the run
+    worker = PushDeliveryWorker(db, transport, base_backoff=0)
+    start = time.perf_counter()
+    while await worker.run_once():
+        pass
+    elapsed = time.perf_counter() - start
+
+    print(f"{NOTIFICATIONS} notifications, failure rate {FAILURE_RATE:.0%}")
+    print(f"wall time:          {elapsed:8.2f} s")
+    print(f"gateway calls:      {worker.stats['gateway_calls']:8d}")
+    print(f"delivered:          {worker.stats['delivered']:8d}")
+    print(f"retried:            {worker.stats['retried']:8d}")
+    print(f"dead-lettered:      {worker.stats['dead']:8d}")
+    print(f"deliveries/second:  {worker.stats['messages'] / elapsed:8.0f} (wall), {worker.deliveries_per_second():.0f} (busy)")
+
+    await transport.close()
+    server.should_exit = True
+    await server_task
+    await client.drop_database(db_name)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+"""
+Micro-benchmark: admin list serialization
+Compares the old path ({**serialize_doc(doc), "id": ...} copies followed by
+FastAPI's jsonable_encoder and stdlib json) with FastJSONResponse rendering
+documents whose ids were already mapped to strings by the find_serialized
+projection.
+
+Run from backend/: python benchmarks/bench_serialization.py
+"""
+
+import json
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+from server import FastJSONResponse, serialize_doc  # noqa: E402
+
+ROWS = 1000
+REPEAT = 20
+
+
+def make_bookings(n):
+    now = datetime.utcnow()
+    return [{
+        "_id": ObjectId(),
+        "service_id": str(ObjectId()),
+        "service_name": "Ev Temizliği",
+        "customer_name": f"Müşteri {i}",
+        "customer_phone": f"0555{i:07d}",
+        "customer_address": "Atatürk Cad. No: 1 Kadıköy İstanbul",
+        "booking_date": (now + timedelta(days=i % 60)).strftime("%Y-%m-%d"),
+        "booking_time": "10:00",
+        "base_price": 1500.0,
+        "total_price": 1350.0,
+        "discount_applied": 150.0,
+        "discount_details": ["Cuma indirimi: ₺150.00"],
+        "payment_method": "cash",
+        "customer_photos": [],
+        "status": "pending",
+        "created_at": (now - timedelta(minutes=i)).isoformat()
+    } for i in range(n)]
+
+
+def make_customers(n):
+    now = datetime.utcnow()
+    return [{
+        "_id": ObjectId(),
+        "name": f"Müşteri {i}",
+        "phone": f"0555{i:07d}",
+        "email": f"musteri{i}@example.com",
+        "address": "Atatürk Cad. No: 1 Kadıköy İstanbul",
+        "loyalty_points": i % 300,
+        "total_bookings": i % 12,
+        "referral_code": f"REF{i:05d}",
+        "referred_by": None,
+        "created_at": (now - timedelta(minutes=i)).isoformat()
+    } for i in range(n)]
+
+
+def project(docs):
+    """What the ID_TO_STRING stage returns from MongoDB"""
+    return [{**d, "_id": str(d["_id"]), "id": str(d["_id"])} for d in docs]
+
+
+def old_path(docs):
+    rows = [{**serialize_doc(dict(d)), "id": str(d["_id"])} for d in docs]
+    return json.dumps(jsonable_encoder(rows), ensure_ascii=False).encode("utf-8")
+
+
+def new_path(projected):
+    return FastJSONResponse(projected).body
+
+
+def run(name, docs):
+    projected = project(docs)
+    assert json.loads(old_path(docs)) == json.loads(new_path(projected))
+    old = min(timeit.repeat(lambda: old_path(docs), number=1, repeat=REPEAT))
+    new = min(timeit.repeat(lambda: new_path(projected), number=1, repeat=REPEAT))
+    print(f"{name:<16} {ROWS} rows  old: {old * 1000:7.2f} ms  new: {new * 1000:7.2f} ms  speedup: {old / new:5.1f}x")
+
+
+if __name__ == "__main__":
+    run("admin/bookings", make_bookings(ROWS))
+    run("admin/customers", make_customers(ROWS))
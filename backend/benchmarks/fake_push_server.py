@@ -0,0 +1,76 @@
+"""
+Local stand-in for the Expo push gateway, for tests and benchmarks.
+Accepts the same request/response format as https://exp.host/--/api/v2/push/send.
+
+Run from backend/:
+    python benchmarks/fake_push_server.py --port 8099 --failure-rate 0.05
+then start the API with PUSH_GATEWAY_URL=http://127.0.0.1:8099/--/api/v2/push/send
+"""
+
+import argparse
+import asyncio
+import random
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+MAX_MESSAGES_PER_CALL = 100
+
+
+def create_app(
+    failure_rate: float = 0.0,
+    latency: float = 0.0,
+    invalid_prefix: str = "invalid",
+    retry_prefix: str = "retry",
+    record: bool = False
+) -> FastAPI:
+    """Gateway that fails failure_rate of messages, and every message to a
+    token starting with retry_prefix, with a retryable error and rejects
+    tokens starting with invalid_prefix as DeviceNotRegistered. With record,
+    the received messages are kept in app.state.messages."""
+    app = FastAPI()
+    app.state.received = 0
+    app.state.calls = 0
+    app.state.messages = []
+
+    @app.post("/--/api/v2/push/send")
+    async def send(request: Request):
+        messages = await request.json()
+        if isinstance(messages, dict):
+            messages = [messages]
+        if len(messages) > MAX_MESSAGES_PER_CALL:
+            return JSONResponse({"errors": [{"code": "PUSH_TOO_MANY_NOTIFICATIONS"}]}, status_code=400)
+        if latency:
+            await asyncio.sleep(latency)
+        app.state.calls += 1
+        app.state.received += len(messages)
+        if record:
+            app.state.messages += messages
+
+        tickets = []
+        for message in messages:
+            if str(message.get("to", "")).startswith(invalid_prefix):
+                tickets.append({"status": "error", "message": "not registered", "details": {"error": "DeviceNotRegistered"}})
+            elif str(message.get("to", "")).startswith(retry_prefix) or random.random() < failure_rate:
+                tickets.append({"status": "error", "message": "rate exceeded", "details": {"error": "MessageRateExceeded"}})
+            else:
+                tickets.append({"status": "ok", "id": str(uuid.uuid4())})
+        return {"data": tickets}
+
+    @app.get("/stats")
+    async def stats():
+        return {"calls": app.state.calls, "received": app.state.received}
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.failure_rate, args.latency), host="127.0.0.1", port=args.port, log_level="warning")
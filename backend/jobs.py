@@ -0,0 +1,212 @@
+"""
+Persistent in-process background job runner.
+
+Jobs are documents in the jobs collection, so queued work survives a
+restart. Handlers are registered by name with JobRunner.task and receive the
+job payload as keyword arguments. A fixed number of worker coroutines claim
+the highest-priority due job with find_one_and_update; failures are retried
+with exponential backoff up to max_attempts. A running job holds a lease
+that its worker renews every lease_timeout / 3 seconds, so only jobs whose
+process died are claimed again; such a reclaim counts as an attempt. drain()
+stops claiming and waits for running jobs, for use in the shutdown event.
+Jobs enqueued with a key are created at most once per key, so every process
+can enqueue the same scheduled job and it still runs once per cluster.
+"""
+
+import asyncio
+import logging
+import secrets
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+class JobRunner:
+    def __init__(
+        self,
+        db,
+        concurrency: int = 4,
+        poll_interval: float = 1.0,
+        max_attempts: int = 3,
+        base_backoff: float = 5.0,
+        lease_timeout: float = 600.0,
+        keep_finished_days: int = 7
+    ):
+        self.db = db
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.lease_timeout = lease_timeout
+        self.keep_finished_days = keep_finished_days
+        self.handlers: Dict[str, Callable] = {}
+        self.worker_id = secrets.token_hex(6)
+        self.workers = []
+        self.running = set()
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+
+    def task(self, name: str):
+        """Register an async handler for jobs with the given name"""
+        def decorator(handler):
+            self.handlers[name] = handler
+            return handler
+        return decorator
+
+    def job_doc(self, name: str, payload: Optional[dict], priority: int, delay: float, max_attempts: Optional[int]) -> dict:
+        if name not in self.handlers:
+            raise ValueError(f"Unknown job: {name}")
+        now = datetime.utcnow()
+        return {
+            "name": name,
+            "payload": payload or {},
+            "priority": priority,
+            "status": "queued",
+            "attempts": 0,
+            "max_attempts": max_attempts or self.max_attempts,
+            "run_at": now + timedelta(seconds=delay),
+            "created_at": now
+        }
+
+    async def enqueue(self, name: str, payload: Optional[dict] = None, priority: int = 0, delay: float = 0, max_attempts: Optional[int] = None, key: Optional[str] = None):
+        """Persist a job and return its id; higher priority runs first.
+
+        With a key, returns None if a job with that key was already enqueued.
+        """
+        job = self.job_doc(name, payload, priority, delay, max_attempts)
+        if key is not None:
+            job["key"] = key
+        try:
+            result = await self.db.jobs.insert_one(job)
+        except DuplicateKeyError:
+            return None
+        self.wakeup.set()
+        return result.inserted_id
+
+    async def enqueue_many(self, name: str, payloads: List[dict], priority: int = 0, delay: float = 0, max_attempts: Optional[int] = None):
+        """Persist one job per payload with a single insert and return their ids"""
+        if not payloads:
+            return []
+        result = await self.db.jobs.insert_many([
+            self.job_doc(name, payload, priority, delay, max_attempts) for payload in payloads
+        ])
+        self.wakeup.set()
+        return result.inserted_ids
+
+    async def claim(self) -> Optional[dict]:
+        now = datetime.utcnow()
+        return await self.db.jobs.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_at": {"$lte": now}},
+                # Jobs whose worker stopped renewing the lease (crashed or killed process)
+                {"status": "running", "lease_until": {"$lte": now}},
+                # Claimed before leases were renewed
+                {"status": "running", "lease_until": {"$exists": False}, "started_at": {"$lte": now - timedelta(seconds=self.lease_timeout)}}
+            ]},
+            {
+                "$set": {
+                    "status": "running", "started_at": now, "worker": self.worker_id,
+                    "lease_until": now + timedelta(seconds=self.lease_timeout)
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("priority", -1), ("run_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def heartbeat(self, job: dict):
+        """Renew the job's lease until cancelled"""
+        while True:
+            await asyncio.sleep(self.lease_timeout / 3)
+            try:
+                result = await self.db.jobs.update_one(
+                    {"_id": job["_id"], "status": "running", "worker": self.worker_id},
+                    {"$set": {"lease_until": datetime.utcnow() + timedelta(seconds=self.lease_timeout)}}
+                )
+                if result.matched_count == 0:
+                    logger.warning(f"Job {job['name']} {job['_id']} lost its lease")
+                    return
+            except Exception:
+                logger.exception(f"Renewing the lease of job {job['name']} {job['_id']} failed")
+
+    async def execute(self, job: dict):
+        handler = self.handlers.get(job["name"])
+        max_attempts = job.get("max_attempts", self.max_attempts)
+        if job["attempts"] > max_attempts:
+            # Reclaimed after its worker died on the last attempt
+            await self.db.jobs.update_one({"_id": job["_id"]}, {"$set": {
+                "status": "failed", "finished_at": datetime.utcnow(), "error": "Lease expired on the last attempt",
+                "expire_at": datetime.utcnow() + timedelta(days=self.keep_finished_days)
+            }})
+            logger.error(f"Job {job['name']} {job['_id']} failed permanently: lease expired {max_attempts} times")
+            return
+        heartbeat = asyncio.ensure_future(self.heartbeat(job))
+        try:
+            if handler is None:
+                raise ValueError(f"Unknown job: {job['name']}")
+            await handler(**job.get("payload", {}))
+        except Exception as e:
+            if job["attempts"] < max_attempts:
+                backoff = self.base_backoff * (2 ** (job["attempts"] - 1))
+                await self.db.jobs.update_one({"_id": job["_id"]}, {"$set": {
+                    "status": "queued", "run_at": datetime.utcnow() + timedelta(seconds=backoff), "error": repr(e)
+                }})
+                logger.warning(f"Job {job['name']} {job['_id']} failed, retrying in {backoff:.0f}s: {e!r}")
+            else:
+                await self.db.jobs.update_one({"_id": job["_id"]}, {"$set": {
+                    "status": "failed", "finished_at": datetime.utcnow(), "error": repr(e),
+                    "expire_at": datetime.utcnow() + timedelta(days=self.keep_finished_days)
+                }})
+                logger.exception(f"Job {job['name']} {job['_id']} failed permanently")
+            return
+        finally:
+            heartbeat.cancel()
+        await self.db.jobs.update_one({"_id": job["_id"]}, {"$set": {
+            "status": "done", "finished_at": datetime.utcnow(),
+            "expire_at": datetime.utcnow() + timedelta(days=self.keep_finished_days)
+        }})
+
+    async def work(self):
+        while not self.stopping:
+            try:
+                job = await self.claim()
+            except Exception:
+                logger.exception("Job claim failed")
+                job = None
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            # Shielded so a drain timeout never abandons a job halfway
+            task = asyncio.ensure_future(self.execute(job))
+            self.running.add(task)
+            try:
+                await asyncio.shield(task)
+            finally:
+                self.running.discard(task)
+
+    async def start(self):
+        await self.db.jobs.create_index([("status", 1), ("priority", -1), ("run_at", 1)])
+        await self.db.jobs.create_index("expire_at", expireAfterSeconds=0)
+        await self.db.jobs.create_index("key", unique=True, partialFilterExpression={"key": {"$exists": True}})
+        self.stopping = False
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+
+    async def drain(self, timeout: float = 30.0):
+        """Stop claiming jobs and wait up to timeout for running ones"""
+        self.stopping = True
+        self.wakeup.set()
+        if self.running:
+            done, pending = await asyncio.wait(set(self.running), timeout=timeout)
+            if pending:
+                logger.warning(f"{len(pending)} jobs still running at shutdown; they will be retried after the lease expires")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
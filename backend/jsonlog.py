@@ -0,0 +1,176 @@
+"""
+Structured JSON logging off the event loop.
+
+configure_logging() routes every record through a bounded queue: the
+QueueHandler on the calling thread only merges the message arguments,
+renders a traceback if there is one and stamps the current request's id and
+route; a QueueListener thread encodes the record as one JSON line and
+writes it, so slow log pipes never stall the loop. When the queue is full,
+records are dropped and counted in log_records_dropped_total.
+
+AccessLog writes one line per request with method, route, status, latency
+and MongoDB call count. Routes listed in its rate limits (high-volume ones
+such as /api/location/update) are logged at most that many times per
+second; the next line logged for the route reports how many were skipped.
+Server errors are always logged.
+
+    {"ts": "2026-10-19T09:00:00.123Z", "level": "INFO", "logger": "access",
+     "msg": "POST /api/bookings 200", "request_id": "3f9c1a2b00000012",
+     "route": "/api/bookings", "method": "POST", "status": 200,
+     "latency_ms": 12.4, "db_calls": 5, "db_time_ms": 3.1}
+"""
+
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import orjson
+
+from metrics import REGISTRY, Counter, RequestContext, Registry, current_request
+
+# Standard LogRecord attributes; anything else set through extra= is emitted
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return orjson.dumps(entry, default=str).decode()
+
+
+class RequestQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records without formatting them, tagged with the current request"""
+
+    def __init__(self, log_queue: queue.Queue, dropped: Counter):
+        super().__init__(log_queue)
+        self.dropped = dropped
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Arguments and tracebacks may not survive until the listener runs
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        context = current_request.get()
+        if context is not None and not hasattr(record, "request_id"):
+            record.request_id = context.request_id
+            record.route = context.route
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped.inc()
+
+
+class TextFormatter(logging.Formatter):
+    """The previous plain text format, with the request id when there is one"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        request_id = getattr(record, "request_id", None)
+        return f"{line} [{request_id}]" if request_id else line
+
+
+def configure_logging(
+    level: str = "INFO",
+    format: str = "json",
+    queue_size: int = 10000,
+    stream=None,
+    registry: Registry = REGISTRY
+) -> logging.handlers.QueueListener:
+    """Send all logging through a queue to a JSON (or text) writer thread.
+
+    Returns the started listener; stop() it at shutdown to flush the queue.
+    """
+    log_queue = queue.Queue(maxsize=queue_size)
+    dropped = registry.register(Counter(
+        "log_records_dropped_total", "Log records dropped because the log queue was full."
+    ))
+    writer = logging.StreamHandler(stream or sys.stdout)
+    writer.setFormatter(JSONFormatter() if format == "json" else TextFormatter())
+    listener = logging.handlers.QueueListener(log_queue, writer)
+
+    handler = RequestQueueHandler(log_queue, dropped)
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    # Uvicorn logs through its own handlers; send its errors through the
+    # queue too, and leave access lines to AccessLog
+    for name in ("uvicorn", "uvicorn.error"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+    logging.getLogger("uvicorn.access").disabled = True
+    listener.start()
+    return listener
+
+
+class AccessLog:
+    """Per-request access lines with per-route rate limits (lines per second)"""
+
+    def __init__(self, rate_limits: Optional[Dict[str, float]] = None, logger: Optional[logging.Logger] = None):
+        self.rate_limits = rate_limits or {}
+        self.logger = logger or logging.getLogger("access")
+        # route -> [current second, lines logged in it, lines skipped since the last one]
+        self.windows: Dict[str, list] = {}
+
+    def __call__(self, context: RequestContext, status: int, elapsed: float):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        route = context.route
+        skipped = 0
+        limit = self.rate_limits.get(route)
+        if limit is not None and status < 500:
+            second = int(time.monotonic())
+            window = self.windows.get(route)
+            if window is None or window[0] != second:
+                window = self.windows[route] = [second, 0, window[2] if window else 0]
+            if window[1] >= limit:
+                window[2] += 1
+                return
+            window[1] += 1
+            skipped, window[2] = window[2], 0
+        method = context.scope["method"]
+        self.logger.log(logging.WARNING if status >= 500 else logging.INFO, f"{method} {route} {status}", extra={
+            "request_id": context.request_id,
+            "route": route,
+            "method": method,
+            "status": status,
+            "latency_ms": round(elapsed * 1000, 1),
+            "db_calls": context.db_calls,
+            "db_time_ms": round(context.db_time * 1000, 1),
+            "skipped": skipped or None
+        })
+
+
+def parse_rate_limits(value: str) -> Dict[str, float]:
+    """'route=lines_per_second,...' as a dict"""
+    limits = {}
+    for item in value.split(","):
+        route, _, rate = item.strip().rpartition("=")
+        if route:
+            limits[route] = float(rate)
+    return limits
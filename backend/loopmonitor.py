@@ -0,0 +1,85 @@
+"""
+Event loop lag monitor and blocking-call detector.
+
+A heartbeat coroutine sleeps for interval seconds at a time and records how
+late each wakeup is: that lag is how long any ready callback (a request, a
+job) waited for the loop, exported as a histogram and a last-value gauge.
+
+A watchdog thread checks the heartbeat every threshold / 2. When it is more
+than threshold stale, one callback has held the loop that long without
+yielding (bcrypt, a large sort or parse, a blocking client call), and the
+loop thread's current stack names the offending coroutine. The stack is
+logged once per blocking episode and the episode is counted.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Optional
+
+from metrics import REGISTRY, Counter, Gauge, Histogram, Registry
+
+logger = logging.getLogger(__name__)
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class LoopMonitor:
+    def __init__(self, registry: Registry = REGISTRY, interval: float = 0.05, threshold: float = 0.1):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = registry.register(Histogram(
+            "event_loop_lag_seconds", "Delay of event loop heartbeat wakeups.", buckets=LAG_BUCKETS
+        ))
+        self.last_lag = registry.register(Gauge(
+            "event_loop_lag_last_seconds", "Delay of the latest event loop heartbeat wakeup."
+        ))
+        self.blocked = registry.register(Counter(
+            "event_loop_blocked_total", "Callbacks that held the event loop longer than the blocking threshold."
+        ))
+        self.beat = time.monotonic()
+        self.loop_thread: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+
+    async def heartbeat(self):
+        while True:
+            start = time.monotonic()
+            self.beat = start
+            await asyncio.sleep(self.interval)
+            lag = max(time.monotonic() - start - self.interval, 0.0)
+            self.lag.observe(lag)
+            self.last_lag.set(lag)
+            if lag >= self.threshold:
+                logger.warning(f"Event loop heartbeat was {lag * 1000:.0f} ms late")
+
+    def watch(self):
+        reported = None
+        while not self.stopping.wait(self.threshold / 2):
+            beat = self.beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled < self.threshold or beat == reported:
+                continue
+            reported = beat
+            self.blocked.inc()
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "  (stack unavailable)\n"
+            logger.warning(f"Event loop blocked for {stalled * 1000:.0f} ms so far, in:\n{stack.rstrip()}")
+
+    def start(self):
+        """Start monitoring the running loop; call from a coroutine on it"""
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.stopping.clear()
+        self.task = asyncio.get_running_loop().create_task(self.heartbeat())
+        self.watchdog = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.task:
+            self.task.cancel()
@@ -0,0 +1,458 @@
+"""
+Prometheus metrics in the text exposition format.
+
+A deliberately small registry instead of a client library: metrics are
+plain dicts keyed by label-value tuples and rendered on scrape. Updates come
+from the event loop and from pymongo's monitoring threads (CommandMetrics,
+PoolMetrics), so each metric guards its dict with its own lock and render
+copies it under that lock. That keeps the per-request cost of
+MetricsMiddleware to a couple of uncontended lock acquisitions, dict updates
+and a bisect; see benchmarks/bench_metrics.py.
+
+    MetricsMiddleware - ASGI middleware feeding HTTPMetrics: in-flight gauge,
+                        request counts and latency histograms by method,
+                        route template and status; also publishes the
+                        request's RequestContext (with its request id)
+                        and its request id and DB call headers
+    PoolMetrics       - pymongo connection pool listener: open, checked-out
+                        and waiting connections per server
+    CommandMetrics    - pymongo command listener: timings and document counts
+                        per collection and command, per-request DB calls and
+                        a slow-command log naming the route
+"""
+
+import itertools
+import logging
+import secrets
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds; Prometheus client defaults
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Seconds; MongoDB commands are mostly well under a millisecond
+COMMAND_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{escape_label(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def samples(self) -> Iterable[Tuple[str, Tuple[str, ...], Tuple, float]]:
+        """(name, label names, label values, value) for every sample"""
+        raise NotImplementedError
+
+    def render(self, lines: List[str]):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} {self.type}")
+        for name, labelnames, values, value in self.samples():
+            lines.append(f"{name}{format_labels(labelnames, values)} {format_value(value)}")
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield self.name, self.labelnames, labels, value
+
+
+class Gauge(Metric):
+    """A gauge set directly, or read from collect() at scrape time"""
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), collect: Optional[Callable[[], Dict[Tuple, float]]] = None):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Tuple, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, labels: Tuple = ()):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, labels: Tuple = (), amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels: Tuple = (), amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) - amount
+
+    def samples(self):
+        if self.collect:
+            values = list(self.collect().items())
+        else:
+            with self.lock:
+                values = list(self.values.items())
+        for labels, value in values:
+            yield self.name, self.labelnames, labels, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label tuple: [count per bucket..., count above the last bucket, sum]
+        self.series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, labels: Tuple = ()):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        bucket_labels = self.labelnames + ("le",)
+        # Copied under the lock so counts and sum come from the same moment
+        with self.lock:
+            snapshot = [(labels, list(series)) for labels, series in self.series.items()]
+        for labels, series in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                yield f"{self.name}_bucket", bucket_labels, labels + (format_value(bound),), cumulative
+            yield f"{self.name}_sum", self.labelnames, labels, series[-1]
+            yield f"{self.name}_count", self.labelnames, labels, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Duplicate metric: {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self.metrics.values():
+            metric.render(lines)
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+REGISTRY = Registry()
+
+
+# Generated request ids: a per-process random prefix and a sequence number
+REQUEST_ID_PREFIX = secrets.token_hex(4)
+request_sequence = itertools.count(1)
+
+
+def incoming_request_id(scope) -> Optional[str]:
+    """A caller-supplied X-Request-ID, so a proxy's id carries through"""
+    for name, value in scope["headers"]:
+        if name == b"x-request-id":
+            return value.decode("latin-1")[:64] or None
+    return None
+
+
+class RequestContext:
+    """State of the HTTP request being served, shared with the code it runs"""
+    __slots__ = ("scope", "request_id", "db_calls", "db_time")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.request_id = incoming_request_id(scope) or f"{REQUEST_ID_PREFIX}{next(request_sequence):08x}"
+        self.db_calls = 0
+        self.db_time = 0.0
+
+    @property
+    def route(self) -> str:
+        return getattr(self.scope.get("route"), "path", "unmatched")
+
+
+# Set by MetricsMiddleware; None outside requests (startup, background jobs)
+current_request: ContextVar[Optional[RequestContext]] = ContextVar("current_request", default=None)
+
+
+class HTTPMetrics:
+    def __init__(self, registry: Registry = REGISTRY):
+        self.in_flight = registry.register(Gauge(
+            "http_requests_in_flight", "HTTP requests currently being served."
+        ))
+        self.requests = registry.register(Counter(
+            "http_requests_total", "HTTP requests by method, route and status.", ("method", "route", "status")
+        ))
+        self.duration = registry.register(Histogram(
+            "http_request_duration_seconds", "HTTP request latency by method, route and status.", ("method", "route", "status")
+        ))
+
+
+class MetricsMiddleware:
+    """Time HTTP requests and label them by route template, not raw path.
+
+    The route is read from the scope after the app has run, where FastAPI's
+    router leaves the matched route; unmatched paths share one label so
+    scanners cannot blow up the series count. The duration covers the whole
+    response, including streamed bodies.
+
+    The request's RequestContext is published in current_request, and the
+    response carries its X-Request-ID plus X-DB-Calls and X-DB-Time-Ms: the
+    MongoDB commands run for it before its headers were sent (so not the
+    rest of a stream). on_finish, if given, is called with the context,
+    status and duration of every finished request.
+    """
+
+    def __init__(self, app, metrics: HTTPMetrics, on_finish: Optional[Callable[[RequestContext, int, float], None]] = None):
+        self.app = app
+        self.in_flight = metrics.in_flight
+        self.requests = metrics.requests
+        self.duration = metrics.duration
+        self.on_finish = on_finish
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        context = RequestContext(scope)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [
+                    *message.get("headers", ()),
+                    (b"x-request-id", context.request_id.encode("latin-1")),
+                    (b"x-db-calls", b"%d" % context.db_calls),
+                    (b"x-db-time-ms", b"%.1f" % (context.db_time * 1000))
+                ]}
+            await send(message)
+
+        token = current_request.set(context)
+        self.in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.in_flight.dec()
+            current_request.reset(token)
+            labels = (scope["method"], context.route, str(status))
+            self.requests.inc(labels)
+            self.duration.observe(elapsed, labels)
+            if self.on_finish:
+                self.on_finish(context, status, elapsed)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Connection pool gauges per MongoDB server, from pool monitoring events.
+
+    Pass the instance in the client's event_listeners. Events arrive on
+    pymongo's threads, so the counts are updated under a lock and exported
+    through collect callbacks.
+    """
+
+    def __init__(self, registry: Registry = REGISTRY):
+        self.lock = threading.Lock()
+        # address -> [open, checked out, waiting, max size]
+        self.pools: Dict[str, list] = {}
+        self.checkout_failures = Counter(
+            "mongodb_pool_checkout_failures_total", "Failed connection checkouts by server and reason.", ("address", "reason")
+        )
+        for index, (name, help) in enumerate([
+            ("mongodb_pool_connections", "Open connections in the pool."),
+            ("mongodb_pool_checked_out", "Connections checked out by operations."),
+            ("mongodb_pool_waiting", "Operations waiting to check out a connection."),
+            ("mongodb_pool_max_size", "Configured maximum pool size.")
+        ]):
+            registry.register(Gauge(name, help, ("address",), collect=self.gauge(index)))
+        registry.register(self.checkout_failures)
+
+    def gauge(self, index: int) -> Callable[[], Dict[Tuple, float]]:
+        def collect():
+            with self.lock:
+                return {(address,): pool[index] for address, pool in self.pools.items()}
+        return collect
+
+    def update(self, address, *deltas: Tuple[int, int]):
+        """Apply (index, delta) pairs to a pool's counts"""
+        with self.lock:
+            pool = self.pools.get(f"{address[0]}:{address[1]}")
+            if pool is not None:
+                for index, delta in deltas:
+                    pool[index] += delta
+
+    def pool_created(self, event):
+        key = f"{event.address[0]}:{event.address[1]}"
+        with self.lock:
+            self.pools[key] = [0, 0, 0, event.options.get("maxPoolSize", 100)]
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        with self.lock:
+            self.pools.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def connection_created(self, event):
+        self.update(event.address, (0, 1))
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.update(event.address, (0, -1))
+
+    def connection_check_out_started(self, event):
+        self.update(event.address, (2, 1))
+
+    def connection_check_out_failed(self, event):
+        self.update(event.address, (2, -1))
+        with self.lock:
+            self.checkout_failures.inc((f"{event.address[0]}:{event.address[1]}", str(event.reason)))
+
+    def connection_checked_out(self, event):
+        self.update(event.address, (2, -1), (1, 1))
+
+    def connection_checked_in(self, event):
+        self.update(event.address, (1, -1))
+
+
+def command_collection(event) -> str:
+    target = event.command.get("collection") if event.command_name == "getMore" else event.command.get(event.command_name)
+    return target if isinstance(target, str) else ""
+
+
+def command_shape(command) -> str:
+    """Field names of a command's filter, sort and pipeline stages, never values"""
+    parts = []
+    for key in ("filter", "query", "sort"):
+        if isinstance(command.get(key), dict):
+            parts.append(f"{key}={','.join(command[key])}")
+    if isinstance(command.get("pipeline"), list):
+        parts.append(f"pipeline={','.join(next(iter(stage), '') for stage in command['pipeline'])}")
+    for key in ("updates", "deletes"):
+        if command.get(key):
+            parts.append(f"{key}={len(command[key])} q={','.join(command[key][0].get('q', {}))}")
+    return " ".join(parts)
+
+
+def reply_documents(reply) -> int:
+    """Documents returned (cursor batches) or written (n) by a command"""
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or ())
+    n = reply.get("n")
+    return n if isinstance(n, int) else 0
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """MongoDB command timings per collection and command.
+
+    Pass the instance in the client's event_listeners. Motor runs pymongo in
+    executor threads with a copy of the caller's context, so current_request
+    still names the request that issued a command; each finished command is
+    counted in that request's db_calls and db_time. Commands taking at least
+    slow_ms are logged with the route and the command's shape.
+    """
+
+    def __init__(self, registry: Registry = REGISTRY, slow_ms: float = 100.0):
+        self.lock = threading.Lock()
+        self.slow_ms = slow_ms
+        # (connection id, request id) -> (collection, request context, command)
+        self.in_progress: Dict[tuple, tuple] = {}
+        self.duration = registry.register(Histogram(
+            "mongodb_command_duration_seconds", "MongoDB command latency by collection and command.",
+            ("collection", "command"), buckets=COMMAND_BUCKETS
+        ))
+        self.documents = registry.register(Counter(
+            "mongodb_command_documents_total", "Documents returned or written by MongoDB commands.", ("collection", "command")
+        ))
+        self.failures = registry.register(Counter(
+            "mongodb_command_failures_total", "Failed MongoDB commands by collection and command.", ("collection", "command")
+        ))
+
+    def started(self, event):
+        entry = (command_collection(event), current_request.get(), event.command)
+        with self.lock:
+            self.in_progress[(event.connection_id, event.request_id)] = entry
+
+    def pending(self, context: RequestContext) -> List[str]:
+        """collection.command of the commands in flight for a request"""
+        with self.lock:
+            return sorted({
+                f"{collection}.{next(iter(command))}"
+                for collection, owner, command in self.in_progress.values() if owner is context
+            })
+
+    def finish(self, event, documents: int, failed: bool):
+        with self.lock:
+            entry = self.in_progress.pop((event.connection_id, event.request_id), None)
+            if entry is None:
+                return
+            collection, context, command = entry
+            labels = (collection, event.command_name)
+            seconds = event.duration_micros / 1e6
+            self.duration.observe(seconds, labels)
+            if documents:
+                self.documents.inc(labels, documents)
+            if failed:
+                self.failures.inc(labels)
+            if context is not None:
+                context.db_calls += 1
+                context.db_time += seconds
+        if seconds * 1000 >= self.slow_ms:
+            logger.warning(
+                f"Slow MongoDB command: {event.command_name} {event.database_name}.{collection} "
+                f"{seconds * 1000:.0f} ms, {documents} docs, route {context.route if context else '-'} "
+                f"{command_shape(command)}".rstrip()
+            )
+
+    def succeeded(self, event):
+        self.finish(event, reply_documents(event.reply), False)
+
+    def failed(self, event):
+        self.finish(event, 0, True)
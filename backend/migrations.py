@@ -0,0 +1,232 @@
+"""
+Online, resumable schema migrations.
+
+A migration is a numbered, per-document transform registered with
+MigrationRunner.migration: given a document matching its query, it returns
+an update document (or None to leave the document alone). The runner walks
+the collection in _id order, batch_size documents at a time, applies each
+batch with one unordered bulk_write and pauses between batches, so the
+collection stays online and is never locked or loaded whole.
+
+Progress lives in the schema_migrations collection, one document per
+version: status (pending / running / applied / failed), the last _id
+processed, counts and a lease. An interrupted run resumes after the last
+checkpointed _id; the lease keeps two processes from running the same
+migration. A dry run scans the same batches without writing and reports how
+many documents would change, with a few sample updates.
+
+Command line, from backend/:
+    python migrations.py                 list migrations and their status
+    python migrations.py run [VERSION]   apply pending migrations (or one)
+    python migrations.py dry-run VERSION
+"""
+
+import asyncio
+import logging
+import sys
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+DRY_RUN_SAMPLES = 5
+
+
+class Migration:
+    __slots__ = ("version", "collection", "description", "query", "projection", "transform")
+
+    def __init__(self, version: int, collection: str, description: str, query: dict, projection: Optional[dict], transform: Callable):
+        self.version = version
+        self.collection = collection
+        self.description = description
+        self.query = query
+        self.projection = projection
+        self.transform = transform
+
+
+class MigrationRunner:
+    def __init__(self, db, batch_size: int = 500, pause: float = 0.2, lease_timeout: float = 300.0):
+        self.db = db
+        self.batch_size = batch_size
+        self.pause = pause
+        self.lease_timeout = lease_timeout
+        self.migrations: Dict[int, Migration] = {}
+
+    def migration(self, version: int, collection: str, description: str, query: Optional[dict] = None, projection: Optional[dict] = None):
+        """Register a per-document transform returning an update or None"""
+        def decorator(transform):
+            if version in self.migrations:
+                raise ValueError(f"Duplicate migration version: {version}")
+            self.migrations[version] = Migration(version, collection, description, query or {}, projection, transform)
+            return transform
+        return decorator
+
+    async def status(self) -> List[dict]:
+        states = {s["_id"]: s for s in await self.db.schema_migrations.find().to_list(None)}
+        return [{
+            "version": m.version,
+            "collection": m.collection,
+            "description": m.description,
+            **{k: v for k, v in states.get(m.version, {"status": "pending"}).items() if k != "_id"}
+        } for m in sorted(self.migrations.values(), key=lambda m: m.version)]
+
+    async def pending(self) -> List[Migration]:
+        applied = set(await self.db.schema_migrations.distinct("_id", {"status": "applied"}))
+        return [m for m in sorted(self.migrations.values(), key=lambda m: m.version) if m.version not in applied]
+
+    async def batches(self, migration: Migration, after=None):
+        """Yield (documents, [(_id, update)]) per _id-range batch after the given _id"""
+        while True:
+            query = dict(migration.query)
+            if after is not None:
+                query["_id"] = {"$gt": after}
+            docs = await self.db[migration.collection].find(query, migration.projection).sort("_id", 1).limit(self.batch_size).to_list(self.batch_size)
+            if not docs:
+                return
+            updates = []
+            for doc in docs:
+                update = migration.transform(doc)
+                if update:
+                    updates.append((doc["_id"], update))
+            yield docs, updates
+            after = docs[-1]["_id"]
+
+    async def acquire(self, migration: Migration) -> Optional[dict]:
+        """Take the lease on a migration; None if it is applied or leased elsewhere"""
+        now = datetime.utcnow()
+        try:
+            return await self.db.schema_migrations.find_one_and_update(
+                {"_id": migration.version, "status": {"$ne": "applied"}, "$or": [
+                    {"locked_until": {"$exists": False}}, {"locked_until": {"$lt": now}}
+                ]},
+                {
+                    "$set": {
+                        "status": "running",
+                        "collection": migration.collection,
+                        "description": migration.description,
+                        "locked_until": now + timedelta(seconds=self.lease_timeout)
+                    },
+                    "$setOnInsert": {"last_id": None, "processed": 0, "modified": 0, "started_at": now}
+                },
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return None
+
+    async def run(self, migration: Migration, progress: Optional[Callable] = None) -> Optional[dict]:
+        """Apply one migration, resuming from its checkpoint"""
+        state = await self.acquire(migration)
+        if state is None:
+            logger.info(f"Migration {migration.version} is applied or running elsewhere")
+            return None
+        # A dry run may have created the state document without counters
+        processed, modified, last_id = state.get("processed", 0), state.get("modified", 0), state.get("last_id")
+        remaining = await self.db[migration.collection].count_documents(
+            {**migration.query, "_id": {"$gt": last_id}} if last_id is not None else migration.query
+        )
+        total = processed + remaining
+        try:
+            async for docs, updates in self.batches(migration, last_id):
+                if updates:
+                    result = await self.db[migration.collection].bulk_write(
+                        [UpdateOne({"_id": _id}, update) for _id, update in updates], ordered=False
+                    )
+                    modified += result.modified_count
+                processed += len(docs)
+                await self.db.schema_migrations.update_one({"_id": migration.version}, {"$set": {
+                    "last_id": docs[-1]["_id"],
+                    "processed": processed,
+                    "modified": modified,
+                    "total": total,
+                    "locked_until": datetime.utcnow() + timedelta(seconds=self.lease_timeout)
+                }})
+                if progress:
+                    progress(migration, processed, total)
+                await asyncio.sleep(self.pause)
+        except Exception as e:
+            await self.db.schema_migrations.update_one(
+                {"_id": migration.version},
+                {"$set": {"status": "failed", "error": repr(e)}, "$unset": {"locked_until": ""}}
+            )
+            raise
+        state = await self.db.schema_migrations.find_one_and_update(
+            {"_id": migration.version},
+            {"$set": {"status": "applied", "finished_at": datetime.utcnow(), "total": processed}, "$unset": {"locked_until": "", "error": ""}},
+            return_document=ReturnDocument.AFTER
+        )
+        logger.info(f"Migration {migration.version} applied: {modified} of {processed} documents changed")
+        return state
+
+    async def dry_run(self, migration: Migration, progress: Optional[Callable] = None) -> dict:
+        """Scan like run() without writing; returns counts and sample updates"""
+        total = await self.db[migration.collection].count_documents(migration.query)
+        processed, would_modify, samples = 0, 0, []
+        async for docs, updates in self.batches(migration):
+            processed += len(docs)
+            would_modify += len(updates)
+            for _id, update in updates[:DRY_RUN_SAMPLES - len(samples)]:
+                samples.append({"_id": str(_id), "update": update})
+            if progress:
+                progress(migration, processed, total)
+            await asyncio.sleep(self.pause)
+        result = {"scanned": processed, "would_modify": would_modify, "samples": samples, "at": datetime.utcnow()}
+        await self.db.schema_migrations.update_one(
+            {"_id": migration.version},
+            {"$set": {"last_dry_run": result}, "$setOnInsert": {"status": "pending"}},
+            upsert=True
+        )
+        return result
+
+    async def run_pending(self, progress: Optional[Callable] = None) -> List[int]:
+        """Apply pending migrations in version order.
+
+        Stops at the first migration that fails or is leased by another
+        process, so later versions never run before earlier ones.
+        """
+        applied = []
+        for migration in await self.pending():
+            if not await self.run(migration, progress):
+                break
+            applied.append(migration.version)
+        return applied
+
+
+def log_progress(migration: Migration, processed: int, total: int):
+    percent = processed * 100 // total if total else 100
+    logger.info(f"Migration {migration.version} ({migration.collection}): {processed}/{total} ({percent}%)")
+
+
+async def main(argv: List[str]):
+    from server import migration_runner, client
+
+    def print_progress(migration, processed, total):
+        print(f"\r{migration.version} {migration.collection}: {processed}/{total}", end="", flush=True)
+
+    try:
+        command = argv[0] if argv else "status"
+        if command == "status":
+            for state in await migration_runner.status():
+                print(f"{state['version']:>4}  {state['status']:<8} {state['collection']:<14} {state['description']}")
+        elif command == "run":
+            migrations = [migration_runner.migrations[int(argv[1])]] if len(argv) > 1 else await migration_runner.pending()
+            for migration in migrations:
+                await migration_runner.run(migration, print_progress)
+                print()
+        elif command == "dry-run":
+            result = await migration_runner.dry_run(migration_runner.migrations[int(argv[1])], print_progress)
+            print(f"\nscanned {result['scanned']}, would modify {result['would_modify']}")
+            for sample in result["samples"]:
+                print(f"  {sample['_id']}: {sample['update']}")
+        else:
+            print(__doc__)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(sys.argv[1:]))
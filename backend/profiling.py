@@ -0,0 +1,179 @@
+"""
+On-demand sampling profiler for single requests.
+
+An admin adds "X-Profile: 1" (or the query flag _profile=1) to any request,
+with an admin token in X-Profile-Token or the usual Authorization header.
+ProfilingMiddleware then runs that request while a sampler thread reads the
+event loop thread's stack every interval; the response gets an
+X-Profile-Id header and the finished profile is handed to a store callback.
+Other requests only pay for the flag check, and one profile runs at a time.
+
+Each sample is weighted by the time since the previous one and filed under
+one of four roots:
+    request;...          the request's own code running on the loop: handler
+                         logic, serialization, bcrypt (CPU)
+    [mongodb wait];...   the loop is idle while the request has MongoDB
+                         commands in flight, named collection.command
+    [waiting]            the loop is idle and the request waits on anything else
+    [other tasks];...    the loop runs other code: other requests, jobs, and
+                         tasks the request gathered
+Stacks are in folded format, one "root;frame;frame weight" line per stack
+with weights in microseconds, as read by flamegraph.pl and speedscope.
+"""
+
+import logging
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Awaitable, Callable, List, Optional
+
+from metrics import current_request
+from timestamps import utc_now
+
+logger = logging.getLogger(__name__)
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+class Sampler(threading.Thread):
+    """Samples one thread's stack, classifying it against a root frame"""
+
+    def __init__(self, thread_id: int, root, pending: Callable[[], List[str]], interval: float):
+        super().__init__(name="request-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.root = root
+        self.pending = pending
+        self.interval = interval
+        self.stacks = Counter()
+        self.totals = Counter()
+        self.samples = 0
+        self.done = threading.Event()
+
+    def run(self):
+        last = time.perf_counter()
+        while not self.done.wait(self.interval):
+            now = time.perf_counter()
+            weight = int((now - last) * 1e6)
+            last = now
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None or self.done.is_set():
+                continue
+            kind, stack = self.classify(frame)
+            self.samples += 1
+            self.totals[kind] += weight
+            self.stacks[stack] += weight
+
+    def classify(self, frame):
+        names = []
+        while frame is not None:
+            if frame is self.root:
+                return "cpu", ";".join(["request", *reversed(names)])
+            names.append(frame_name(frame))
+            frame = frame.f_back
+        # An idle loop sits in the selector's select()
+        if names and names[0].startswith("selectors.py:") and names[0].endswith(".select"):
+            pending = self.pending()
+            if pending:
+                return "mongodb_wait", "[mongodb wait];" + "+".join(pending)
+            return "waiting", "[waiting]"
+        return "other", ";".join(["[other tasks]", *reversed(names)])
+
+    def stop(self):
+        self.done.set()
+        self.join()
+
+
+class ProfilingMiddleware:
+    """Profile requests flagged by an admin; see the module docstring.
+
+    authorize gets the presented token and says whether it is an admin's,
+    pending gets the request's RequestContext and lists its in-flight MongoDB
+    commands, and store receives the finished profile document. Must run
+    inside MetricsMiddleware, which publishes the RequestContext.
+    """
+
+    def __init__(
+        self,
+        app,
+        authorize: Callable[[str], bool],
+        store: Callable[[dict], Awaitable],
+        pending: Callable[[object], List[str]],
+        interval: float = 0.001
+    ):
+        self.app = app
+        self.authorize = authorize
+        self.store = store
+        self.pending = pending
+        self.interval = interval
+        self.active = False
+
+    def requested(self, scope) -> Optional[str]:
+        """The token of a profiling request, or None"""
+        flagged = b"_profile=1" in scope.get("query_string", b"")
+        token = None
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                flagged = flagged or value == b"1"
+            elif name == b"x-profile-token" or (name == b"authorization" and token is None):
+                token = value.decode("latin-1").removeprefix("Bearer ").strip()
+        return token if flagged and token else None
+
+    async def __call__(self, scope, receive, send):
+        token = self.requested(scope) if scope["type"] == "http" and not self.active else None
+        if not token or not self.authorize(token):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = secrets.token_hex(12)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", ()), (b"x-profile-id", profile_id.encode())]}
+            await send(message)
+
+        context = current_request.get()
+        sampler = Sampler(
+            threading.get_ident(), sys._getframe(),
+            lambda: self.pending(context) if context else [], self.interval
+        )
+        self.active = True
+        started_at = utc_now()
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            wall = time.perf_counter() - start
+            sampler.stop()
+            self.active = False
+            await self.save(profile_id, scope, status, started_at, wall, sampler, context)
+
+    async def save(self, profile_id, scope, status, started_at, wall, sampler, context):
+        profile = {
+            "_id": profile_id,
+            "method": scope["method"],
+            "path": scope["path"],
+            "route": context.route if context else getattr(scope.get("route"), "path", "unmatched"),
+            "status": status,
+            "started_at": started_at,
+            "wall_ms": round(wall * 1000, 1),
+            "interval_ms": self.interval * 1000,
+            "samples": sampler.samples,
+            **{f"{kind}_ms": round(sampler.totals[kind] / 1000, 1) for kind in ("cpu", "mongodb_wait", "waiting", "other")},
+            "db_calls": context.db_calls if context else None,
+            "db_time_ms": round(context.db_time * 1000, 1) if context else None,
+            "folded": "\n".join(f"{stack} {weight}" for stack, weight in sampler.stacks.most_common())
+        }
+        try:
+            await self.store(profile)
+        except Exception:
+            logger.exception(f"Could not store profile {profile_id}")
@@ -0,0 +1,255 @@
+"""
+Batched push-notification delivery.
+
+Targeted notifications are inserted with push_status "pending". The
+PushDeliveryWorker claims due notifications in batches, resolves their
+targets' device tokens with one query, and sends the messages through a
+pluggable transport in chunks of at most MAX_MESSAGES_PER_CALL. Failed
+deliveries are retried with exponential backoff, to the failed device tokens
+only (push_retry_tokens), so devices that already got the message are not
+sent it again; after max_attempts the notification is marked "dead" and
+copied to push_dead_letters.
+
+Transports:
+    ExpoPushTransport    - Expo push API, or any compatible gateway such as
+                           benchmarks/fake_push_server.py via PUSH_GATEWAY_URL
+    LoggingPushTransport - local stand-in that only logs, for development
+"""
+
+import asyncio
+import logging
+import random
+import secrets
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+import httpx
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+EXPO_PUSH_URL = "https://exp.host/--/api/v2/push/send"
+MAX_MESSAGES_PER_CALL = 100
+
+
+class PushResult:
+    """Outcome of one message: ok, retryable failure, or dead device token"""
+    __slots__ = ("ok", "retryable", "token_invalid", "error")
+
+    def __init__(self, ok: bool, retryable: bool = False, token_invalid: bool = False, error: Optional[str] = None):
+        self.ok = ok
+        self.retryable = retryable
+        self.token_invalid = token_invalid
+        self.error = error
+
+
+class ExpoPushTransport:
+    """Send messages to an Expo-compatible push gateway over HTTP"""
+
+    def __init__(self, url: str = EXPO_PUSH_URL, timeout: float = 10.0):
+        self.url = url
+        self.client = httpx.AsyncClient(timeout=timeout)
+
+    async def send(self, messages: List[dict]) -> List[PushResult]:
+        try:
+            response = await self.client.post(self.url, json=messages)
+        except httpx.HTTPError as e:
+            return [PushResult(False, retryable=True, error=str(e))] * len(messages)
+        if response.status_code == 429 or response.status_code >= 500:
+            return [PushResult(False, retryable=True, error=f"HTTP {response.status_code}")] * len(messages)
+        if response.status_code != 200:
+            return [PushResult(False, error=f"HTTP {response.status_code}")] * len(messages)
+
+        tickets = response.json().get("data", [])
+        results = []
+        for ticket in tickets:
+            if ticket.get("status") == "ok":
+                results.append(PushResult(True))
+                continue
+            error = (ticket.get("details") or {}).get("error") or ticket.get("message")
+            results.append(PushResult(
+                False,
+                retryable=error in ("MessageRateExceeded", "InternalError"),
+                token_invalid=error == "DeviceNotRegistered",
+                error=error
+            ))
+        # A short ticket list means the gateway dropped the tail of the batch
+        results += [PushResult(False, retryable=True, error="missing ticket")] * (len(messages) - len(results))
+        return results
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class LoggingPushTransport:
+    """Local stand-in gateway: accepts every message and logs it"""
+
+    async def send(self, messages: List[dict]) -> List[PushResult]:
+        for message in messages:
+            logger.info(f"Push to {message['to']}: {message['title']} - {message['body']}")
+        return [PushResult(True)] * len(messages)
+
+    async def close(self):
+        pass
+
+
+def create_transport(name: str, gateway_url: Optional[str] = None):
+    if name == "expo":
+        return ExpoPushTransport(gateway_url or EXPO_PUSH_URL)
+    return LoggingPushTransport()
+
+
+class PushDeliveryWorker:
+    """Drain pending notifications to the push transport in batches"""
+
+    def __init__(
+        self,
+        db,
+        transport,
+        batch_size: int = MAX_MESSAGES_PER_CALL,
+        max_attempts: int = 5,
+        base_backoff: float = 30.0,
+        poll_interval: float = 2.0,
+        claim_timeout: float = 300.0
+    ):
+        self.db = db
+        self.transport = transport
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.stats = {"delivered": 0, "retried": 0, "dead": 0, "no_token": 0, "messages": 0, "gateway_calls": 0, "busy_seconds": 0.0}
+
+    def deliveries_per_second(self) -> float:
+        busy = self.stats["busy_seconds"]
+        return self.stats["messages"] / busy if busy else 0.0
+
+    async def claim_batch(self) -> List[dict]:
+        """Atomically take up to batch_size due notifications for this worker"""
+        now = datetime.utcnow()
+        due = await self.db.notifications.find({"$or": [
+            {"push_status": "pending", "push_next_attempt_at": {"$lte": now}},
+            # Claims left behind by a crashed worker
+            {"push_status": "sending", "push_claimed_at": {"$lte": now - timedelta(seconds=self.claim_timeout)}}
+        ]}, {"_id": 1}).sort("push_next_attempt_at", 1).limit(self.batch_size).to_list(self.batch_size)
+        if not due:
+            return []
+        claim = secrets.token_hex(8)
+        # Re-check the claimable condition so a concurrent worker's fresh claim is never taken over
+        await self.db.notifications.update_many(
+            {"_id": {"$in": [d["_id"] for d in due]}, "$or": [
+                {"push_status": "pending"},
+                {"push_status": "sending", "push_claimed_at": {"$lte": now - timedelta(seconds=self.claim_timeout)}}
+            ]},
+            {"$set": {"push_status": "sending", "push_claim": claim, "push_claimed_at": now}}
+        )
+        return await self.db.notifications.find({"push_claim": claim}).to_list(self.batch_size)
+
+    async def deliver_batch(self, notifications: List[dict]):
+        keys = {n["_id"]: ("admin" if n.get("type") == "admin" else n.get("target_id")) for n in notifications}
+        tokens = await self.db.push_tokens.find(
+            {"target_key": {"$in": list(set(keys.values()))}}, {"token": 1, "target_key": 1}
+        ).to_list(None)
+        tokens_by_key = {}
+        for t in tokens:
+            tokens_by_key.setdefault(t["target_key"], []).append(t["token"])
+
+        messages = []
+        owners = []
+        for n in notifications:
+            targets = tokens_by_key.get(keys[n["_id"]], [])
+            # A retry goes only to the devices that failed last time
+            if n.get("push_retry_tokens") is not None:
+                retry_tokens = set(n["push_retry_tokens"])
+                targets = [token for token in targets if token in retry_tokens]
+            for token in targets:
+                messages.append({
+                    "to": token,
+                    "title": n.get("title"),
+                    "body": n.get("message"),
+                    "sound": "default",
+                    "data": {"notification_id": str(n["_id"]), "booking_id": n.get("booking_id")}
+                })
+                owners.append(n["_id"])
+
+        results = []
+        for start in range(0, len(messages), MAX_MESSAGES_PER_CALL):
+            results += await self.transport.send(messages[start:start + MAX_MESSAGES_PER_CALL])
+            self.stats["gateway_calls"] += 1
+        self.stats["messages"] += len(messages)
+
+        # Outcomes are per device token: notification id -> tokens
+        delivered, retryable, errors, invalid_tokens = {}, {}, {}, []
+        for message, owner, result in zip(messages, owners, results):
+            if result.ok:
+                delivered.setdefault(owner, []).append(message["to"])
+            elif result.token_invalid:
+                invalid_tokens.append(message["to"])
+            else:
+                errors[owner] = result.error
+                if result.retryable:
+                    retryable.setdefault(owner, []).append(message["to"])
+
+        now = datetime.utcnow()
+        operations = []
+        dead = []
+        for n in notifications:
+            nid = n["_id"]
+            # Devices reached on an earlier attempt count towards "sent"
+            reached = n.get("push_delivered", 0) + len(delivered.get(nid, ()))
+            if nid in retryable:
+                attempts = n.get("push_attempts", 0) + 1
+                retry = {"push_attempts": attempts, "push_error": errors.get(nid), "push_retry_tokens": retryable[nid], "push_delivered": reached}
+                if attempts >= self.max_attempts:
+                    dead.append({**n, **retry, "dead_at": now})
+                    operations.append(UpdateOne({"_id": nid}, {"$set": {"push_status": "dead", **retry}}))
+                else:
+                    backoff = self.base_backoff * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+                    operations.append(UpdateOne({"_id": nid}, {"$set": {
+                        "push_status": "pending",
+                        "push_next_attempt_at": now + timedelta(seconds=backoff),
+                        **retry
+                    }}))
+                    self.stats["retried"] += 1
+            elif reached or nid in errors:
+                # Delivered to at least one device, or failed permanently on all
+                status = "sent" if reached else "failed"
+                operations.append(UpdateOne({"_id": nid}, {
+                    "$set": {"push_status": status, "push_sent_at": now, "push_error": errors.get(nid), "push_delivered": reached},
+                    "$unset": {"push_retry_tokens": ""}
+                }))
+                if status == "sent":
+                    self.stats["delivered"] += 1
+            else:
+                operations.append(UpdateOne({"_id": nid}, {"$set": {"push_status": "no_token"}}))
+                self.stats["no_token"] += 1
+        if operations:
+            await self.db.notifications.bulk_write(operations, ordered=False)
+        if dead:
+            await self.db.push_dead_letters.insert_many(dead)
+            self.stats["dead"] += len(dead)
+        if invalid_tokens:
+            await self.db.push_tokens.delete_many({"token": {"$in": invalid_tokens}})
+
+    async def run_once(self) -> int:
+        """Deliver one batch; returns the number of notifications processed"""
+        notifications = await self.claim_batch()
+        if notifications:
+            start = time.perf_counter()
+            await self.deliver_batch(notifications)
+            self.stats["busy_seconds"] += time.perf_counter() - start
+        return len(notifications)
+
+    async def run(self):
+        while True:
+            try:
+                processed = await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Push delivery batch failed")
+                processed = 0
+            if processed < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
@@ -0,0 +1,246 @@
+"""
+Automatic scheduling of package subscription sessions.
+
+A scheduling run takes any number of subscriptions, loads the availability
+slots and active bookings of the whole date range they span with one query
+each, and places every remaining session in a single in-memory pass: session
+k of a subscription targets start + k * interval and takes the first day in
+[target, target + interval) with a free slot, preferring the customer's
+preferred time. Sessions that find no slot stay in sessions_remaining so the
+customer can still book them by hand.
+
+Slot places come from the availability documents' reserved counters and
+capacities. The result is committed in bulk: conditional counter updates
+for the slots used, one bulk_write that takes the sessions from the
+subscriptions (conditional on sessions_remaining, like single redemption)
+and one insert_many for the bookings.
+"""
+
+import asyncio
+import secrets
+from collections import Counter
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from timestamps import booking_starts_at, utc_now
+
+# Days between sessions; monthly is four weeks so sessions keep their weekday
+FREQUENCY_DAYS = {"weekly": 7, "biweekly": 14, "monthly": 28}
+ACTIVE_BOOKING_STATUSES = ["pending", "confirmed"]
+WRITE_BATCH_SIZE = 1000
+RESERVE_CONCURRENCY = 50
+
+
+def allocate_sessions(
+    requests: List[dict],
+    open_slots: Dict[int, List[str]],
+    reserved: Counter,
+    capacity: Optional[Dict[Tuple[int, str], int]] = None
+) -> List[Tuple[int, int, str]]:
+    """Place sessions into free slots; returns (request index, day ordinal, time).
+
+    requests are dicts with start (day ordinal), interval, sessions and an
+    optional preferred_time, served in list order. open_slots maps a day
+    ordinal to its sorted time slots, reserved counts bookings per (day, time)
+    and is updated in place as slots are taken, and capacity gives places per
+    (day, time), 1 when missing.
+    """
+    capacity = capacity or {}
+    # Free places left per day, so full days are skipped without a slot scan
+    free = {
+        day: sum(max(capacity.get((day, t), 1) - reserved[(day, t)], 0) for t in times)
+        for day, times in open_slots.items()
+    }
+    allocations = []
+    for index, request in enumerate(requests):
+        interval = request["interval"]
+        preferred = request.get("preferred_time")
+        previous = None
+        for k in range(request["sessions"]):
+            first = request["start"] + k * interval
+            if previous is not None:
+                first = max(first, previous + 1)
+            for day in range(first, request["start"] + (k + 1) * interval):
+                if not free.get(day):
+                    continue
+                times = open_slots[day]
+                if preferred in times and reserved[(day, preferred)] < capacity.get((day, preferred), 1):
+                    slot = preferred
+                else:
+                    slot = next(t for t in times if reserved[(day, t)] < capacity.get((day, t), 1))
+                reserved[(day, slot)] += 1
+                free[day] -= 1
+                allocations.append((index, day, slot))
+                previous = day
+                break
+    return allocations
+
+
+async def load_range(db, first_day: int, end_day: int):
+    """Open slots, reserved counts and capacities for days in [first_day, end_day)"""
+    date_range = {"$gte": date.fromordinal(first_day).isoformat(), "$lt": date.fromordinal(end_day).isoformat()}
+    open_slots, reserved, capacity = {}, Counter(), {}
+    cursor = db.availability.find(
+        {"date": date_range, "available": True},
+        {"date": 1, "time_slots": 1, "capacity": 1, "slot_capacity": 1, "reserved": 1}
+    )
+    async for doc in cursor:
+        day = date.fromisoformat(doc["date"]).toordinal()
+        open_slots[day] = sorted(doc.get("time_slots") or [])
+        for t in open_slots[day]:
+            capacity[(day, t)] = doc.get("slot_capacity", {}).get(t, doc.get("capacity", 1))
+            reserved[(day, t)] = doc.get("reserved", {}).get(t, 0)
+    return open_slots, reserved, capacity
+
+
+async def reserve_slots(db, slots: Counter) -> set:
+    """Take counted places per (day, time); returns the slots that were full.
+
+    Each slot is one conditional update, so a booking made since the range
+    was loaded can make a slot fail but never push it over capacity. The
+    updates are sent concurrently, RESERVE_CONCURRENCY at a time.
+    """
+    items = list(slots.items())
+    full = set()
+    for start in range(0, len(items), RESERVE_CONCURRENCY):
+        chunk = items[start:start + RESERVE_CONCURRENCY]
+        results = await asyncio.gather(*[db.availability.update_one(
+            {
+                "date": date.fromordinal(day).isoformat(),
+                "available": True,
+                "time_slots": t,
+                "$expr": {"$lte": [
+                    {"$add": [{"$ifNull": [f"$reserved.{t}", 0]}, count]},
+                    {"$ifNull": [f"$slot_capacity.{t}", {"$ifNull": ["$capacity", 1]}]}
+                ]}
+            },
+            {"$inc": {f"reserved.{t}": count}}
+        ) for (day, t), count in chunk])
+        full.update(slot for (slot, _), result in zip(chunk, results) if not result.modified_count)
+    return full
+
+
+async def release_slots(db, slots: Counter):
+    operations = [UpdateOne(
+        {"date": date.fromordinal(day).isoformat()}, {"$inc": {f"reserved.{t}": -count}}
+    ) for (day, t), count in slots.items()]
+    for start in range(0, len(operations), WRITE_BATCH_SIZE):
+        await db.availability.bulk_write(operations[start:start + WRITE_BATCH_SIZE], ordered=False)
+
+
+async def schedule_subscriptions(db, subscriptions: List[dict], today: Optional[date] = None) -> List[dict]:
+    """Book the remaining sessions of subscriptions; returns the inserted bookings"""
+    tomorrow = (today or date.today()).toordinal() + 1
+    subscriptions = [s for s in subscriptions if s.get("sessions_remaining", 0) > 0]
+    if not subscriptions:
+        return []
+
+    package_ids = list({ObjectId(s["package_id"]) for s in subscriptions})
+    packages = {str(p["_id"]): p for p in await db.packages.find(
+        {"_id": {"$in": package_ids}}, {"service_id": 1, "frequency": 1}
+    ).to_list(None)}
+    service_ids = list({ObjectId(p["service_id"]) for p in packages.values()})
+    services = {str(s["_id"]): s for s in await db.services.find(
+        {"_id": {"$in": service_ids}}, {"name": 1, "price": 1}
+    ).to_list(None)}
+    phones = list({s["customer_phone"] for s in subscriptions})
+    customers = {c["phone"]: c for c in await db.customers.find(
+        {"phone": {"$in": phones}}, {"phone": 1, "name": 1, "address": 1}
+    ).to_list(None)}
+
+    schedulable, requests = [], []
+    for sub in subscriptions:
+        package = packages.get(sub["package_id"])
+        if not package or package.get("service_id") not in services or sub["customer_phone"] not in customers:
+            continue
+        interval = FREQUENCY_DAYS.get(package.get("frequency"), 7)
+        start = tomorrow
+        if sub.get("start_date"):
+            start = max(start, date.fromisoformat(sub["start_date"]).toordinal())
+        if sub.get("scheduled_until"):
+            start = max(start, date.fromisoformat(sub["scheduled_until"]).toordinal() + interval)
+        schedulable.append((sub, package))
+        requests.append({
+            "start": start,
+            "interval": interval,
+            "sessions": sub["sessions_remaining"],
+            "preferred_time": sub.get("preferred_time")
+        })
+    if not requests:
+        return []
+
+    first_day = min(r["start"] for r in requests)
+    end_day = max(r["start"] + r["sessions"] * r["interval"] for r in requests)
+    open_slots, reserved, capacity = await load_range(db, first_day, end_day)
+    allocations = allocate_sessions(requests, open_slots, reserved, capacity)
+
+    full = await reserve_slots(db, Counter((day, slot) for _, day, slot in allocations))
+    slots_by_sub: Dict[int, List[Tuple[int, str]]] = {}
+    for index, day, slot in allocations:
+        if (day, slot) not in full:
+            slots_by_sub.setdefault(index, []).append((day, slot))
+    if not slots_by_sub:
+        return []
+
+    # Take the sessions; the run tag tells which subscriptions still had them
+    run = secrets.token_hex(8)
+    operations = []
+    for index, slots in slots_by_sub.items():
+        sub = schedulable[index][0]
+        operations.append(UpdateOne(
+            {"_id": sub["_id"], "status": "active", "sessions_remaining": {"$gte": len(slots)}},
+            {
+                "$inc": {"sessions_remaining": -len(slots)},
+                "$set": {"schedule_run": run},
+                "$max": {"scheduled_until": date.fromordinal(slots[-1][0]).isoformat()}
+            }
+        ))
+    for start in range(0, len(operations), WRITE_BATCH_SIZE):
+        await db.subscriptions.bulk_write(operations[start:start + WRITE_BATCH_SIZE], ordered=False)
+    taken = {s["_id"] for s in await db.subscriptions.find({"schedule_run": run}, {"_id": 1}).to_list(None)}
+    unused = Counter(
+        slot for index, slots in slots_by_sub.items()
+        if schedulable[index][0]["_id"] not in taken for slot in slots
+    )
+    if unused:
+        await release_slots(db, unused)
+
+    now = utc_now()
+    bookings = []
+    for index, slots in slots_by_sub.items():
+        sub, package = schedulable[index]
+        if sub["_id"] not in taken:
+            continue
+        service = services[package["service_id"]]
+        customer = customers[sub["customer_phone"]]
+        session_price = round(sub["price_paid"] / sub["total_sessions"], 2)
+        for day, slot in slots:
+            booking_date = date.fromordinal(day).isoformat()
+            bookings.append({
+                "service_id": package["service_id"],
+                "service_name": service["name"],
+                "customer_name": customer.get("name"),
+                "customer_phone": sub["customer_phone"],
+                "customer_address": customer.get("address") or "",
+                "booking_date": booking_date,
+                "booking_time": slot,
+                "base_price": service["price"],
+                "total_price": session_price,
+                "discount_applied": max(service["price"] - session_price, 0.0),
+                "discount_details": [f"Paket: {sub['package_name']}"],
+                "payment_method": "package",
+                "customer_photos": [],
+                "status": "pending",
+                "created_at": now,
+                "starts_at": booking_starts_at(booking_date, slot),
+                "package_id": sub["package_id"],
+                "subscription_id": sub["_id"],
+                "package_session": "redeemed",
+                "auto_scheduled": True
+            })
+    for start in range(0, len(bookings), WRITE_BATCH_SIZE):
+        await db.bookings.insert_many(bookings[start:start + WRITE_BATCH_SIZE], ordered=False)
+    return bookings
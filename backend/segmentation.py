@@ -0,0 +1,151 @@
+"""
+RFM (recency / frequency / monetary) segmentation of customers.
+
+Bookings (hot and archived) are read in one streaming pass into compact
+typed arrays (one int per customer code, one int per booking day, one float
+per price), so memory grows by roughly 16 bytes per booking plus one dict
+entry per customer. All
+scoring is done with vectorized NumPy operations and the labels are written
+back to the customers collection with batched bulk_write calls.
+"""
+
+import asyncio
+from array import array
+from datetime import datetime, date
+
+import numpy as np
+from pymongo import UpdateOne
+
+# Bookings that count as purchases, same as the admin revenue figure
+RFM_STATUSES = ["confirmed", "completed"]
+READ_BATCH_SIZE = 5000
+ARCHIVE_COLLECTION = "bookings_archive"
+WRITE_BATCH_SIZE = 1000
+
+SEGMENTS = ["champions", "loyal", "high_value_at_risk", "lapsed", "new", "potential"]
+
+
+async def load_booking_columns(db):
+    """Stream bookings into (phones, customer codes, day ordinals, prices)"""
+    codes_by_phone = {}
+    codes = array("i")
+    days = array("i")
+    prices = array("d")
+    # Archived bookings count too; both tiers are read in one pass
+    query = {"status": {"$in": RFM_STATUSES}}
+    cursor = db.bookings.aggregate([
+        {"$match": query},
+        {"$unionWith": {"coll": ARCHIVE_COLLECTION, "pipeline": [{"$match": query}]}},
+        {"$project": {"_id": 0, "customer_phone": 1, "booking_date": 1, "total_price": 1}}
+    ], batchSize=READ_BATCH_SIZE)
+    async for booking in cursor:
+        try:
+            day = date.fromisoformat(booking["booking_date"][:10]).toordinal()
+        except (KeyError, TypeError, ValueError):
+            continue
+        phone = booking.get("customer_phone")
+        code = codes_by_phone.setdefault(phone, len(codes_by_phone))
+        codes.append(code)
+        days.append(day)
+        prices.append(float(booking.get("total_price") or 0))
+    phones = list(codes_by_phone)
+    return (
+        phones,
+        np.frombuffer(codes, dtype=np.int32) if codes else np.empty(0, dtype=np.int32),
+        np.frombuffer(days, dtype=np.int32) if days else np.empty(0, dtype=np.int32),
+        np.frombuffer(prices, dtype=np.float64) if prices else np.empty(0, dtype=np.float64),
+    )
+
+
+def quintile_scores(values: np.ndarray) -> np.ndarray:
+    """Score each value 1-5 by its percentile rank (5 = highest)
+
+    Tied values share their average rank, so a value most customers have
+    (a single booking) lands in the middle instead of above every quantile
+    edge it equals.
+    """
+    if values.size == 0:
+        return np.empty(0, dtype=np.int8)
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    below = np.cumsum(counts) - counts
+    # Midpoint of the tied block, as a fraction in (0, 1)
+    rank = (below + counts / 2) / values.size
+    return np.clip(np.ceil(rank * 5), 1, 5).astype(np.int8)[inverse.ravel()]
+
+
+def score_customers(customer_count: int, codes: np.ndarray, days: np.ndarray, prices: np.ndarray, today: int) -> dict:
+    """Per-customer RFM values, 1-5 scores and segment labels"""
+    frequency = np.bincount(codes, minlength=customer_count)
+    monetary = np.bincount(codes, weights=prices, minlength=customer_count)
+    last_day = np.full(customer_count, np.iinfo(np.int32).min, dtype=np.int32)
+    np.maximum.at(last_day, codes, days)
+    recency = np.maximum(today - last_day, 0)
+
+    # Fewer days since the last booking is better, so recency is scored negated
+    r = quintile_scores(-recency)
+    f = quintile_scores(frequency)
+    m = quintile_scores(monetary)
+
+    segment_index = np.select(
+        [
+            (r >= 4) & (f >= 4) & (m >= 4),
+            (r >= 3) & (f >= 4),
+            (r <= 2) & (m >= 4),
+            r <= 2,
+            (r >= 4) & (frequency == 1),
+        ],
+        [0, 1, 2, 3, 4],
+        default=5
+    )
+    return {
+        "recency_days": recency,
+        "frequency": frequency,
+        "monetary": monetary,
+        "r": r,
+        "f": f,
+        "m": m,
+        "segment": np.asarray(SEGMENTS, dtype=object)[segment_index],
+    }
+
+
+async def run_rfm_segmentation(db) -> dict:
+    """Recompute rfm for all customers and return customer counts per segment"""
+    computed_at = datetime.utcnow().isoformat()
+    phones, codes, days, prices = await load_booking_columns(db)
+    scores = await asyncio.to_thread(
+        score_customers, len(phones), codes, days, prices, date.today().toordinal()
+    )
+
+    batch = []
+    for i, phone in enumerate(phones):
+        batch.append(UpdateOne({"phone": phone}, {"$set": {"rfm": {
+            "recency_days": int(scores["recency_days"][i]),
+            "frequency": int(scores["frequency"][i]),
+            "monetary": round(float(scores["monetary"][i]), 2),
+            "r": int(scores["r"][i]),
+            "f": int(scores["f"][i]),
+            "m": int(scores["m"][i]),
+            "segment": scores["segment"][i],
+            "computed_at": computed_at,
+        }}}))
+        if len(batch) >= WRITE_BATCH_SIZE:
+            await db.customers.bulk_write(batch, ordered=False)
+            batch = []
+    if batch:
+        await db.customers.bulk_write(batch, ordered=False)
+
+    # Customers without a counted booking in this run
+    await db.customers.update_many(
+        {"rfm.computed_at": {"$ne": computed_at}},
+        {"$set": {"rfm": {"segment": "no_bookings", "computed_at": computed_at}}}
+    )
+
+    # Counted from the customers collection: bookings whose phone has no
+    # customer document are scored but not part of any segment
+    summary = {}
+    async for row in db.customers.aggregate([
+        {"$match": {"rfm.computed_at": computed_at}},
+        {"$group": {"_id": "$rfm.segment", "count": {"$sum": 1}}}
+    ]):
+        summary[row["_id"]] = row["count"]
+    return summary
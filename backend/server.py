@@ -1,35 +1,56 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
+import csv
+import io
 import logging
+import asyncio
+import heapq
+import re
+import unicodedata
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Literal, Optional
+from collections import Counter
 from datetime import datetime, date, time, timedelta
 from bson import ObjectId
 import bcrypt
 import jwt
+from segmentation import run_rfm_segmentation
+from push import PushDeliveryWorker, create_transport
+from jobs import JobRunner
+from scheduling import ACTIVE_BOOKING_STATUSES, schedule_subscriptions
+from migrations import MigrationRunner, log_progress
+from metrics import REGISTRY, CONTENT_TYPE, CommandMetrics, HTTPMetrics, MetricsMiddleware, PoolMetrics
+from profiling import ProfilingMiddleware
+from loopmonitor import LoopMonitor
+from jsonlog import AccessLog, configure_logging, parse_rate_limits
+from timestamps import utc_now, booking_starts_at, parse_timestamp, local_day_start, month_range, day_range
+import orjson
 import secrets
 import string
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
+# MongoDB connection. Pool and command monitoring feed /metrics; commands
+# slower than SLOW_QUERY_MS are logged with the route that issued them.
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+pool_metrics = PoolMetrics(REGISTRY)
+command_metrics = CommandMetrics(REGISTRY, slow_ms=float(os.environ.get('SLOW_QUERY_MS', 100)))
+client = AsyncIOMotorClient(mongo_url, event_listeners=[pool_metrics, command_metrics])
 db = client[os.environ['DB_NAME']]
 
 # JWT Secret
 JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
 security = HTTPBearer()
-
-# Create the main app
-app = FastAPI()
-api_router = APIRouter(prefix="/api")
+optional_security = HTTPBearer(auto_error=False)
 
 # Helper function to convert ObjectId to string
 def serialize_doc(doc):
@@ -37,6 +58,147 @@ def serialize_doc(doc):
         doc['_id'] = str(doc['_id'])
     return doc
 
+# ============== FAST JSON SERIALIZATION ==============
+
+def _orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered by orjson, with native ObjectId/datetime support.
+
+    Returning an instance directly from a handler skips FastAPI's
+    jsonable_encoder pass, which dominates the cost of the large admin lists.
+    """
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+# Maps _id to string "_id"/"id" fields inside MongoDB, replacing the
+# per-document {**serialize_doc(doc), "id": ...} copies in Python
+ID_TO_STRING = {"$addFields": {"_id": {"$toString": "$_id"}, "id": {"$toString": "$_id"}}}
+
+def serialized_cursor(collection, query: Optional[dict] = None, sort: Optional[list] = None, limit: Optional[int] = None, exclude: Optional[List[str]] = None, union_with: Optional[str] = None, **kwargs):
+    """Cursor over documents already shaped for a JSON response"""
+    pipeline = [{"$match": query or {}}]
+    if union_with:
+        pipeline.append({"$unionWith": {"coll": union_with, "pipeline": [{"$match": query or {}}]}})
+    if sort:
+        pipeline.append({"$sort": dict(sort)})
+    if limit:
+        pipeline.append({"$limit": limit})
+    if exclude:
+        pipeline.append({"$project": {field: 0 for field in exclude}})
+    pipeline.append(ID_TO_STRING)
+    return collection.aggregate(pipeline, **kwargs)
+
+async def find_serialized(collection, query: Optional[dict] = None, sort: Optional[list] = None, limit: int = 100, exclude: Optional[List[str]] = None, union_with: Optional[str] = None) -> list:
+    """Find documents already shaped for a JSON response"""
+    return await serialized_cursor(collection, query, sort, limit, exclude, union_with).to_list(limit)
+
+# ============== STREAMING RESPONSES ==============
+
+STREAM_BATCH_SIZE = 200
+# Newest rows returned by the admin list endpoints; the exports return everything
+ADMIN_LIST_LIMIT = 1000
+
+class MergedCursor:
+    """Merge cursors that are each sorted ascending by key into one stream"""
+
+    def __init__(self, cursors: list, key: str):
+        self.cursors = cursors
+        self.key = key
+
+    async def __aiter__(self):
+        heads = []
+        for index, cursor in enumerate(self.cursors):
+            async for doc in cursor:
+                heads.append((doc.get(self.key) or "", index, doc))
+                break
+        heapq.heapify(heads)
+        while heads:
+            _, index, doc = heads[0]
+            yield doc
+            async for following in self.cursors[index]:
+                heapq.heapreplace(heads, (following.get(self.key) or "", index, following))
+                break
+            else:
+                heapq.heappop(heads)
+
+    async def close(self):
+        for cursor in self.cursors:
+            await cursor.close()
+
+async def stream_json_array(cursor, batch_size: int = STREAM_BATCH_SIZE):
+    """Encode a cursor as a JSON array, one chunk per batch of documents.
+
+    At most one batch is held in memory at a time, so memory use does not
+    depend on the size of the result.
+    """
+    separator = b""
+    batch = []
+    try:
+        yield b"["
+        async for doc in cursor:
+            batch.append(orjson.dumps(doc, default=_orjson_default))
+            if len(batch) >= batch_size:
+                yield separator + b",".join(batch)
+                separator = b","
+                batch = []
+        if batch:
+            yield separator + b",".join(batch)
+        yield b"]"
+    finally:
+        await cursor.close()
+
+def streaming_list(collection, query: Optional[dict] = None, sort: Optional[list] = None, limit: Optional[int] = ADMIN_LIST_LIMIT, exclude: Optional[List[str]] = None) -> StreamingResponse:
+    """Stream up to limit matching documents as a JSON array"""
+    cursor = serialized_cursor(collection, query, sort, limit, exclude, batchSize=STREAM_BATCH_SIZE, allowDiskUse=True)
+    return StreamingResponse(stream_json_array(cursor), media_type="application/json")
+
+# Create the main app
+app = FastAPI(default_response_class=FastJSONResponse)
+api_router = APIRouter(prefix="/api")
+
+# ============== CONDITIONAL GET (ETAG) ==============
+
+# Per-collection versions for the public catalog endpoints, kept in the
+# catalog_versions collection so every worker and replica sees the same
+# value. Every write to one of these collections sets a new version, so a
+# matching If-None-Match can be answered with 304 after a single _id lookup
+# instead of building the response. Versions are ObjectIds rather than
+# counters, so a dropped or restored catalog_versions never reissues an old
+# ETag for different data.
+async def bump_version(*collections: str):
+    """Invalidate cached responses built from the given collections"""
+    await db.catalog_versions.bulk_write([
+        UpdateOne({"_id": name}, {"$set": {"version": ObjectId()}}, upsert=True) for name in collections
+    ])
+
+async def collection_etag(*collections: str, key: str = "") -> str:
+    """Strong ETag derived from the current versions of the given collections"""
+    docs = await db.catalog_versions.find({"_id": {"$in": list(collections)}}).to_list(len(collections))
+    current = {doc["_id"]: str(doc["version"]) for doc in docs}
+    versions = "-".join(current.get(name, "0") for name in collections)
+    return f'"{versions}{"-" + key if key else ""}"'
+
+async def conditional_get(request: Request, response: Response, *collections: str, key: str = "") -> Optional[Response]:
+    """Return a 304 response if the client already has the current version.
+
+    Otherwise the ETag is attached to the outgoing response and None is
+    returned so the handler goes on to build the body.
+    """
+    etag = await collection_etag(*collections, key=key)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # If-None-Match uses weak comparison, so W/ prefixes are ignored
+        candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if etag in candidates or "*" in candidates:
+            return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
 # ============== MODELS ==============
 
 class Service(BaseModel):
@@ -95,7 +257,7 @@ class BookingResponse(BaseModel):
     discount_applied: float
     payment_method: str
     status: str
-    created_at: str
+    created_at: datetime
     customer_photos: Optional[List[str]] = []
 
 # Review Models
@@ -108,17 +270,24 @@ class ReviewCreate(BaseModel):
 class NotificationCreate(BaseModel):
     title: str
     message: str
-    type: str  # "admin", "customer"
+    type: Literal["admin", "customer"]  # broadcasts only go through /admin/notifications/broadcast
     target_id: Optional[str] = None  # customer_id or "admin"
     booking_id: Optional[str] = None
 
+class PushTokenRegister(BaseModel):
+    token: str  # Expo push token
+
+class BroadcastCreate(BaseModel):
+    title: str
+    message: str
+
 class ReviewResponse(BaseModel):
     id: str
     booking_id: str
     customer_name: str
     rating: int
     comment: Optional[str]
-    created_at: str
+    created_at: datetime
 
 # Package Models
 class PackageCreate(BaseModel):
@@ -160,6 +329,8 @@ class AvailabilityDate(BaseModel):
     date: str
     available: bool
     time_slots: List[str] = []
+    capacity: int = 1  # Crews available for each slot
+    slot_capacity: Dict[str, int] = {}  # Per-slot overrides, e.g. {"10:00": 3}
 
 class AvailabilityResponse(BaseModel):
     dates: List[dict]
@@ -171,6 +342,15 @@ class SettingUpdate(BaseModel):
 class BookingStatusUpdate(BaseModel):
     status: str
 
+class BulkBookingStatusUpdate(BaseModel):
+    booking_ids: List[str]
+    status: str
+
+class WaitlistJoin(BaseModel):
+    booking_date: str
+    booking_time: str
+    customer_phone: str
+
 # Work Photo Models
 class WorkPhotoUpload(BaseModel):
     booking_id: str
@@ -194,6 +374,12 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def verify_customer_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = verify_token(credentials)
+    if not payload.get("customer_id"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return payload
+
 def generate_referral_code():
     """Generate a unique referral code"""
     chars = string.ascii_uppercase + string.digits
@@ -230,6 +416,783 @@ async def add_loyalty_points(customer_phone: str, amount: float):
         {"$inc": {"loyalty_points": points, "total_bookings": 1}}
     )
 
+async def redeem_package_session(customer_phone: str, package_id: str, service_id: str) -> dict:
+    """Take one session from the customer's oldest usable subscription.
+
+    The sessions_remaining > 0 filter and the decrement are a single
+    find_one_and_update, so concurrent bookings can never overdraw a package.
+    """
+    if not ObjectId.is_valid(package_id):
+        raise HTTPException(status_code=400, detail="Geçersiz paket ID")
+    package = await db.packages.find_one({"_id": ObjectId(package_id)}, {"service_id": 1})
+    if not package:
+        raise HTTPException(status_code=404, detail="Paket bulunamadı")
+    if package.get("service_id") != service_id:
+        raise HTTPException(status_code=400, detail="Paket bu hizmet için geçerli değil")
+    
+    subscription = await db.subscriptions.find_one_and_update(
+        {
+            "customer_phone": customer_phone,
+            "package_id": package_id,
+            "status": "active",
+            "sessions_remaining": {"$gt": 0}
+        },
+        {"$inc": {"sessions_remaining": -1}},
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+    if not subscription:
+        raise HTTPException(status_code=400, detail="Bu pakette kullanılabilir seans kalmadı")
+    return subscription
+
+async def return_package_session(subscription_id: ObjectId):
+    await db.subscriptions.update_one({"_id": subscription_id}, {"$inc": {"sessions_remaining": 1}})
+
+async def release_package_session(booking_id: ObjectId):
+    """Give a cancelled booking's package session back, at most once"""
+    # Skipped if the booking was reactivated before this ran
+    booking = await db.bookings.find_one_and_update(
+        {"_id": booking_id, "package_session": "redeemed", "status": "cancelled"},
+        {"$set": {"package_session": "released"}},
+        projection={"subscription_id": 1}
+    )
+    if booking:
+        await return_package_session(booking["subscription_id"])
+
+async def reclaim_package_session(subscription_id: ObjectId) -> bool:
+    """Take a released session again for a reactivated booking, with the
+    same conditional decrement as redeem_package_session"""
+    result = await db.subscriptions.update_one(
+        {"_id": subscription_id, "status": "active", "sessions_remaining": {"$gt": 0}},
+        {"$inc": {"sessions_remaining": -1}}
+    )
+    return result.modified_count == 1
+
+# ============== CUSTOMER STATS ==============
+
+# Lifetime aggregates kept on each customer document:
+#   total_spent / completed_bookings - sum and count of completed bookings
+#   last_booking_date                - latest booking_date that is not cancelled
+#   rating_total / rating_count      - reviews given, average_rating derived
+# They are updated incrementally by booking events, and the nightly
+# reconciliation below repairs any drift.
+
+def completed_stats_delta(booking: dict, old_status: str, new_status: str) -> dict:
+    """$inc for total_spent/completed_bookings when a booking changes status"""
+    if old_status == new_status or "completed" not in (old_status, new_status):
+        return {}
+    sign = 1 if new_status == "completed" else -1
+    return {"total_spent": sign * booking.get("total_price", 0), "completed_bookings": sign}
+
+async def refresh_last_booking_date(customer_phone: str):
+    """Recompute last_booking_date after a booking stopped counting"""
+    query = {"customer_phone": customer_phone, "status": {"$ne": "cancelled"}}
+    # Archived bookings are older than any hot one, so the archive is only a fallback
+    latest = (
+        await db.bookings.find_one(query, {"booking_date": 1}, sort=[("booking_date", -1)])
+        or await db[BOOKING_ARCHIVE].find_one(query, {"booking_date": 1}, sort=[("booking_date", -1)])
+    )
+    await db.customers.update_one(
+        {"phone": customer_phone},
+        {"$set": {"last_booking_date": latest["booking_date"] if latest else None}}
+    )
+
+async def record_booking_created(booking: dict):
+    await db.customers.update_one(
+        {"phone": booking["customer_phone"]},
+        {"$max": {"last_booking_date": booking["booking_date"]}}
+    )
+
+async def record_scheduled_bookings(bookings: List[dict]):
+    """Loyalty points and stats for bulk-created bookings, one update per customer"""
+    updates = {}
+    for b in bookings:
+        update = updates.setdefault(b["customer_phone"], {"points": 0, "count": 0, "last": b["booking_date"]})
+        update["points"] += int(b["total_price"] / 10)
+        update["count"] += 1
+        update["last"] = max(update["last"], b["booking_date"])
+    if updates:
+        await db.customers.bulk_write([UpdateOne(
+            {"phone": phone},
+            {"$inc": {"loyalty_points": u["points"], "total_bookings": u["count"]}, "$max": {"last_booking_date": u["last"]}}
+        ) for phone, u in updates.items()], ordered=False)
+
+# Ids of the status changes already counted in a customer's totals, so a
+# retried job does not count one twice
+MAX_STATS_RECEIPTS = 50
+
+# Receipt lists kept on customer documents, left out of admin lists
+CUSTOMER_INTERNAL_FIELDS = ["stats_events", "read_broadcasts"]
+
+async def record_booking_status_change(booking: dict, new_status: str, event_id: str):
+    old_status = booking.get("status")
+    if "cancelled" in (old_status, new_status) and old_status != new_status:
+        await refresh_last_booking_date(booking["customer_phone"])
+    delta = completed_stats_delta(booking, old_status, new_status)
+    if delta:
+        await db.customers.update_one(
+            {"phone": booking["customer_phone"], "stats_events": {"$ne": event_id}},
+            {"$inc": delta, "$push": {"stats_events": {"$each": [event_id], "$slice": -MAX_STATS_RECEIPTS}}}
+        )
+
+def rating_stats_update(rating_delta: int, count_delta: int) -> list:
+    """Pipeline update adjusting rating totals and average_rating atomically"""
+    return [
+        {"$set": {
+            "rating_total": {"$add": [{"$ifNull": ["$rating_total", 0]}, rating_delta]},
+            "rating_count": {"$add": [{"$ifNull": ["$rating_count", 0]}, count_delta]}
+        }},
+        {"$set": {"average_rating": {"$cond": [
+            {"$gt": ["$rating_count", 0]},
+            {"$round": [{"$divide": ["$rating_total", "$rating_count"]}, 2]},
+            None
+        ]}}}
+    ]
+
+async def reconcile_customer_stats(batch_size: int = 500) -> int:
+    """Recompute every customer's aggregates from bookings and reviews.
+
+    Customers are processed in _id order, one batch at a time: one grouped
+    aggregation per collection for the batch's phones and one bulk_write.
+    """
+    updated = 0
+    last_id = None
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        customers = await db.customers.find(query, {"phone": 1}).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not customers:
+            return updated
+        last_id = customers[-1]["_id"]
+        phones = [c["phone"] for c in customers]
+        
+        booking_query = {"customer_phone": {"$in": phones}, "status": {"$ne": "cancelled"}}
+        booking_stats = await db.bookings.aggregate([
+            {"$match": booking_query},
+            {"$unionWith": {"coll": BOOKING_ARCHIVE, "pipeline": [{"$match": booking_query}]}},
+            {"$group": {
+                "_id": "$customer_phone",
+                "total_spent": {"$sum": {"$cond": [{"$eq": ["$status", "completed"]}, "$total_price", 0]}},
+                "completed_bookings": {"$sum": {"$cond": [{"$eq": ["$status", "completed"]}, 1, 0]}},
+                "last_booking_date": {"$max": "$booking_date"}
+            }}
+        ]).to_list(len(phones))
+        review_stats = await db.reviews.aggregate([
+            {"$match": {"customer_phone": {"$in": phones}}},
+            {"$group": {"_id": "$customer_phone", "rating_total": {"$sum": "$rating"}, "rating_count": {"$sum": 1}}}
+        ]).to_list(len(phones))
+        bookings_by_phone = {b["_id"]: b for b in booking_stats}
+        reviews_by_phone = {r["_id"]: r for r in review_stats}
+        
+        operations = []
+        for phone in phones:
+            b = bookings_by_phone.get(phone, {})
+            r = reviews_by_phone.get(phone, {})
+            rating_count = r.get("rating_count", 0)
+            operations.append(UpdateOne({"phone": phone}, {"$set": {
+                "total_spent": b.get("total_spent", 0),
+                "completed_bookings": b.get("completed_bookings", 0),
+                "last_booking_date": b.get("last_booking_date"),
+                "rating_total": r.get("rating_total", 0),
+                "rating_count": rating_count,
+                "average_rating": round(r["rating_total"] / rating_count, 2) if rating_count else None
+            }}))
+        await db.customers.bulk_write(operations, ordered=False)
+        updated += len(operations)
+
+CUSTOMER_STATS_RECONCILE_HOUR = int(os.environ.get('CUSTOMER_STATS_RECONCILE_HOUR', 3))  # UTC
+
+# ============== NOTIFICATION HELPERS ==============
+
+# Targeted notifications expire through a TTL index on expire_at, and each
+# target keeps at most NOTIFICATION_MAX_PER_TARGET of them. Unread and total
+# counts per target ("admin" or a customer id) live in notification_counters
+# so badges are a single point read. The "broadcast" counter document holds
+# the broadcast sequence; customers count read broadcasts in broadcasts_read.
+# TTL deletions are not counted as they happen; a nightly reconciliation
+# (or an admin-triggered one) recounts every target.
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', 90))
+NOTIFICATION_MAX_PER_TARGET = int(os.environ.get('NOTIFICATION_MAX_PER_TARGET', 200))
+NOTIFICATION_SWEEP_INTERVAL = 3600  # seconds
+NOTIFICATION_RECONCILE_HOUR = int(os.environ.get('NOTIFICATION_RECONCILE_HOUR', 2))  # UTC
+
+# Push delivery bookkeeping, kept out of API responses
+NOTIFICATION_INTERNAL_FIELDS = [
+    "push_status", "push_attempts", "push_next_attempt_at", "push_claim",
+    "push_claimed_at", "push_sent_at", "push_error", "push_retry_tokens",
+    "push_delivered", "dedup_key"
+]
+
+def notification_doc(title: str, message: str, type: str, target_id: Optional[str] = None, booking_id: Optional[str] = None) -> dict:
+    now = utc_now()
+    return {
+        "title": title,
+        "message": message,
+        "type": type,
+        "target_id": target_id,
+        "booking_id": booking_id,
+        "read": False,
+        "created_at": now,
+        "expire_at": now + timedelta(days=NOTIFICATION_RETENTION_DAYS),
+        # Picked up by the push delivery worker
+        "push_status": "pending",
+        "push_attempts": 0,
+        "push_next_attempt_at": now
+    }
+
+def notification_target_key(notification: dict) -> Optional[str]:
+    if notification.get("type") == "admin":
+        return "admin"
+    if notification.get("type") == "customer":
+        return notification.get("target_id")
+    return None
+
+def notification_target_query(key: str) -> dict:
+    if key == "admin":
+        return {"type": "admin"}
+    return {"type": "customer", "target_id": key}
+
+async def insert_notifications(notifications: List[dict]) -> list:
+    """Insert targeted notifications and bump their targets' counters.
+
+    Notifications carrying a dedup_key that already exists are skipped.
+    """
+    try:
+        await db.notifications.insert_many(notifications, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(err.get("code") != 11000 for err in errors):
+            raise
+        duplicates = {err["index"] for err in errors}
+        notifications = [n for i, n in enumerate(notifications) if i not in duplicates]
+    counts = Counter(k for k in map(notification_target_key, notifications) if k)
+    if counts:
+        await db.notification_counters.bulk_write([
+            UpdateOne({"_id": key}, {"$inc": {"unread": n, "total": n}}, upsert=True)
+            for key, n in counts.items()
+        ], ordered=False)
+    return [n["_id"] for n in notifications]
+
+async def adjust_unread(key: Optional[str], delta: int):
+    if key and delta:
+        await db.notification_counters.update_one({"_id": key}, {"$inc": {"unread": delta}})
+
+async def mark_target_read(key: str, before: Optional[str] = None) -> int:
+    """Mark a target's notifications read up to and including the cursor id"""
+    query = {**notification_target_query(key), "read": False}
+    if before:
+        if not ObjectId.is_valid(before):
+            raise HTTPException(status_code=400, detail="Geçersiz bildirim imleci")
+        query["_id"] = {"$lte": ObjectId(before)}
+    result = await db.notifications.update_many(query, {"$set": {"read": True}})
+    await adjust_unread(key, -result.modified_count)
+    return result.modified_count
+
+async def enforce_notification_retention():
+    """Trim targets over the cap, recounting only the targets trimmed"""
+    over_cap = await db.notification_counters.find(
+        {"_id": {"$ne": "broadcast"}, "total": {"$gt": NOTIFICATION_MAX_PER_TARGET}}, {"_id": 1}
+    ).to_list(None)
+    for counter in over_cap:
+        query = notification_target_query(counter["_id"])
+        oldest_kept = await db.notifications.find(query, {"created_at": 1}).sort("created_at", -1).skip(NOTIFICATION_MAX_PER_TARGET - 1).limit(1).to_list(1)
+        if oldest_kept:
+            await db.notifications.delete_many({**query, "created_at": {"$lt": oldest_kept[0]["created_at"]}})
+        total, unread = await asyncio.gather(
+            db.notifications.count_documents(query),
+            db.notifications.count_documents({**query, "read": False})
+        )
+        await db.notification_counters.update_one({"_id": counter["_id"]}, {"$set": {"unread": unread, "total": total}})
+
+async def reconcile_notification_counters() -> int:
+    """Recount every target's notifications; repairs drift from TTL deletions.
+
+    Writes racing with the recount are corrected on the next run.
+    """
+    counts = await db.notifications.aggregate([
+        {"$match": {"type": {"$in": ["admin", "customer"]}}},
+        {"$group": {
+            "_id": {"$cond": [{"$eq": ["$type", "admin"]}, "admin", "$target_id"]},
+            "total": {"$sum": 1},
+            "unread": {"$sum": {"$cond": [{"$eq": ["$read", False]}, 1, 0]}}
+        }}
+    ], allowDiskUse=True).to_list(None)
+    counts = [c for c in counts if c["_id"]]
+    if counts:
+        await db.notification_counters.bulk_write([
+            UpdateOne({"_id": c["_id"]}, {"$set": {"unread": c["unread"], "total": c["total"]}}, upsert=True)
+            for c in counts
+        ], ordered=False)
+    await db.notification_counters.update_many(
+        {"_id": {"$nin": [c["_id"] for c in counts] + ["broadcast"]}},
+        {"$set": {"unread": 0, "total": 0}}
+    )
+    return len(counts)
+
+async def periodic_notification_retention():
+    while True:
+        await asyncio.sleep(NOTIFICATION_SWEEP_INTERVAL)
+        try:
+            await enforce_notification_retention()
+        except Exception:
+            logger.exception("Notification retention sweep failed")
+
+# ============== BOOKING REMINDERS ==============
+
+# Upcoming bookings are a range scan on starts_at, their UTC start time
+REMINDER_LEAD_HOURS = int(os.environ.get('REMINDER_LEAD_HOURS', 24))
+REMINDER_INTERVAL = int(os.environ.get('REMINDER_INTERVAL_SECONDS', 300))
+REMINDER_BATCH_SIZE = 500
+
+async def send_booking_reminders(lead_hours: int = REMINDER_LEAD_HOURS) -> int:
+    """Notify customers of bookings starting within lead_hours.
+
+    Each reminder notification has dedup_key "reminder:<booking_id>" under a
+    unique index, and the booking is stamped with reminder_sent_at, so a
+    restart between the two steps can never send a reminder twice.
+    """
+    now = utc_now()
+    query = {
+        "starts_at": {"$gte": now, "$lte": now + timedelta(hours=lead_hours)},
+        "status": {"$in": ["pending", "confirmed"]},
+        "reminder_sent_at": {"$exists": False}
+    }
+    sent = 0
+    while True:
+        bookings = await db.bookings.find(
+            query, {"customer_phone": 1, "service_name": 1, "booking_date": 1, "booking_time": 1}
+        ).limit(REMINDER_BATCH_SIZE).to_list(REMINDER_BATCH_SIZE)
+        if not bookings:
+            return sent
+        
+        phones = list({b.get("customer_phone") for b in bookings})
+        customers = await db.customers.find({"phone": {"$in": phones}}, {"phone": 1}).to_list(len(phones))
+        customer_ids = {c["phone"]: str(c["_id"]) for c in customers}
+        notifications = []
+        for b in bookings:
+            if b.get("customer_phone") not in customer_ids:
+                continue
+            notification = notification_doc(
+                "Randevu Hatırlatması",
+                f"{b.get('service_name')} - {b.get('booking_date')} {b.get('booking_time')}",
+                "customer",
+                customer_ids[b["customer_phone"]],
+                str(b["_id"])
+            )
+            notification["dedup_key"] = f"reminder:{b['_id']}"
+            notifications.append(notification)
+        if notifications:
+            sent += len(await insert_notifications(notifications))
+        
+        await db.bookings.update_many(
+            {"_id": {"$in": [b["_id"] for b in bookings]}},
+            {"$set": {"reminder_sent_at": utc_now()}}
+        )
+        if len(bookings) < REMINDER_BATCH_SIZE:
+            return sent
+
+async def periodic_booking_reminders():
+    while True:
+        try:
+            sent = await send_booking_reminders()
+            if sent:
+                logger.info(f"Sent {sent} booking reminders")
+        except Exception:
+            logger.exception("Booking reminder run failed")
+        await asyncio.sleep(REMINDER_INTERVAL)
+
+# ============== SLOT CAPACITY ==============
+
+# Each availability document keeps reserved.<time>, the number of active
+# bookings in that slot, next to its capacity. Bookings take and give back a
+# place with single conditional updates, so checking a slot is a counter
+# comparison and concurrent bookings can never exceed the capacity.
+# ACTIVE_BOOKING_STATUSES (from scheduling.py) are the statuses that hold a place.
+
+def slot_capacity(availability: dict, time_slot: str) -> int:
+    return availability.get("slot_capacity", {}).get(time_slot, availability.get("capacity", 1))
+
+def slot_remaining(availability: dict, time_slot: str) -> int:
+    return slot_capacity(availability, time_slot) - availability.get("reserved", {}).get(time_slot, 0)
+
+async def reserve_slot(date_str: str, time_slot: str) -> bool:
+    """Take one place in a slot if it is open and not full"""
+    result = await db.availability.update_one(
+        {
+            "date": date_str,
+            "available": True,
+            "time_slots": time_slot,
+            "$expr": {"$lt": [
+                {"$ifNull": [f"$reserved.{time_slot}", 0]},
+                {"$ifNull": [f"$slot_capacity.{time_slot}", {"$ifNull": ["$capacity", 1]}]}
+            ]}
+        },
+        {"$inc": {f"reserved.{time_slot}": 1}}
+    )
+    return result.modified_count == 1
+
+async def release_slot(date_str: str, time_slot: str, count: int = 1):
+    await db.availability.update_one(
+        {"date": date_str, f"reserved.{time_slot}": {"$gte": count}},
+        {"$inc": {f"reserved.{time_slot}": -count}}
+    )
+
+async def set_booking_status(booking: dict, new_status: str) -> bool:
+    """Change a booking's status and move its slot reservation with it.
+
+    Returns False if the booking's status was changed concurrently.
+    """
+    old_status = booking["status"]
+    takes_slot = old_status not in ACTIVE_BOOKING_STATUSES and new_status in ACTIVE_BOOKING_STATUSES
+    frees_slot = old_status in ACTIVE_BOOKING_STATUSES and new_status not in ACTIVE_BOOKING_STATUSES
+    # A reactivated package booking takes its released session again
+    reclaims_session = takes_slot and booking.get("package_session") == "released"
+    if takes_slot and not await reserve_slot(booking["booking_date"], booking["booking_time"]):
+        raise HTTPException(status_code=400, detail="Bu saat dolu")
+    if reclaims_session and not await reclaim_package_session(booking["subscription_id"]):
+        await release_slot(booking["booking_date"], booking["booking_time"])
+        raise HTTPException(status_code=400, detail="Bu pakette kullanılabilir seans kalmadı")
+    query = {"_id": booking["_id"], "status": old_status}
+    changes = {"status": new_status}
+    if takes_slot and booking.get("subscription_id"):
+        # The session must not have been released since it was read
+        query["package_session"] = booking.get("package_session")
+    if reclaims_session:
+        changes["package_session"] = "redeemed"
+    result = await db.bookings.update_one(query, {"$set": changes})
+    if not result.matched_count:
+        if takes_slot:
+            await release_slot(booking["booking_date"], booking["booking_time"])
+        if reclaims_session:
+            await return_package_session(booking["subscription_id"])
+        return False
+    if frees_slot:
+        await release_slot(booking["booking_date"], booking["booking_time"])
+        if new_status == "cancelled":
+            await notify_waitlist(booking["booking_date"], booking["booking_time"])
+    return True
+
+async def backfill_slot_reservations():
+    """Count active bookings into availability documents that predate reserved"""
+    dates = await db.availability.distinct("date", {"reserved": {"$exists": False}})
+    if not dates:
+        return
+    counts = await db.bookings.aggregate([
+        {"$match": {"booking_date": {"$in": dates}, "status": {"$in": ACTIVE_BOOKING_STATUSES}}},
+        {"$group": {"_id": {"date": "$booking_date", "time": "$booking_time"}, "count": {"$sum": 1}}}
+    ]).to_list(None)
+    reserved = {d: {} for d in dates}
+    for c in counts:
+        reserved[c["_id"]["date"]][c["_id"]["time"]] = c["count"]
+    await db.availability.bulk_write([
+        UpdateOne({"date": d, "reserved": {"$exists": False}}, {"$set": {"reserved": r}})
+        for d, r in reserved.items()
+    ], ordered=False)
+
+# ============== WAITLIST ==============
+
+# Customers waiting for a full slot. Each freed place pops the oldest waiting
+# entry with one find_one_and_update on the (date, time, status, created_at)
+# index and notifies that customer, instead of clients polling the slot.
+
+async def notify_waitlist(date_str: str, time_slot: str, places: int = 1) -> int:
+    """Notify up to places waiting customers that the slot has opened"""
+    notifications = []
+    for _ in range(places):
+        entry = await db.waitlist.find_one_and_update(
+            {"booking_date": date_str, "booking_time": time_slot, "status": "waiting"},
+            {"$set": {"status": "notified", "notified_at": utc_now()}},
+            sort=[("created_at", 1)]
+        )
+        if not entry:
+            break
+        notification = notification_doc(
+            "Beklediğiniz saat açıldı",
+            f"{date_str} {time_slot} için yer açıldı. Hemen randevu alabilirsiniz.",
+            "customer",
+            entry["customer_id"]
+        )
+        notification["dedup_key"] = f"waitlist:{entry['_id']}"
+        notifications.append(notification)
+    if notifications:
+        await insert_notifications(notifications)
+    return len(notifications)
+
+# ============== BOOKING ARCHIVE ==============
+
+# Completed and cancelled bookings older than BOOKING_ARCHIVE_MONTHS move to
+# bookings_archive, keeping the hot collection (slot checks, admin lists) to
+# recent and active bookings. Customer history, exports, stats and the
+# customer aggregates read both tiers; archive_stats holds the archive's
+# dashboard totals so /admin/stats never scans it.
+BOOKING_ARCHIVE = "bookings_archive"
+BOOKING_ARCHIVE_MONTHS = int(os.environ.get('BOOKING_ARCHIVE_MONTHS', 12))
+BOOKING_ARCHIVE_HOUR = int(os.environ.get('BOOKING_ARCHIVE_HOUR', 4))  # UTC
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 500))
+ARCHIVE_BATCH_PAUSE = float(os.environ.get('ARCHIVE_BATCH_PAUSE', 0.5))
+TERMINAL_BOOKING_STATUSES = ["completed", "cancelled"]
+
+def archive_cutoff(months: int, today: Optional[date] = None) -> str:
+    """The booking_date before which terminal bookings are archived"""
+    today = today or date.today()
+    month_index = today.year * 12 + today.month - 1 - months
+    return date(month_index // 12, month_index % 12 + 1, min(today.day, 28)).isoformat()
+
+async def find_booking(booking_id: ObjectId) -> Optional[dict]:
+    """Find a booking in the hot collection, then in the archive"""
+    return await db.bookings.find_one({"_id": booking_id}) or await db[BOOKING_ARCHIVE].find_one({"_id": booking_id})
+
+async def archive_bookings(months: int = BOOKING_ARCHIVE_MONTHS, batch_size: int = ARCHIVE_BATCH_SIZE, pause: float = ARCHIVE_BATCH_PAUSE) -> int:
+    """Move old terminal bookings to the archive in throttled batches.
+
+    Each batch is upserted into the archive before it is deleted from
+    bookings, so an interrupted run loses nothing and the next run picks up
+    where it stopped. A booking reactivated mid-batch stays hot.
+    """
+    query = {"status": {"$in": TERMINAL_BOOKING_STATUSES}, "booking_date": {"$lt": archive_cutoff(months)}}
+    archived = 0
+    while True:
+        batch = await db.bookings.find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+        now = utc_now()
+        await db[BOOKING_ARCHIVE].bulk_write(
+            [ReplaceOne({"_id": b["_id"]}, {**b, "archived_at": now}, upsert=True) for b in batch],
+            ordered=False
+        )
+        ids = [b["_id"] for b in batch]
+        result = await db.bookings.delete_many({"_id": {"$in": ids}, "status": {"$in": TERMINAL_BOOKING_STATUSES}})
+        if result.deleted_count < len(ids):
+            still_hot = await db.bookings.find({"_id": {"$in": ids}}, {"_id": 1}).to_list(len(ids))
+            await db[BOOKING_ARCHIVE].delete_many({"_id": {"$in": [b["_id"] for b in still_hot]}})
+        archived += result.deleted_count
+        await asyncio.sleep(pause)
+    
+    totals = await db[BOOKING_ARCHIVE].aggregate([{"$group": {
+        "_id": None,
+        "total": {"$sum": 1},
+        "completed": {"$sum": {"$cond": [{"$eq": ["$status", "completed"]}, 1, 0]}},
+        "revenue": {"$sum": {"$cond": [{"$eq": ["$status", "completed"]}, "$total_price", 0]}}
+    }}]).to_list(1)
+    totals = totals[0] if totals else {"total": 0, "completed": 0, "revenue": 0}
+    await db.archive_stats.update_one({"_id": "bookings"}, {"$set": {
+        "total": totals["total"], "completed": totals["completed"], "revenue": totals["revenue"], "updated_at": utc_now()
+    }}, upsert=True)
+    return archived
+
+# ============== BACKGROUND JOBS ==============
+
+# Follow-up work that request handlers enqueue instead of awaiting. Retries
+# re-run the whole handler, so every step is idempotent (deduplicated
+# notifications, $max, conditional updates keyed by the booking or event id)
+# except the loyalty $inc, which comes last.
+job_runner = JobRunner(db, concurrency=int(os.environ.get('JOB_CONCURRENCY', 4)))
+
+JOB_PRIORITY_HIGH = 10
+JOB_PRIORITY_LOW = 0
+
+async def run_nightly(job_name: str, hour: int):
+    """Queue job_name once a day at hour (UTC).
+
+    Every process runs this loop; the per-day job key makes only the first
+    enqueue count, so the job runs once per cluster with the runner's retries.
+    """
+    while True:
+        now = datetime.utcnow()
+        next_run = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            await job_runner.enqueue(job_name, priority=JOB_PRIORITY_LOW, key=f"{job_name}:{next_run.date().isoformat()}")
+        except Exception:
+            logger.exception(f"Queuing the nightly {job_name} job failed")
+
+def booking_snapshot(booking: dict) -> dict:
+    """Fields the booking jobs need, without photo blobs"""
+    fields = ["_id", "customer_phone", "customer_name", "service_name", "booking_date", "booking_time", "total_price", "status"]
+    return {field: booking.get(field) for field in fields}
+
+@job_runner.task("booking_created")
+async def booking_created_job(booking: dict):
+    # Admin'e bildirim gönder
+    notification = notification_doc(
+        "Yeni Randevu",
+        f"{booking['customer_name']} - {booking['service_name']} - {booking['booking_date']} {booking['booking_time']}",
+        "admin",
+        "admin",
+        str(booking["_id"])
+    )
+    notification["dedup_key"] = f"booking-created:{booking['_id']}"
+    await insert_notifications([notification])
+    await record_booking_created(booking)
+    await add_loyalty_points(booking["customer_phone"], booking["total_price"])
+
+@job_runner.task("booking_status_changed")
+async def booking_status_changed_job(booking: dict, new_status: str, event_id: str, notify_customer: bool = False):
+    # Müşteriye bildirim gönder
+    if notify_customer and new_status in BOOKING_STATUS_MESSAGES:
+        customer = await db.customers.find_one({"phone": booking.get("customer_phone")}, {"_id": 1})
+        if customer:
+            notification = notification_doc(
+                BOOKING_STATUS_MESSAGES[new_status],
+                f"{booking.get('service_name')} - {booking.get('booking_date')} {booking.get('booking_time')}",
+                "customer",
+                str(customer["_id"]),
+                str(booking["_id"])
+            )
+            notification["dedup_key"] = f"booking-status:{event_id}"
+            await insert_notifications([notification])
+    if new_status == "cancelled":
+        await release_package_session(booking["_id"])
+    await record_booking_status_change(booking, new_status, event_id)
+
+def booking_status_payload(booking: dict, new_status: str, notify_customer: bool) -> dict:
+    return {
+        "booking": booking_snapshot(booking),
+        "new_status": new_status,
+        "event_id": str(ObjectId()),
+        "notify_customer": notify_customer
+    }
+
+async def enqueue_booking_status_change(booking: dict, new_status: str, notify_customer: bool = False):
+    await job_runner.enqueue(
+        "booking_status_changed", booking_status_payload(booking, new_status, notify_customer), priority=JOB_PRIORITY_HIGH
+    )
+
+@job_runner.task("review_created")
+async def review_created_job(customer_phone: str, rating: int):
+    # Loyalty points for the review (10 points) and rating stats in one update
+    update = rating_stats_update(rating, 1)
+    update[0]["$set"]["loyalty_points"] = {"$add": [{"$ifNull": ["$loyalty_points", 0]}, 10]}
+    await db.customers.update_one({"phone": customer_phone}, update)
+
+@job_runner.task("reconcile_customer_stats")
+async def reconcile_customer_stats_job():
+    updated = await reconcile_customer_stats()
+    logger.info(f"Customer stats reconciled for {updated} customers")
+
+@job_runner.task("reconcile_notification_counters")
+async def reconcile_notification_counters_job():
+    targets = await reconcile_notification_counters()
+    logger.info(f"Notification counters reconciled for {targets} targets")
+
+@job_runner.task("package_scheduling")
+async def package_scheduling_job():
+    subscriptions = await db.subscriptions.find({
+        "status": "active",
+        "sessions_remaining": {"$gt": 0},
+        "auto_schedule": {"$ne": False}
+    }).sort("created_at", 1).to_list(None)
+    bookings = await schedule_subscriptions(db, subscriptions)
+    await record_scheduled_bookings(bookings)
+    logger.info(f"Scheduled {len(bookings)} package sessions for {len(subscriptions)} subscriptions")
+
+@job_runner.task("archive_bookings")
+async def archive_bookings_job(months: int = BOOKING_ARCHIVE_MONTHS):
+    archived = await archive_bookings(months)
+    logger.info(f"Archived {archived} bookings older than {months} months")
+
+@job_runner.task("migrations")
+async def migrations_job(version: Optional[int] = None, dry_run: bool = False):
+    if version is None:
+        applied = await migration_runner.run_pending(log_progress)
+        if applied:
+            logger.info(f"Applied migrations: {applied}")
+        return
+    migration = migration_runner.migrations[version]
+    if dry_run:
+        result = await migration_runner.dry_run(migration, log_progress)
+        logger.info(f"Migration {version} dry run: {result['would_modify']} of {result['scanned']} documents would change")
+    else:
+        await migration_runner.run(migration, log_progress)
+
+@job_runner.task("rfm_segmentation")
+async def rfm_segmentation_job():
+    segments = await run_rfm_segmentation(db)
+    logger.info(f"Customer segments updated: {segments}")
+
+# ============== CUSTOMER SEARCH HELPERS ==============
+
+# Turkish letters without a plain ASCII decomposition; I and İ both fold to i
+TURKISH_FOLD = str.maketrans("çÇğĞıIİöÖşŞüÜ", "ccggiiioossuu")
+
+def fold_search_text(text: str) -> str:
+    """Case- and diacritic-insensitive form of text for Turkish search"""
+    text = unicodedata.normalize("NFKD", (text or "").translate(TURKISH_FOLD))
+    return text.encode("ascii", "ignore").decode("ascii").lower()
+
+def name_search_tokens(name: str) -> List[str]:
+    """Indexed words of a customer name, matched by prefix in searches"""
+    return re.findall(r"[a-z0-9]+", fold_search_text(name))
+
+# ============== SCHEMA MIGRATIONS ==============
+
+# Storage format changes run as versioned, resumable batch migrations (see
+# migrations.py). Pending ones are queued as a background job at startup;
+# admins can list them and start a run or dry run on demand.
+migration_runner = MigrationRunner(
+    db,
+    batch_size=int(os.environ.get('MIGRATION_BATCH_SIZE', 500)),
+    pause=float(os.environ.get('MIGRATION_BATCH_PAUSE', 0.2))
+)
+
+@migration_runner.migration(1, "customers", "Add name_tokens for customer search", {"name_tokens": {"$exists": False}}, {"name": 1})
+def add_customer_name_tokens(customer: dict) -> dict:
+    return {"$set": {"name_tokens": name_search_tokens(customer.get("name", ""))}}
+
+# Native dates (see timestamps.py): ISO string created_at values become BSON
+# dates, and bookings get starts_at for time-window queries
+def fields_to_date(*fields: str):
+    """Migration update turning the given ISO string fields into dates"""
+    def update(doc: dict) -> Optional[dict]:
+        changes = {}
+        for field in fields:
+            value = parse_timestamp(doc.get(field)) if isinstance(doc.get(field), str) else None
+            if value:
+                changes[field] = value
+        return {"$set": changes} if changes else None
+    return update
+
+def string_fields_query(*fields: str) -> dict:
+    return {"$or": [{field: {"$type": "string"}} for field in fields]}
+
+created_at_to_date = fields_to_date("created_at")
+
+def booking_timestamps(booking: dict) -> Optional[dict]:
+    update = created_at_to_date(booking) or {"$set": {}}
+    if "starts_at" not in booking:
+        # None for unparseable legacy dates, so the booking is not matched again
+        update["$set"]["starts_at"] = booking_starts_at(booking.get("booking_date"), booking.get("booking_time"))
+    return update if update["$set"] else None
+
+BOOKING_TIMESTAMPS_QUERY = {"$or": [{"created_at": {"$type": "string"}}, {"starts_at": {"$exists": False}}]}
+BOOKING_TIMESTAMPS_FIELDS = {"created_at": 1, "starts_at": 1, "booking_date": 1, "booking_time": 1}
+migration_runner.migration(2, "bookings", "Store booking created_at as a date and add starts_at", BOOKING_TIMESTAMPS_QUERY, BOOKING_TIMESTAMPS_FIELDS)(booking_timestamps)
+migration_runner.migration(3, BOOKING_ARCHIVE, "Store archived booking created_at as a date and add starts_at", BOOKING_TIMESTAMPS_QUERY, BOOKING_TIMESTAMPS_FIELDS)(booking_timestamps)
+migration_runner.migration(4, "reviews", "Store review created_at as a date", {"created_at": {"$type": "string"}}, {"created_at": 1})(created_at_to_date)
+migration_runner.migration(5, "notifications", "Store notification created_at as a date", {"created_at": {"$type": "string"}}, {"created_at": 1})(created_at_to_date)
+
+# Targeted notifications from before the retention policy have no expire_at,
+# so the TTL index would keep them forever
+@migration_runner.migration(6, "notifications", "Add expire_at to older notifications", {"type": {"$in": ["admin", "customer"]}, "expire_at": {"$exists": False}}, {"created_at": 1})
+def add_notification_expiry(notification: dict) -> dict:
+    created_at = notification.get("created_at")
+    if isinstance(created_at, str):
+        created_at = parse_timestamp(created_at)
+    return {"$set": {"expire_at": (created_at or utc_now()) + timedelta(days=NOTIFICATION_RETENTION_DAYS)}}
+
+# The remaining collections written with ISO string timestamps; every
+# stored instant is a BSON date from here on
+migration_runner.migration(7, "customers", "Store customer created_at as a date", string_fields_query("created_at"), {"created_at": 1})(fields_to_date("created_at"))
+migration_runner.migration(8, "subscriptions", "Store subscription created_at as a date", string_fields_query("created_at"), {"created_at": 1})(fields_to_date("created_at"))
+migration_runner.migration(9, "waitlist", "Store waitlist created_at and notified_at as dates", string_fields_query("created_at", "notified_at"), {"created_at": 1, "notified_at": 1})(fields_to_date("created_at", "notified_at"))
+migration_runner.migration(10, "work_photos", "Store work photo created_at as a date", string_fields_query("created_at"), {"created_at": 1})(fields_to_date("created_at"))
+migration_runner.migration(11, "booking_locations", "Store location updated_at as a date", string_fields_query("updated_at"), {"updated_at": 1})(fields_to_date("updated_at"))
+migration_runner.migration(12, "push_tokens", "Store push token updated_at as a date", string_fields_query("updated_at"), {"updated_at": 1})(fields_to_date("updated_at"))
+migration_runner.migration(13, "packages", "Store package created_at as a date", string_fields_query("created_at"), {"created_at": 1})(fields_to_date("created_at"))
+migration_runner.migration(14, "admins", "Store admin created_at as a date", string_fields_query("created_at"), {"created_at": 1})(fields_to_date("created_at"))
+migration_runner.migration(15, "archive_stats", "Store archive stats updated_at as a date", string_fields_query("updated_at"), {"updated_at": 1})(fields_to_date("updated_at"))
+
 # ============== CUSTOMER AUTH APIs ==============
 
 @api_router.post("/customers/register")
@@ -255,7 +1218,8 @@ async def register_customer(customer: CustomerRegister):
         "total_bookings": 0,
         "referral_code": referral_code,
         "referred_by": None,
-        "created_at": datetime.utcnow().isoformat()
+        "name_tokens": name_search_tokens(customer.name),
+        "created_at": utc_now()
     }
     
     result = await db.customers.insert_one(customer_doc)
@@ -391,7 +1355,7 @@ async def create_review(review: ReviewCreate):
     """Create a review for a completed booking"""
     # Check booking exists and is completed
     try:
-        booking = await db.bookings.find_one({"_id": ObjectId(review.booking_id)})
+        booking = await find_booking(ObjectId(review.booking_id))
     except Exception:
         raise HTTPException(status_code=400, detail="Geçersiz randevu ID")
     
@@ -418,16 +1382,17 @@ async def create_review(review: ReviewCreate):
         "customer_phone": booking["customer_phone"],
         "rating": review.rating,
         "comment": review.comment,
-        "created_at": datetime.utcnow().isoformat()
+        "created_at": utc_now()
     }
     
     result = await db.reviews.insert_one(review_doc)
+    await bump_version("reviews")
     
     # Give loyalty points for review (10 points)
-    await db.customers.update_one(
-        {"phone": booking["customer_phone"]},
-        {"$inc": {"loyalty_points": 10}}
-    )
+    await job_runner.enqueue("review_created", {
+        "customer_phone": booking["customer_phone"],
+        "rating": review.rating
+    }, priority=JOB_PRIORITY_HIGH)
     
     return {
         "id": str(result.inserted_id),
@@ -445,12 +1410,16 @@ async def get_reviews(service_id: Optional[str] = None, limit: int = 10):
     if service_id:
         query["service_id"] = service_id
     
-    reviews = await db.reviews.find(query).sort("created_at", -1).limit(limit).to_list(limit)
-    return [{**serialize_doc(r), "id": str(r["_id"])} for r in reviews]
+    reviews = await find_serialized(db.reviews, query, sort=[("created_at", -1)], limit=limit)
+    return FastJSONResponse(reviews)
 
 @api_router.get("/reviews/stats")
-async def get_review_stats():
+async def get_review_stats(request: Request, response: Response):
     """Get review statistics"""
+    not_modified = await conditional_get(request, response, "reviews")
+    if not_modified:
+        return not_modified
+    
     pipeline = [
         {"$group": {
             "_id": None,
@@ -483,8 +1452,13 @@ async def get_review_stats():
 # ============== PACKAGE APIs ==============
 
 @api_router.get("/packages")
-async def get_packages():
+async def get_packages(request: Request, response: Response):
     """Get all active packages"""
+    # service_name comes from the services collection, so both versions count
+    not_modified = await conditional_get(request, response, "packages", "services")
+    if not_modified:
+        return not_modified
+    
     packages = await db.packages.find({"active": True}).to_list(100)
     result = []
     for pkg in packages:
@@ -504,8 +1478,23 @@ async def get_packages():
     return result
 
 @api_router.post("/packages/subscribe")
-async def subscribe_to_package(customer_phone: str, package_id: str):
-    """Subscribe customer to a package"""
+async def subscribe_to_package(
+    customer_phone: str,
+    package_id: str,
+    start_date: Optional[str] = None,
+    preferred_time: Optional[str] = None,
+    auto_schedule: bool = True
+):
+    """Subscribe customer to a package and book its sessions in advance"""
+    # Checked before anything is stored: the scheduler parses both later
+    if start_date:
+        try:
+            start_date = datetime.strptime(start_date, "%Y-%m-%d").date().isoformat()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Tarih formatı YYYY-AA-GG olmalıdır")
+    if preferred_time and not re.fullmatch(r"([01]\d|2[0-3]):[0-5]\d", preferred_time):
+        raise HTTPException(status_code=400, detail="Saat formatı SS:DD olmalıdır")
+    
     try:
         package = await db.packages.find_one({"_id": ObjectId(package_id)})
     except Exception:
@@ -527,27 +1516,40 @@ async def subscribe_to_package(customer_phone: str, package_id: str):
         "total_sessions": package["total_sessions"],
         "price_paid": package["price"],
         "status": "active",
-        "created_at": datetime.utcnow().isoformat()
+        "start_date": start_date,
+        "preferred_time": preferred_time,
+        "auto_schedule": auto_schedule,
+        "created_at": utc_now()
     }
     
     result = await db.subscriptions.insert_one(subscription)
     
+    bookings = []
+    if auto_schedule:
+        bookings = await schedule_subscriptions(db, [subscription])
+        await record_scheduled_bookings(bookings)
+    
     return {
         "id": str(result.inserted_id),
         "message": "Paket aboneliği başarıyla oluşturuldu",
-        "sessions_remaining": package["total_sessions"]
+        "sessions_remaining": package["total_sessions"] - len(bookings),
+        "scheduled_sessions": [{
+            "id": str(b["_id"]),
+            "booking_date": b["booking_date"],
+            "booking_time": b["booking_time"]
+        } for b in bookings]
     }
 
 @api_router.get("/packages/my-subscriptions")
 async def get_my_subscriptions(phone: str):
     """Get customer's active subscriptions"""
-    subscriptions = await db.subscriptions.find({
+    subscriptions = await find_serialized(db.subscriptions, {
         "customer_phone": phone,
         "status": "active",
         "sessions_remaining": {"$gt": 0}
-    }).to_list(100)
+    }, exclude=["schedule_run"])
     
-    return [{**serialize_doc(s), "id": str(s["_id"])} for s in subscriptions]
+    return FastJSONResponse(subscriptions)
 
 # ============== WORK PHOTO APIs ==============
 
@@ -570,7 +1572,7 @@ async def upload_work_photo(photo: WorkPhotoUpload):
         "booking_id": photo.booking_id,
         "photo_type": photo.photo_type,
         "photo_base64": photo.photo_base64,
-        "created_at": datetime.utcnow().isoformat()
+        "created_at": utc_now()
     }
     
     result = await db.work_photos.insert_one(photo_doc)
@@ -608,7 +1610,7 @@ async def update_location(location: LocationUpdate):
             "latitude": location.latitude,
             "longitude": location.longitude,
             "status": location.status,
-            "updated_at": datetime.utcnow().isoformat()
+            "updated_at": utc_now()
         }},
         upsert=True
     )
@@ -632,19 +1634,25 @@ async def get_location(booking_id: str):
 # ============== ORIGINAL SERVICE APIs ==============
 
 @api_router.get("/services")
-async def get_services():
+async def get_services(request: Request, response: Response):
     """Get all active services"""
-    services = await db.services.find({"active": True}).sort("order", 1).to_list(100)
-    return [{**serialize_doc(s), "id": str(s["_id"])} for s in services]
+    not_modified = await conditional_get(request, response, "services")
+    if not_modified:
+        return not_modified
+    
+    return await find_serialized(db.services, {"active": True}, sort=[("order", 1)])
 
 @api_router.get("/availability")
-async def get_availability(year: int, month: int):
+async def get_availability(request: Request, response: Response, year: int, month: int = Query(..., ge=1, le=12)):
     """Get availability for a specific month"""
-    start_date = f"{year}-{month:02d}-01"
-    end_date = f"{year}-{month:02d}-31"
+    not_modified = await conditional_get(request, response, "availability", key=f"{year}-{month:02d}")
+    if not_modified:
+        return not_modified
+    
+    start_date, end_date = month_range(year, month)
     
     availability_docs = await db.availability.find({
-        "date": {"$gte": start_date, "$lte": end_date}
+        "date": {"$gte": start_date, "$lt": end_date}
     }).to_list(100)
     
     dates = []
@@ -665,19 +1673,15 @@ async def get_time_slots(date_str: str = Query(..., alias="date")):
     if not availability or not availability.get("available"):
         return {"slots": [], "all_slots": [], "booked_slots": [], "available": False}
     
-    bookings = await db.bookings.find({
-        "booking_date": date_str,
-        "status": {"$in": ["pending", "confirmed"]}
-    }).to_list(100)
-    
-    booked_times = [b["booking_time"] for b in bookings]
     all_slots = availability.get("time_slots", [])
-    available_slots = [slot for slot in all_slots if slot not in booked_times]
+    remaining = {slot: max(slot_remaining(availability, slot), 0) for slot in all_slots}
+    available_slots = [slot for slot in all_slots if remaining[slot] > 0]
     
     return {
         "slots": available_slots,
         "all_slots": all_slots,
-        "booked_slots": booked_times,
+        "booked_slots": [slot for slot in all_slots if remaining[slot] == 0],
+        "remaining": remaining,
         "available": len(available_slots) > 0
     }
 
@@ -702,15 +1706,17 @@ async def create_booking(booking: BookingCreate):
     if booking.booking_time not in availability.get("time_slots", []):
         raise HTTPException(status_code=400, detail="Bu saat müsait değil")
     
-    # Check if already booked
-    existing = await db.bookings.find_one({
-        "booking_date": booking.booking_date,
-        "booking_time": booking.booking_time,
-        "status": {"$in": ["pending", "confirmed"]}
-    })
-    if existing:
+    # Take a place in the slot; given back if anything below fails
+    if not await reserve_slot(booking.booking_date, booking.booking_time):
         raise HTTPException(status_code=400, detail="Bu saat dolu")
-    
+    try:
+        return await insert_booking(booking, service)
+    except Exception:
+        await release_slot(booking.booking_date, booking.booking_time)
+        raise
+
+async def insert_booking(booking: BookingCreate, service: dict) -> dict:
+    """Price and store a booking whose slot is already reserved"""
     # Calculate price with discounts
     base_price = service["price"]
     total_discount = 0.0
@@ -732,6 +1738,14 @@ async def create_booking(booking: BookingCreate):
     
     total_price = base_price - total_discount
     
+    # Package bookings are paid for by the subscription, one session each
+    subscription = None
+    if booking.package_id:
+        subscription = await redeem_package_session(booking.customer_phone, booking.package_id, booking.service_id)
+        total_price = round(subscription["price_paid"] / subscription["total_sessions"], 2)
+        total_discount = max(base_price - total_price, 0.0)
+        discount_details = [f"Paket: {subscription['package_name']} (kalan seans: {subscription['sessions_remaining']})"]
+    
     # Create booking
     booking_doc = {
         "service_id": booking.service_id,
@@ -748,24 +1762,32 @@ async def create_booking(booking: BookingCreate):
         "payment_method": booking.payment_method,
         "customer_photos": booking.customer_photos or [],  # Store customer's photos
         "status": "pending",
-        "created_at": datetime.utcnow().isoformat()
+        "created_at": utc_now(),
+        "starts_at": booking_starts_at(booking.booking_date, booking.booking_time)
     }
+    if subscription:
+        booking_doc["package_id"] = booking.package_id
+        booking_doc["subscription_id"] = subscription["_id"]
+        booking_doc["package_session"] = "redeemed"
     
-    result = await db.bookings.insert_one(booking_doc)
-    
-    # Add loyalty points
-    await add_loyalty_points(booking.customer_phone, total_price)
+    try:
+        result = await db.bookings.insert_one(booking_doc)
+    except Exception:
+        if subscription:
+            await return_package_session(subscription["_id"])
+        raise
     
-    # Admin'e bildirim gönder
-    await db.notifications.insert_one({
-        "title": "Yeni Randevu",
-        "message": f"{booking_doc['customer_name']} - {booking_doc['service_name']} - {booking_doc['booking_date']} {booking_doc['booking_time']}",
-        "type": "admin",
-        "target_id": "admin",
-        "booking_id": str(result.inserted_id),
-        "read": False,
-        "created_at": datetime.utcnow().isoformat()
-    })
+    # Loyalty points, customer stats and the admin notification
+    await job_runner.enqueue("booking_created", {"booking": booking_snapshot(booking_doc)}, priority=JOB_PRIORITY_HIGH)
+    await db.waitlist.update_many(
+        {
+            "booking_date": booking.booking_date,
+            "booking_time": booking.booking_time,
+            "customer_phone": booking.customer_phone,
+            "status": {"$in": ["waiting", "notified"]}
+        },
+        {"$set": {"status": "booked"}}
+    )
     
     return {
         "id": str(result.inserted_id),
@@ -780,21 +1802,19 @@ async def create_booking(booking: BookingCreate):
         "discount_applied": booking_doc["discount_applied"],
         "payment_method": booking_doc["payment_method"],
         "status": booking_doc["status"],
-        "created_at": booking_doc["created_at"]
+        "created_at": booking_doc["created_at"],
+        "sessions_remaining": subscription["sessions_remaining"] if subscription else None
     }
 
 @api_router.get("/bookings/check")
 async def check_bookings(phone: str):
     """Get bookings by phone number"""
-    bookings = await db.bookings.find({"customer_phone": phone}).sort("created_at", -1).to_list(100)
-    result = []
-    for b in bookings:
-        booking_data = {**serialize_doc(b), "id": str(b["_id"])}
+    bookings = await find_serialized(db.bookings, {"customer_phone": phone}, sort=[("created_at", -1)], union_with=BOOKING_ARCHIVE)
+    for booking_data in bookings:
         # Check if booking has review
-        review = await db.reviews.find_one({"booking_id": str(b["_id"])})
+        review = await db.reviews.find_one({"booking_id": booking_data["id"]})
         booking_data["has_review"] = review is not None
-        result.append(booking_data)
-    return result
+    return FastJSONResponse(bookings)
 
 @api_router.put("/bookings/{booking_id}/cancel")
 async def cancel_booking(booking_id: str, phone: str):
@@ -813,13 +1833,71 @@ async def cancel_booking(booking_id: str, phone: str):
     if booking["status"] in ["cancelled", "completed"]:
         raise HTTPException(status_code=400, detail="Bu randevu iptal edilemez")
     
-    await db.bookings.update_one(
-        {"_id": ObjectId(booking_id)},
-        {"$set": {"status": "cancelled"}}
-    )
+    if not await set_booking_status(booking, "cancelled"):
+        raise HTTPException(status_code=409, detail="Randevu başka bir işlemle güncellendi, tekrar deneyin")
+    await enqueue_booking_status_change(booking, "cancelled")
     
     return {"message": "Randevu iptal edildi", "id": booking_id}
 
+# ============== WAITLIST APIs ==============
+
+@api_router.post("/waitlist")
+async def join_waitlist(entry: WaitlistJoin):
+    """Join the waitlist of a full slot"""
+    customer = await db.customers.find_one({"phone": entry.customer_phone}, {"_id": 1})
+    if not customer:
+        raise HTTPException(status_code=400, detail="Bekleme listesine katılmak için önce kayıt olmanız gerekiyor")
+    
+    availability = await db.availability.find_one({"date": entry.booking_date})
+    if not availability or not availability.get("available") or entry.booking_time not in availability.get("time_slots", []):
+        raise HTTPException(status_code=400, detail="Bu saat müsait değil")
+    if slot_remaining(availability, entry.booking_time) > 0:
+        raise HTTPException(status_code=400, detail="Bu saatte yer var, randevu oluşturabilirsiniz")
+    
+    # Entries expire at local midnight after the slot's day
+    slot_end = local_day_start(date.fromisoformat(entry.booking_date) + timedelta(days=1))
+    try:
+        result = await db.waitlist.insert_one({
+            "booking_date": entry.booking_date,
+            "booking_time": entry.booking_time,
+            "customer_phone": entry.customer_phone,
+            "customer_id": str(customer["_id"]),
+            "status": "waiting",
+            "created_at": utc_now(),
+            "expire_at": slot_end
+        })
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Bu saat için zaten bekleme listesindesiniz")
+    
+    position = await db.waitlist.count_documents({
+        "booking_date": entry.booking_date,
+        "booking_time": entry.booking_time,
+        "status": "waiting",
+        "_id": {"$lte": result.inserted_id}
+    })
+    return {"id": str(result.inserted_id), "message": "Bekleme listesine eklendiniz", "position": position}
+
+@api_router.get("/waitlist")
+async def get_my_waitlist(phone: str):
+    """Get customer's waitlist entries"""
+    entries = await find_serialized(
+        db.waitlist,
+        {"customer_phone": phone, "status": {"$in": ["waiting", "notified"]}},
+        sort=[("booking_date", 1), ("booking_time", 1)],
+        exclude=["expire_at"]
+    )
+    return FastJSONResponse(entries)
+
+@api_router.delete("/waitlist/{entry_id}")
+async def leave_waitlist(entry_id: str, phone: str):
+    """Leave a slot's waitlist"""
+    if not ObjectId.is_valid(entry_id):
+        raise HTTPException(status_code=400, detail="Geçersiz kayıt ID")
+    result = await db.waitlist.delete_one({"_id": ObjectId(entry_id), "customer_phone": phone})
+    if not result.deleted_count:
+        raise HTTPException(status_code=404, detail="Kayıt bulunamadı")
+    return {"message": "Bekleme listesinden çıkarıldınız"}
+
 # ============== ADMIN APIs ==============
 
 @api_router.post("/admin/login")
@@ -857,7 +1935,7 @@ async def init_admin():
     admin = {
         "username": "admin",
         "password": hashed.decode('utf-8'),
-        "created_at": datetime.utcnow().isoformat()
+        "created_at": utc_now()
     }
     
     await db.admins.insert_one(admin)
@@ -896,6 +1974,7 @@ async def init_admin():
                 {"$set": pkg},
                 upsert=True
             )
+        await bump_version("packages")
     
     return {"message": "Admin oluşturuldu", "username": "admin", "password": "admin123"}
 
@@ -903,15 +1982,15 @@ async def init_admin():
 async def get_admin_bookings(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get all bookings"""
     verify_token(credentials)
-    bookings = await db.bookings.find().sort("created_at", -1).to_list(1000)
-    result = []
-    for b in bookings:
-        booking_data = {**serialize_doc(b), "id": str(b["_id"])}
-        # Include customer_photos if present
-        if "customer_photos" in b:
-            booking_data["customer_photos"] = b["customer_photos"]
-        result.append(booking_data)
-    return result
+    return streaming_list(db.bookings, sort=[("created_at", -1)])
+
+# Customer notification titles for admin status changes
+BOOKING_STATUS_MESSAGES = {
+    "confirmed": "Randevunuz onaylandı",
+    "completed": "Randevunuz tamamlandı",
+    "cancelled": "Randevunuz iptal edildi",
+    "in_progress": "Randevunuz başladı"
+}
 
 @api_router.put("/admin/bookings/{booking_id}")
 async def update_booking_status(
@@ -927,41 +2006,121 @@ async def update_booking_status(
     if not booking:
         raise HTTPException(status_code=404, detail="Randevu bulunamadı")
     
-    result = await db.bookings.update_one(
-        {"_id": ObjectId(booking_id)},
-        {"$set": {"status": update.status}}
-    )
+    if not await set_booking_status(booking, update.status):
+        raise HTTPException(status_code=409, detail="Randevu başka bir işlemle güncellendi, tekrar deneyin")
+    await enqueue_booking_status_change(booking, update.status, notify_customer=True)
     
-    # Müşteriye bildirim gönder
-    status_messages = {
-        "confirmed": "Randevunuz onaylandı",
-        "completed": "Randevunuz tamamlandı",
-        "cancelled": "Randevunuz iptal edildi",
-        "in_progress": "Randevunuz başladı"
-    }
+    return {"message": "Randevu güncellendi"}
+
+@api_router.post("/admin/bookings/bulk-status")
+async def bulk_update_booking_status(
+    update: BulkBookingStatusUpdate,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Update the status of many bookings at once"""
+    verify_token(credentials)
     
-    if update.status in status_messages:
-        # Müşteriyi bul
-        customer = await db.customers.find_one({"phone": booking.get("customer_phone")})
-        if customer:
-            await db.notifications.insert_one({
-                "title": status_messages[update.status],
-                "message": f"{booking.get('service_name')} - {booking.get('booking_date')} {booking.get('booking_time')}",
-                "type": "customer",
-                "target_id": str(customer["_id"]),
-                "booking_id": booking_id,
-                "read": False,
-                "created_at": datetime.utcnow().isoformat()
-            })
+    booking_ids = list(dict.fromkeys(update.booking_ids))
+    object_ids = [ObjectId(b) for b in booking_ids if ObjectId.is_valid(b)]
     
-    return {"message": "Randevu güncellendi"}
+    bookings = await db.bookings.find(
+        {"_id": {"$in": object_ids}},
+        {
+            "customer_phone": 1, "customer_name": 1, "service_name": 1, "booking_date": 1, "booking_time": 1,
+            "status": 1, "total_price": 1, "package_session": 1, "subscription_id": 1
+        }
+    ).to_list(len(object_ids))
+    
+    # Reactivated bookings need their slot, and a released package session,
+    # back; bookings whose slot is full or package is used up are skipped
+    slot_full = set()
+    no_sessions = set()
+    reserved = []
+    reclaimed = set()
+    if update.status in ACTIVE_BOOKING_STATUSES:
+        for b in bookings:
+            if b.get("status") in ACTIVE_BOOKING_STATUSES:
+                continue
+            if not await reserve_slot(b["booking_date"], b["booking_time"]):
+                slot_full.add(b["_id"])
+                continue
+            if b.get("package_session") == "released":
+                if not await reclaim_package_session(b["subscription_id"]):
+                    await release_slot(b["booking_date"], b["booking_time"])
+                    no_sessions.add(b["_id"])
+                    continue
+                reclaimed.add(b["_id"])
+            reserved.append(b)
+    bookings = [b for b in bookings if b["_id"] not in slot_full | no_sessions]
+    
+    # Like set_booking_status, each row only changes if its status is still
+    # the one read above; status_batch tells which rows this call changed
+    # and is removed again once they are known
+    conflicts = set()
+    if bookings:
+        batch = ObjectId()
+        reactivated = {b["_id"] for b in reserved}
+        operations = []
+        for b in bookings:
+            query = {"_id": b["_id"], "status": b.get("status")}
+            changes = {"status": update.status, "status_batch": batch}
+            if b["_id"] in reactivated and b.get("subscription_id"):
+                # The session must not have been released since it was read
+                query["package_session"] = b.get("package_session")
+            if b["_id"] in reclaimed:
+                changes["package_session"] = "redeemed"
+            operations.append(UpdateOne(query, {"$set": changes}))
+        await db.bookings.bulk_write(operations, ordered=False)
+        changed = {d["_id"] for d in await db.bookings.find(
+            {"_id": {"$in": [b["_id"] for b in bookings]}, "status_batch": batch}, {"_id": 1}
+        ).to_list(len(bookings))}
+        if changed:
+            await db.bookings.update_many({"_id": {"$in": list(changed)}}, {"$unset": {"status_batch": ""}})
+        conflicts = {b["_id"] for b in bookings} - changed
+        for b in reserved:
+            if b["_id"] in conflicts:
+                await release_slot(b["booking_date"], b["booking_time"])
+                if b["_id"] in reclaimed:
+                    await return_package_session(b["subscription_id"])
+        bookings = [b for b in bookings if b["_id"] in changed]
+    found = {b["_id"]: b for b in bookings}
+    
+    # Give back the slots of deactivated bookings, one update per slot
+    if found and update.status not in ACTIVE_BOOKING_STATUSES:
+        freed = Counter(
+            (b["booking_date"], b["booking_time"]) for b in bookings if b.get("status") in ACTIVE_BOOKING_STATUSES
+        )
+        for (date_str, time_slot), count in freed.items():
+            await release_slot(date_str, time_slot, count)
+            if update.status == "cancelled":
+                await notify_waitlist(date_str, time_slot, count)
+    
+    # Notifications, stats and package sessions go through the same
+    # idempotent job as single status changes
+    await job_runner.enqueue_many(
+        "booking_status_changed",
+        [booking_status_payload(b, update.status, notify_customer=True) for b in bookings],
+        priority=JOB_PRIORITY_HIGH
+    )
+    
+    return {
+        "updated": len(found),
+        "results": [{
+            "id": booking_id,
+            "result": "invalid_id" if not ObjectId.is_valid(booking_id)
+            else "updated" if ObjectId(booking_id) in found
+            else "slot_full" if ObjectId(booking_id) in slot_full
+            else "no_sessions" if ObjectId(booking_id) in no_sessions
+            else "conflict" if ObjectId(booking_id) in conflicts else "not_found"
+        } for booking_id in booking_ids]
+    }
 
 @api_router.get("/admin/services")
 async def get_admin_services(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get all services"""
     verify_token(credentials)
-    services = await db.services.find().sort("order", 1).to_list(100)
-    return [{**serialize_doc(s), "id": str(s["_id"])} for s in services]
+    services = await find_serialized(db.services, sort=[("order", 1)])
+    return FastJSONResponse(services)
 
 @api_router.post("/admin/services")
 async def create_service(service: Service, credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -970,6 +2129,7 @@ async def create_service(service: Service, credentials: HTTPAuthorizationCredent
     
     service_doc = service.dict()
     result = await db.services.insert_one(service_doc)
+    await bump_version("services")
     
     response_data = {
         "id": str(result.inserted_id),
@@ -996,6 +2156,7 @@ async def update_service(service_id: str, service: Service, credentials: HTTPAut
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Hizmet bulunamadı")
+    await bump_version("services")
     
     return {"message": "Hizmet güncellendi"}
 
@@ -1008,22 +2169,22 @@ async def delete_service(service_id: str, credentials: HTTPAuthorizationCredenti
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Hizmet bulunamadı")
+    await bump_version("services")
     
     return {"message": "Hizmet silindi"}
 
 @api_router.get("/admin/availability")
-async def get_admin_availability(year: int, month: int, credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_admin_availability(year: int, month: int = Query(..., ge=1, le=12), credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get availability"""
     verify_token(credentials)
     
-    start_date = f"{year}-{month:02d}-01"
-    end_date = f"{year}-{month:02d}-31"
+    start_date, end_date = month_range(year, month)
     
-    availability_docs = await db.availability.find({
-        "date": {"$gte": start_date, "$lte": end_date}
-    }).to_list(100)
+    availability_docs = await find_serialized(db.availability, {
+        "date": {"$gte": start_date, "$lt": end_date}
+    })
     
-    return [{**serialize_doc(a), "id": str(a["_id"])} for a in availability_docs]
+    return FastJSONResponse(availability_docs)
 
 @api_router.get("/admin/availability/date")
 async def get_availability_by_date(date: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -1045,6 +2206,7 @@ async def set_availability(availability: AvailabilityDate, credentials: HTTPAuth
         {"$set": availability.dict()},
         upsert=True
     )
+    await bump_version("availability")
     
     return {"message": "Müsaitlik güncellendi"}
 
@@ -1052,8 +2214,8 @@ async def set_availability(availability: AvailabilityDate, credentials: HTTPAuth
 async def get_settings(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get all settings"""
     verify_token(credentials)
-    settings = await db.settings.find().to_list(100)
-    return [{**serialize_doc(s), "id": str(s["_id"])} for s in settings]
+    settings = await find_serialized(db.settings)
+    return FastJSONResponse(settings)
 
 @api_router.put("/admin/settings")
 async def update_setting(setting: SettingUpdate, credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -1117,6 +2279,12 @@ async def get_stats(credentials: HTTPAuthorizationCredentials = Depends(security
     revenue_result = await db.bookings.aggregate(revenue_pipeline).to_list(1)
     total_revenue = revenue_result[0]["total"] if revenue_result else 0
     
+    # Archived bookings, from the totals kept by the archive job
+    archived = await db.archive_stats.find_one({"_id": "bookings"}) or {}
+    total_bookings += archived.get("total", 0)
+    completed_bookings += archived.get("completed", 0)
+    total_revenue += archived.get("revenue", 0)
+    
     return {
         "total_bookings": total_bookings,
         "pending_bookings": pending_bookings,
@@ -1131,23 +2299,93 @@ async def get_stats(credentials: HTTPAuthorizationCredentials = Depends(security
 async def get_customers(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get all customers"""
     verify_token(credentials)
-    customers = await db.customers.find().sort("created_at", -1).to_list(1000)
-    return [{**serialize_doc(c), "id": str(c["_id"])} for c in customers]
+    return streaming_list(db.customers, sort=[("created_at", -1)], exclude=CUSTOMER_INTERNAL_FIELDS)
+
+@api_router.post("/admin/customers/reconcile-stats")
+async def reconcile_customer_stats_now(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Queue a recomputation of customer lifetime aggregates"""
+    verify_token(credentials)
+    job_id = await job_runner.enqueue("reconcile_customer_stats", priority=JOB_PRIORITY_LOW)
+    return {"message": "Müşteri istatistikleri güncelleniyor", "job_id": str(job_id)}
+
+@api_router.post("/admin/customers/segment")
+async def segment_customers(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Queue a recomputation of RFM segments for loyalty campaigns"""
+    verify_token(credentials)
+    job_id = await job_runner.enqueue("rfm_segmentation", priority=JOB_PRIORITY_LOW)
+    return {"message": "Müşteri segmentleri güncelleniyor", "job_id": str(job_id)}
+
+CUSTOMER_LIST_PROJECTION = {
+    "name": 1, "phone": 1, "email": 1, "address": 1, "loyalty_points": 1,
+    "total_bookings": 1, "referral_code": 1, "created_at": 1, "total_spent": 1,
+    "completed_bookings": 1, "last_booking_date": 1, "average_rating": 1, "rfm": 1
+}
+
+@api_router.get("/admin/customers/search")
+async def search_customers(
+    q: Optional[str] = None,
+    segment: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=200),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Search customers by phone prefix or name, newest first.
+
+    Digits match phone prefixes; anything else matches the start of each
+    name word, ignoring case and Turkish diacritics. segment filters by
+    RFM segment. Pass the returned next_cursor back to fetch the following
+    page.
+
+    Only the unfiltered and segment-only listings read in _id order from an
+    index, so their deep pages cost the same as the first. A phone or name
+    prefix is a range scan: every match up to the cursor is read and the
+    page is picked with an in-memory top-k sort on _id, so cost grows with
+    the number of matches (small for a useful search term), not page depth.
+    """
+    verify_token(credentials)
+    
+    query = {"rfm.segment": segment} if segment else {}
+    term = (q or "").strip()
+    if term and re.fullmatch(r"[0-9+ ]+", term):
+        query["phone"] = {"$regex": "^" + re.escape(term.replace(" ", ""))}
+    elif term:
+        tokens = name_search_tokens(term)
+        if tokens:
+            query["$and"] = [{"name_tokens": {"$regex": "^" + re.escape(t)}} for t in tokens]
+    
+    # Keyset pagination on _id, which follows creation order
+    if cursor:
+        if not ObjectId.is_valid(cursor):
+            raise HTTPException(status_code=400, detail="Geçersiz sayfa imleci")
+        query["_id"] = {"$lt": ObjectId(cursor)}
+    
+    customers = await db.customers.find(query, CUSTOMER_LIST_PROJECTION).sort("_id", -1).limit(limit + 1).to_list(limit + 1)
+    next_cursor = str(customers[limit - 1]["_id"]) if len(customers) > limit else None
+    
+    return FastJSONResponse({
+        "customers": [{**c, "_id": str(c["_id"]), "id": str(c["_id"])} for c in customers[:limit]],
+        "next_cursor": next_cursor
+    })
 
 @api_router.get("/admin/reviews")
 async def get_admin_reviews(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get all reviews"""
     verify_token(credentials)
-    reviews = await db.reviews.find().sort("created_at", -1).to_list(1000)
-    return [{**serialize_doc(r), "id": str(r["_id"])} for r in reviews]
+    return streaming_list(db.reviews, sort=[("created_at", -1)])
 
 @api_router.delete("/admin/reviews/{review_id}")
 async def delete_review(review_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Delete a review"""
     verify_token(credentials)
-    result = await db.reviews.delete_one({"_id": ObjectId(review_id)})
-    if result.deleted_count == 0:
+    review = await db.reviews.find_one_and_delete({"_id": ObjectId(review_id)})
+    if not review:
         raise HTTPException(status_code=404, detail="Değerlendirme bulunamadı")
+    await bump_version("reviews")
+    if review.get("customer_phone"):
+        await db.customers.update_one(
+            {"phone": review["customer_phone"]},
+            rating_stats_update(-review.get("rating", 0), -1)
+        )
     return {"message": "Değerlendirme silindi"}
 
 @api_router.post("/admin/packages")
@@ -1158,61 +2396,445 @@ async def create_package(package: PackageCreate, credentials: HTTPAuthorizationC
     package_doc = {
         **package.dict(),
         "active": True,
-        "created_at": datetime.utcnow().isoformat()
+        "created_at": utc_now()
     }
     
     result = await db.packages.insert_one(package_doc)
+    await bump_version("packages")
     
     return {"id": str(result.inserted_id), "message": "Paket oluşturuldu"}
 
+@api_router.post("/admin/packages/schedule")
+async def schedule_package_sessions(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Queue automatic booking of remaining sessions for all subscriptions"""
+    verify_token(credentials)
+    job_id = await job_runner.enqueue("package_scheduling", priority=JOB_PRIORITY_LOW)
+    return {"message": "Paket seansları planlanıyor", "job_id": str(job_id)}
+
 @api_router.get("/admin/packages")
 async def get_admin_packages(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get all packages"""
     verify_token(credentials)
-    packages = await db.packages.find().to_list(100)
-    return [{**serialize_doc(p), "id": str(p["_id"])} for p in packages]
+    packages = await find_serialized(db.packages)
+    return FastJSONResponse(packages)
+
+# ============== EXPORT APIs ==============
+
+# Exportable columns per collection. Photo blobs are deliberately left out;
+# date_field is the field the date_from/date_to filters apply to, and
+# native_dates marks it as a BSON date rather than a YYYY-MM-DD string.
+EXPORT_COLLECTIONS = {
+    "bookings": {
+        "date_field": "booking_date",
+        "archive": "bookings_archive",
+        "columns": [
+            "id", "service_id", "service_name", "customer_name", "customer_phone",
+            "customer_address", "booking_date", "booking_time", "base_price",
+            "total_price", "discount_applied", "discount_details", "payment_method",
+            "status", "created_at"
+        ]
+    },
+    "customers": {
+        "date_field": "created_at",
+        "native_dates": True,
+        "columns": [
+            "id", "name", "phone", "email", "address", "loyalty_points",
+            "total_bookings", "referral_code", "referred_by", "created_at"
+        ]
+    },
+    "reviews": {
+        "date_field": "created_at",
+        "native_dates": True,
+        "columns": [
+            "id", "booking_id", "service_id", "customer_name", "customer_phone",
+            "rating", "comment", "created_at"
+        ]
+    }
+}
+
+def export_row(doc: dict, columns: List[str]) -> dict:
+    row = {}
+    for column in columns:
+        value = doc.get("_id") if column == "id" else doc.get(column)
+        row[column] = str(value) if isinstance(value, ObjectId) else value
+    return row
+
+def csv_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return "; ".join(str(v) for v in value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+async def stream_csv(cursor, columns: List[str], batch_size: int = STREAM_BATCH_SIZE):
+    """Encode a cursor as CSV, one chunk per batch of rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    try:
+        writer.writerow(columns)
+        rows = 0
+        async for doc in cursor:
+            row = export_row(doc, columns)
+            writer.writerow([csv_cell(row[column]) for column in columns])
+            rows += 1
+            if rows >= batch_size:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+                rows = 0
+        yield buffer.getvalue().encode("utf-8")
+    finally:
+        await cursor.close()
+
+async def stream_ndjson(cursor, columns: List[str], batch_size: int = STREAM_BATCH_SIZE):
+    """Encode a cursor as newline-delimited JSON, one chunk per batch of rows"""
+    batch = []
+    try:
+        async for doc in cursor:
+            batch.append(orjson.dumps(export_row(doc, columns), default=_orjson_default))
+            if len(batch) >= batch_size:
+                yield b"\n".join(batch) + b"\n"
+                batch = []
+        if batch:
+            yield b"\n".join(batch) + b"\n"
+    finally:
+        await cursor.close()
+
+@api_router.get("/admin/export/{collection}")
+async def export_collection(
+    collection: str,
+    format: str = "csv",
+    columns: Optional[str] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Export bookings, customers or reviews as CSV or NDJSON"""
+    verify_token(credentials)
+    
+    config = EXPORT_COLLECTIONS.get(collection)
+    if not config:
+        raise HTTPException(status_code=400, detail="Geçersiz koleksiyon")
+    if format not in ["csv", "ndjson"]:
+        raise HTTPException(status_code=400, detail="Format 'csv' veya 'ndjson' olmalıdır")
+    
+    selected = [c.strip() for c in columns.split(",") if c.strip()] if columns else config["columns"]
+    invalid = [c for c in selected if c not in config["columns"]]
+    if invalid or not selected:
+        raise HTTPException(status_code=400, detail=f"Geçersiz sütun: {', '.join(invalid)}")
+    
+    # Dates are local YYYY-MM-DD days and date_to is inclusive; native date
+    # fields are filtered on the UTC range covering those days
+    date_field = config["date_field"]
+    try:
+        day_from = datetime.strptime(date_from, "%Y-%m-%d").date() if date_from else None
+        day_to = datetime.strptime(date_to, "%Y-%m-%d").date() if date_to else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Tarih formatı YYYY-AA-GG olmalıdır")
+    if config.get("native_dates"):
+        date_filter = day_range(day_from, day_to)
+    else:
+        date_filter = {}
+        if day_from:
+            date_filter["$gte"] = day_from.isoformat()
+        if day_to:
+            date_filter["$lt"] = (day_to + timedelta(days=1)).isoformat()
+    query = {date_field: date_filter} if date_filter else {}
+    
+    projection = {c: 1 for c in selected if c != "id"}
+    if "id" not in selected:
+        projection["_id"] = 0
+    if config.get("archive") and projection:
+        projection[date_field] = 1
+    cursor = db[collection].find(query, projection or None, batch_size=STREAM_BATCH_SIZE).sort(date_field, 1)
+    if config.get("archive"):
+        # Both tiers are read in index order and merged, so nothing is sorted in memory
+        cursor = MergedCursor([
+            cursor,
+            db[config["archive"]].find(query, projection or None, batch_size=STREAM_BATCH_SIZE).sort(date_field, 1)
+        ], date_field)
+    
+    if format == "csv":
+        body, media_type = stream_csv(cursor, selected), "text/csv; charset=utf-8"
+    else:
+        body, media_type = stream_ndjson(cursor, selected), "application/x-ndjson"
+    filename = f"{collection}-{datetime.utcnow().strftime('%Y%m%d')}.{format}"
+    return StreamingResponse(body, media_type=media_type, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"'
+    })
 
 # Notification Endpoints
 @api_router.post("/notifications")
 async def create_notification(notification: NotificationCreate):
     """Create a notification"""
-    notif_doc = {
-        "title": notification.title,
-        "message": notification.message,
-        "type": notification.type,
-        "target_id": notification.target_id,
-        "booking_id": notification.booking_id,
-        "read": False,
-        "created_at": datetime.utcnow().isoformat()
-    }
+    notif_doc = notification_doc(
+        notification.title,
+        notification.message,
+        notification.type,
+        notification.target_id,
+        notification.booking_id
+    )
     
-    result = await db.notifications.insert_one(notif_doc)
-    return {"id": str(result.inserted_id), "message": "Bildirim oluşturuldu"}
+    inserted_ids = await insert_notifications([notif_doc])
+    return {"id": str(inserted_ids[0]), "message": "Bildirim oluşturuldu"}
 
 @api_router.get("/admin/notifications")
 async def get_admin_notifications(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get admin notifications"""
     verify_token(credentials)
-    notifications = await db.notifications.find({"type": "admin"}).sort("created_at", -1).to_list(50)
-    return [{**serialize_doc(n), "id": str(n["_id"])} for n in notifications]
+    notifications = await find_serialized(db.notifications, {"type": "admin"}, sort=[("created_at", -1)], limit=50, exclude=NOTIFICATION_INTERNAL_FIELDS)
+    return FastJSONResponse(notifications)
+
+@api_router.get("/admin/notifications/unread-count")
+async def get_admin_unread_count(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Get the number of unread admin notifications"""
+    verify_token(credentials)
+    counter = await db.notification_counters.find_one({"_id": "admin"})
+    return {"unread": max((counter or {}).get("unread", 0), 0)}
+
+@api_router.put("/admin/notifications/read-all")
+async def mark_admin_notifications_read(before: Optional[str] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Mark admin notifications read, up to the notification id in before"""
+    verify_token(credentials)
+    updated = await mark_target_read("admin", before)
+    return {"message": "Bildirimler okundu", "updated": updated}
+
+@api_router.post("/admin/notifications/reconcile-counters")
+async def reconcile_notification_counters_now(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Queue a recount of every target's notification counters"""
+    verify_token(credentials)
+    job_id = await job_runner.enqueue("reconcile_notification_counters", priority=JOB_PRIORITY_LOW)
+    return {"message": "Bildirim sayaçları güncelleniyor", "job_id": str(job_id)}
+
+# Broadcasts are stored once with type "broadcast", no target and a
+# sequence number. Each customer keeps the ids of the broadcasts they have
+# read in read_broadcasts, capped to the most recent MAX_BROADCAST_RECEIPTS,
+# and everything up to broadcast_read_seq counts as read after a read-all.
+MAX_BROADCAST_RECEIPTS = 200
+
+@api_router.post("/admin/notifications/broadcast")
+async def create_broadcast(broadcast: BroadcastCreate, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Send a notification to all customers"""
+    verify_token(credentials)
+    counter = await db.notification_counters.find_one_and_update(
+        {"_id": "broadcast"},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    result = await db.notifications.insert_one({
+        "title": broadcast.title,
+        "message": broadcast.message,
+        "type": "broadcast",
+        "target_id": None,
+        "booking_id": None,
+        "seq": counter["seq"],
+        "created_at": utc_now()
+    })
+    return {"id": str(result.inserted_id), "message": "Duyuru gönderildi"}
 
 @api_router.get("/customer/notifications")
 async def get_customer_notifications(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    """Get customer notifications"""
+    """Get customer notifications, including broadcasts"""
     payload = verify_customer_token(credentials)
     customer_id = payload.get("customer_id")
-    notifications = await db.notifications.find({"type": "customer", "target_id": customer_id}).sort("created_at", -1).to_list(50)
-    return [{**serialize_doc(n), "id": str(n["_id"])} for n in notifications]
+    customer, notifications = await asyncio.gather(
+        db.customers.find_one({"_id": ObjectId(customer_id)}, {"read_broadcasts": 1, "broadcast_read_seq": 1}),
+        find_serialized(db.notifications, {"$or": [
+            {"type": "customer", "target_id": customer_id},
+            {"type": "broadcast", "target_id": None, "seq": {"$exists": True}}
+        ]}, sort=[("created_at", -1)], limit=50, exclude=NOTIFICATION_INTERNAL_FIELDS)
+    )
+    read_broadcasts = {str(b) for b in (customer or {}).get("read_broadcasts", [])}
+    read_seq = (customer or {}).get("broadcast_read_seq", 0)
+    for notification in notifications:
+        if notification["type"] == "broadcast":
+            notification["read"] = notification["id"] in read_broadcasts or notification.get("seq", 0) <= read_seq
+    return FastJSONResponse(notifications)
+
+@api_router.get("/customer/notifications/unread-count")
+async def get_customer_unread_count(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Get the number of unread notifications, including broadcasts"""
+    customer_id = verify_customer_token(credentials)["customer_id"]
+    counter, broadcast_counter, customer = await asyncio.gather(
+        db.notification_counters.find_one({"_id": customer_id}),
+        db.notification_counters.find_one({"_id": "broadcast"}),
+        db.customers.find_one({"_id": ObjectId(customer_id)}, {"broadcasts_read": 1})
+    )
+    unread = max((counter or {}).get("unread", 0), 0)
+    unread_broadcasts = (broadcast_counter or {}).get("seq", 0) - (customer or {}).get("broadcasts_read", 0)
+    return {"unread": unread + max(unread_broadcasts, 0)}
+
+@api_router.put("/customer/notifications/read-all")
+async def mark_customer_notifications_read(before: Optional[str] = None, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Mark notifications and broadcasts read, up to the notification id in before"""
+    customer_id = verify_customer_token(credentials)["customer_id"]
+    updated = await mark_target_read(customer_id, before)
+    
+    broadcast_query = {"type": "broadcast", "target_id": None, "seq": {"$exists": True}}
+    if before:
+        broadcast_query["_id"] = {"$lte": ObjectId(before)}
+    latest, customer = await asyncio.gather(
+        db.notifications.find_one(broadcast_query, {"seq": 1}, sort=[("_id", -1)]),
+        db.customers.find_one({"_id": ObjectId(customer_id)}, {"read_broadcasts": 1, "broadcast_read_seq": 1})
+    )
+    if latest and customer and latest.get("seq", 0) > customer.get("broadcast_read_seq", 0):
+        # Broadcasts after the cursor that were read one by one still count
+        read_after = sum(1 for b in customer.get("read_broadcasts", []) if b > latest["_id"])
+        await db.customers.update_one(
+            {"_id": customer["_id"]},
+            {"$set": {"broadcast_read_seq": latest["seq"], "broadcasts_read": latest["seq"] + read_after}}
+        )
+    return {"message": "Bildirimler okundu", "updated": updated}
 
 @api_router.put("/notifications/{notification_id}/read")
-async def mark_notification_read(notification_id: str):
+async def mark_notification_read(
+    notification_id: str,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
     """Mark notification as read"""
-    await db.notifications.update_one(
-        {"_id": ObjectId(notification_id)},
-        {"$set": {"read": True}}
+    notification = await db.notifications.find_one_and_update(
+        {"_id": ObjectId(notification_id), "type": {"$ne": "broadcast"}, "read": False},
+        {"$set": {"read": True}},
+        projection={"type": 1, "target_id": 1}
     )
+    if notification:
+        await adjust_unread(notification_target_key(notification), -1)
+        return {"message": "Bildirim okundu"}
+    
+    # Broadcasts are marked read per customer
+    broadcast = await db.notifications.find_one({"_id": ObjectId(notification_id), "type": "broadcast"}, {"seq": 1})
+    if broadcast:
+        if not credentials:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        customer_id = verify_customer_token(credentials)["customer_id"]
+        await db.customers.update_one(
+            {
+                "_id": ObjectId(customer_id),
+                "read_broadcasts": {"$ne": broadcast["_id"]},
+                "broadcast_read_seq": {"$not": {"$gte": broadcast.get("seq", 0)}}
+            },
+            {
+                "$push": {"read_broadcasts": {"$each": [broadcast["_id"]], "$slice": -MAX_BROADCAST_RECEIPTS}},
+                "$inc": {"broadcasts_read": 1}
+            }
+        )
     return {"message": "Bildirim okundu"}
 
+@api_router.post("/admin/bookings/archive")
+async def archive_old_bookings(months: int = BOOKING_ARCHIVE_MONTHS, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Queue archiving of completed and cancelled bookings older than months"""
+    verify_token(credentials)
+    if months < 1:
+        raise HTTPException(status_code=400, detail="Ay sayısı en az 1 olmalıdır")
+    job_id = await job_runner.enqueue("archive_bookings", {"months": months}, priority=JOB_PRIORITY_LOW)
+    return {"message": "Eski randevular arşivleniyor", "job_id": str(job_id)}
+
+@api_router.get("/admin/migrations")
+async def get_migrations(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """List schema migrations with their progress"""
+    verify_token(credentials)
+    return FastJSONResponse(await migration_runner.status())
+
+@api_router.post("/admin/migrations/run")
+async def run_migrations(version: Optional[int] = None, dry_run: bool = False, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Queue pending migrations, or a run or dry run of one version"""
+    verify_token(credentials)
+    if version is not None and version not in migration_runner.migrations:
+        raise HTTPException(status_code=404, detail="Migrasyon bulunamadı")
+    if dry_run and version is None:
+        raise HTTPException(status_code=400, detail="Deneme çalıştırması için versiyon gerekli")
+    job_id = await job_runner.enqueue("migrations", {"version": version, "dry_run": dry_run}, priority=JOB_PRIORITY_LOW)
+    return {"message": "Migrasyon kuyruğa alındı", "job_id": str(job_id)}
+
+@api_router.get("/admin/jobs/{job_id}")
+async def get_job(job_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Get the status of a background job"""
+    verify_token(credentials)
+    if not ObjectId.is_valid(job_id):
+        raise HTTPException(status_code=400, detail="Geçersiz iş ID")
+    job = await db.jobs.find_one({"_id": ObjectId(job_id)}, {"payload": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="İş bulunamadı")
+    return {**serialize_doc(job), "id": job["_id"]}
+
+# ============== PUSH DELIVERY APIs ==============
+
+# Only logs messages unless set to "expo", so non-production setups never reach the real gateway
+PUSH_TRANSPORT = os.environ.get('PUSH_TRANSPORT', 'log')  # "expo" or "log"
+PUSH_GATEWAY_URL = os.environ.get('PUSH_GATEWAY_URL')  # defaults to Expo's push API
+
+push_worker = PushDeliveryWorker(db, create_transport(PUSH_TRANSPORT, PUSH_GATEWAY_URL))
+
+async def register_push_token(token: str, target_key: str):
+    await db.push_tokens.update_one(
+        {"token": token},
+        {"$set": {"target_key": target_key, "updated_at": utc_now()}},
+        upsert=True
+    )
+
+@api_router.post("/customer/push-token")
+async def register_customer_push_token(data: PushTokenRegister, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Register a device for customer push notifications"""
+    customer_id = verify_customer_token(credentials)["customer_id"]
+    await register_push_token(data.token, customer_id)
+    return {"message": "Cihaz kaydedildi"}
+
+@api_router.post("/admin/push-token")
+async def register_admin_push_token(data: PushTokenRegister, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Register a device for admin push notifications"""
+    verify_token(credentials)
+    await register_push_token(data.token, "admin")
+    return {"message": "Cihaz kaydedildi"}
+
+@api_router.get("/admin/push/stats")
+async def get_push_stats(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Get push delivery statistics since startup"""
+    verify_token(credentials)
+    pending = await db.notifications.count_documents({"push_status": "pending"})
+    return {
+        **push_worker.stats,
+        "pending": pending,
+        "deliveries_per_second": round(push_worker.deliveries_per_second(), 1)
+    }
+
+# ============== REQUEST PROFILING ==============
+
+# Admins profile a single request by sending "X-Profile: 1" (see
+# profiling.py). Profiles are kept for PROFILE_RETENTION_DAYS; the folded
+# stacks load directly into flamegraph.pl or speedscope.
+PROFILE_RETENTION_DAYS = int(os.environ.get('PROFILE_RETENTION_DAYS', 7))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 1))
+
+def is_admin_token(token: str) -> bool:
+    try:
+        return bool(jwt.decode(token, JWT_SECRET, algorithms=["HS256"]).get("admin_id"))
+    except Exception:
+        return False
+
+async def store_profile(profile: dict):
+    await db.profiles.insert_one({**profile, "expire_at": utc_now() + timedelta(days=PROFILE_RETENTION_DAYS)})
+
+@api_router.get("/admin/profiles")
+async def get_profiles(limit: int = 50, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """List recent request profiles, without their stacks"""
+    verify_token(credentials)
+    profiles = await find_serialized(db.profiles, sort=[("started_at", -1)], limit=min(limit, 200), exclude=["folded", "expire_at"])
+    return FastJSONResponse(profiles)
+
+@api_router.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, format: str = "json", credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Get a request profile; format=folded returns the flame graph stacks as text"""
+    verify_token(credentials)
+    profile = await db.profiles.find_one({"_id": profile_id}, {"expire_at": 0})
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profil bulunamadı")
+    if format == "folded":
+        return Response(profile["folded"] + "\n", media_type="text/plain; charset=utf-8")
+    return FastJSONResponse({**profile, "id": profile["_id"]})
+
 # Include router
 app.include_router(api_router)
 
@@ -1222,15 +2844,123 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-DB-Calls", "X-DB-Time-Ms", "X-Profile-Id"],
+)
+
+# ============== METRICS ==============
+
+# Prometheus scrape endpoint (see metrics.py), outside /api. When
+# METRICS_TOKEN is set, scrapes must send "Authorization: Bearer <token>".
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+http_metrics = HTTPMetrics(REGISTRY)
+# Added first so it runs inside MetricsMiddleware and sees the request context
+app.add_middleware(
+    ProfilingMiddleware,
+    authorize=is_admin_token,
+    store=store_profile,
+    pending=command_metrics.pending,
+    interval=PROFILE_INTERVAL_MS / 1000
+)
+# One JSON access line per request; LOG_RATE_LIMITS caps the lines per second
+# of high-volume routes as "route=rate,..." (server errors are always logged)
+access_log = AccessLog(parse_rate_limits(os.environ.get('LOG_RATE_LIMITS', '/api/location/update=1')))
+app.add_middleware(MetricsMiddleware, metrics=http_metrics, on_finish=access_log)
+
+# Event loop lag, and the stack of any callback holding the loop for longer
+# than BLOCKING_THRESHOLD_MS (see loopmonitor.py)
+loop_monitor = LoopMonitor(
+    REGISTRY,
+    interval=float(os.environ.get('LOOP_MONITOR_INTERVAL', 0.05)),
+    threshold=float(os.environ.get('BLOCKING_THRESHOLD_MS', 100)) / 1000
 )
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(request: Request):
+    """Prometheus text exposition of the app metrics"""
+    if METRICS_TOKEN and not secrets.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+# Configure logging: records are queued and written as JSON lines (or the
+# old text format with LOG_FORMAT=text) by a background thread, see jsonlog.py
+log_listener = configure_logging(
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    format=os.environ.get('LOG_FORMAT', 'json'),
+    queue_size=int(os.environ.get('LOG_QUEUE_SIZE', 10000))
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    # Sort keys of the streamed admin lists and exports, so they are read in index order
+    await db.bookings.create_index("created_at")
+    await db.bookings.create_index("booking_date")
+    await db.customers.create_index("created_at")
+    await db.reviews.create_index("created_at")
+    # Customer search: phone prefix and per-word name prefix. Prefixes are
+    # ranges, so _id order comes from a sort of the matches, not these indexes
+    await db.customers.create_index("phone")
+    await db.customers.create_index([("name_tokens", 1), ("_id", -1)])
+    # Slot capacity: counters for availability documents created before them
+    await db.availability.create_index("date")
+    await backfill_slot_reservations()
+    # Waitlist: oldest waiting entry per slot, one live entry per customer and slot
+    await db.waitlist.create_index([("booking_date", 1), ("booking_time", 1), ("status", 1), ("created_at", 1)])
+    await db.waitlist.create_index(
+        [("booking_date", 1), ("booking_time", 1), ("customer_phone", 1)],
+        unique=True, partialFilterExpression={"status": "waiting"}
+    )
+    await db.waitlist.create_index("customer_phone")
+    await db.waitlist.create_index("expire_at", expireAfterSeconds=0)
+    # Archive: terminal bookings by date in the hot tier, history and exports in the archive
+    await db.bookings.create_index([("status", 1), ("booking_date", 1)])
+    await db[BOOKING_ARCHIVE].create_index([("customer_phone", 1), ("booking_date", -1)])
+    await db[BOOKING_ARCHIVE].create_index("created_at")
+    await db[BOOKING_ARCHIVE].create_index("booking_date")
+    # Customer stats: latest booking per customer, reconciliation lookups
+    await db.bookings.create_index([("customer_phone", 1), ("booking_date", -1)])
+    await db.reviews.create_index("customer_phone")
+    await db.customers.create_index([("rfm.segment", 1), ("_id", -1)])
+    # Notification lists: targeted and broadcast branches are both equality on type/target_id
+    await db.notifications.create_index([("type", 1), ("target_id", 1), ("created_at", -1)])
+    # Retention: documents are removed once expire_at has passed
+    await db.notifications.create_index("expire_at", expireAfterSeconds=0)
+    # Push delivery: due pending notifications, device tokens per target
+    await db.notifications.create_index([("push_status", 1), ("push_next_attempt_at", 1)])
+    await db.push_tokens.create_index("token", unique=True)
+    await db.push_tokens.create_index("target_key")
+    # Reminders: range scan over upcoming bookings' UTC start, one reminder per booking
+    await db.bookings.create_index([("starts_at", 1), ("status", 1)])
+    await db.notifications.create_index(
+        "dedup_key", unique=True, partialFilterExpression={"dedup_key": {"$exists": True}}
+    )
+    # Package redemption: a customer's usable subscriptions for one package
+    await db.subscriptions.create_index([("customer_phone", 1), ("package_id", 1), ("status", 1), ("created_at", 1)])
+    await db.subscriptions.create_index("schedule_run")
+    # Request profiles: newest first, removed after PROFILE_RETENTION_DAYS
+    await db.profiles.create_index("started_at")
+    await db.profiles.create_index("expire_at", expireAfterSeconds=0)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    loop_monitor.start()
+    await job_runner.start()
+    await job_runner.enqueue("migrations", priority=JOB_PRIORITY_LOW)
+    app.state.background_tasks = [
+        asyncio.create_task(run_nightly("reconcile_customer_stats", CUSTOMER_STATS_RECONCILE_HOUR)),
+        asyncio.create_task(periodic_notification_retention()),
+        asyncio.create_task(run_nightly("reconcile_notification_counters", NOTIFICATION_RECONCILE_HOUR)),
+        asyncio.create_task(push_worker.run()),
+        asyncio.create_task(periodic_booking_reminders()),
+        asyncio.create_task(run_nightly("archive_bookings", BOOKING_ARCHIVE_HOUR))
+    ]
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in getattr(app.state, "background_tasks", []):
+        task.cancel()
+    loop_monitor.stop()
+    await job_runner.drain()
+    await push_worker.transport.close()
     client.close()
+    log_listener.stop()
@@ -0,0 +1,1384 @@
+"""
+Test file for TİTAN 360 cleaning app - Performance Features
+Tests:
+1. ETag / conditional GET on public catalog endpoints
+2. Streaming CSV/NDJSON admin export
+3. Bulk booking status updates
+4. Admin customer search with keyset pagination
+5. Notification unread counters and bulk mark-read
+6. Persistent background jobs
+7. Package session redemption on booking
+8. Package session auto-scheduling
+9. Multi-crew slot capacity
+10. Slot waitlist notified on cancellation
+11. Booking archive tier
+12. Schema migrations
+13. Native date timestamps
+14. Prometheus metrics endpoint
+15. MongoDB command monitoring
+16. On-demand request profiling
+17. Event loop lag monitor
+18. Structured request logging
+19. Push delivery worker (local: MongoDB at MONGO_URL and the fake push gateway)
+20. Incremental customer stats match reconciliation
+21. Broadcast notifications and per-customer read receipts
+22. Booking reminders sent once (local: MongoDB at MONGO_URL)
+23. List response shape and streamed JSON arrays
+24. Bulk status changes racing single ones (local: MongoDB at MONGO_URL)
+25. Notification trimming and expiry backfill (local: MongoDB at MONGO_URL)
+"""
+
+import pytest
+import requests
+import json
+import os
+import sys
+import time
+import asyncio
+from datetime import datetime, timedelta
+
+import httpx
+from motor.motor_asyncio import AsyncIOMotorClient
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, "benchmarks"))
+
+from push import ExpoPushTransport, PushDeliveryWorker  # noqa: E402
+from fake_push_server import create_app as create_push_gateway  # noqa: E402
+
+BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', 'https://build-preview-apk.preview.emergentagent.com')
+# /metrics is served outside /api, so it may need a direct backend address
+METRICS_URL = os.environ.get('METRICS_URL', f"{BASE_URL}/metrics")
+# Scratch database for tests that drive backend components directly
+LOCAL_MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+LOCAL_TEST_DB = os.environ.get('LOCAL_TEST_DB_NAME', 'titan_local_test')
+
+
+@pytest.fixture(scope="module")
+def admin_token():
+    """Get admin token"""
+    requests.post(f"{BASE_URL}/api/admin/init")
+    response = requests.post(f"{BASE_URL}/api/admin/login", json={
+        "username": "admin",
+        "password": "admin123"
+    })
+    if response.status_code == 200:
+        return response.json()["token"]
+    pytest.skip("Admin login failed - skipping authenticated tests")
+
+
+class TestConditionalGet:
+    """ETag / If-None-Match support on catalog endpoints"""
+    
+    @pytest.mark.parametrize("path", [
+        "/api/services",
+        "/api/packages",
+        "/api/reviews/stats",
+        "/api/availability?year=2026&month=1",
+    ])
+    def test_matching_etag_returns_304(self, path):
+        """A repeated request with the returned ETag gets 304 and no body"""
+        response = requests.get(f"{BASE_URL}{path}")
+        assert response.status_code == 200
+        etag = response.headers.get("ETag")
+        assert etag and etag.startswith('"'), "Strong ETag missing"
+        
+        response = requests.get(f"{BASE_URL}{path}", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers.get("ETag") == etag
+    
+    def test_availability_etag_differs_per_month(self):
+        """Different months must not share an ETag"""
+        jan = requests.get(f"{BASE_URL}/api/availability?year=2026&month=1").headers["ETag"]
+        feb = requests.get(f"{BASE_URL}/api/availability?year=2026&month=2").headers["ETag"]
+        assert jan != feb
+    
+    def test_admin_write_invalidates_etag(self, admin_token):
+        """Creating a service changes the services ETag"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        etag = requests.get(f"{BASE_URL}/api/services").headers["ETag"]
+        
+        created = requests.post(f"{BASE_URL}/api/admin/services", headers=headers, json={
+            "name": f"TEST_ETag_{int(time.time())}",
+            "description": "ETag test service",
+            "price": 100,
+            "active": False
+        })
+        assert created.status_code == 200
+        
+        response = requests.get(f"{BASE_URL}/api/services", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        
+        requests.delete(f"{BASE_URL}/api/admin/services/{created.json()['id']}", headers=headers)
+
+    def test_version_shared_between_workers(self):
+        """A write seen only through MongoDB, as from another worker, changes the ETag (local)"""
+        import server
+        from starlette.requests import Request
+        from starlette.responses import Response
+
+        def request(etag=None):
+            headers = [(b"if-none-match", etag.encode())] if etag else []
+            return Request({"type": "http", "method": "GET", "path": "/api/services", "headers": headers})
+
+        async def scenario(db):
+            live_db, server.db = server.db, db
+            try:
+                response = Response()
+                assert await server.conditional_get(request(), response, "services") is None
+                etag = response.headers["ETag"]
+                assert (await server.conditional_get(request(etag), Response(), "services")).status_code == 304
+                # Another worker's bump only reaches this one through the database
+                await db.catalog_versions.update_one({"_id": "services"}, {"$set": {"version": "other-worker"}}, upsert=True)
+                assert await server.conditional_get(request(etag), Response(), "services") is None
+            finally:
+                server.db = live_db
+        run_on_scratch_db(scenario)
+
+
+class TestAdminExport:
+    """Streaming CSV/NDJSON export"""
+    
+    def test_export_bookings_csv(self, admin_token):
+        """CSV export starts with the requested header row"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/export/bookings",
+            headers={"Authorization": f"Bearer {admin_token}"},
+            params={"columns": "id,customer_name,booking_date,total_price"}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        assert response.text.splitlines()[0] == "id,customer_name,booking_date,total_price"
+    
+    def test_export_customers_ndjson(self, admin_token):
+        """Each NDJSON line is an object with exactly the requested columns"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/export/customers",
+            headers={"Authorization": f"Bearer {admin_token}"},
+            params={"format": "ndjson", "columns": "id,phone"}
+        )
+        assert response.status_code == 200
+        for line in response.text.splitlines()[:20]:
+            row = json.loads(line)
+            assert set(row.keys()) == {"id", "phone"}
+    
+    def test_export_rejects_photo_columns(self, admin_token):
+        """Photo blobs are not exportable"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/export/bookings",
+            headers={"Authorization": f"Bearer {admin_token}"},
+            params={"columns": "id,customer_photos"}
+        )
+        assert response.status_code == 400
+    
+    def test_export_unknown_collection(self, admin_token):
+        """Only bookings, customers and reviews can be exported"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/export/admins",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 400
+    
+    def test_export_requires_auth(self):
+        """Export is admin-only"""
+        response = requests.get(f"{BASE_URL}/api/admin/export/bookings")
+        assert response.status_code in [401, 403]
+
+
+class TestBulkBookingStatus:
+    """Bulk admin booking status changes"""
+    
+    def test_bulk_status_per_id_results(self, admin_token):
+        """Unknown and malformed ids are reported, not fatal"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        bookings = requests.get(f"{BASE_URL}/api/admin/bookings", headers=headers).json()
+        pending = [b["id"] for b in bookings if b["status"] == "pending"][:2]
+        
+        response = requests.post(f"{BASE_URL}/api/admin/bookings/bulk-status", headers=headers, json={
+            "booking_ids": pending + ["invalid-id", "000000000000000000000000"],
+            "status": "confirmed"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["updated"] == len(pending)
+        results = {r["id"]: r["result"] for r in data["results"]}
+        assert results["invalid-id"] == "invalid_id"
+        assert results["000000000000000000000000"] == "not_found"
+        for booking_id in pending:
+            assert results[booking_id] == "updated"
+        
+        # Revert
+        if pending:
+            requests.post(f"{BASE_URL}/api/admin/bookings/bulk-status", headers=headers, json={
+                "booking_ids": pending,
+                "status": "pending"
+            })
+
+
+class TestCustomerSearch:
+    """Server-side customer search"""
+    
+    @pytest.fixture(scope="class")
+    def search_customer(self):
+        """Register a customer with a Turkish name"""
+        phone = f"0599{int(time.time()) % 10000000:07d}"
+        response = requests.post(f"{BASE_URL}/api/customers/register", json={
+            "name": "TEST Şükrü Işıktaş",
+            "phone": phone
+        })
+        assert response.status_code == 200
+        return response.json()
+    
+    def test_search_by_phone_prefix(self, admin_token, search_customer):
+        """Phone digits match by prefix"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/customers/search",
+            headers={"Authorization": f"Bearer {admin_token}"},
+            params={"q": search_customer["phone"][:9]}
+        )
+        assert response.status_code == 200
+        phones = [c["phone"] for c in response.json()["customers"]]
+        assert all(p.startswith(search_customer["phone"][:9]) for p in phones)
+    
+    def test_search_by_name_ignores_case_and_diacritics(self, admin_token, search_customer):
+        """'sukru isik' finds 'Şükrü Işıktaş'"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/customers/search",
+            headers={"Authorization": f"Bearer {admin_token}"},
+            params={"q": "sukru isik"}
+        )
+        assert response.status_code == 200
+        ids = [c["id"] for c in response.json()["customers"]]
+        assert search_customer["id"] in ids
+    
+    def test_keyset_pagination(self, admin_token):
+        """Consecutive pages do not overlap"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        first = requests.get(f"{BASE_URL}/api/admin/customers/search", headers=headers, params={"limit": 2}).json()
+        assert len(first["customers"]) <= 2
+        if first["next_cursor"]:
+            second = requests.get(
+                f"{BASE_URL}/api/admin/customers/search",
+                headers=headers,
+                params={"limit": 2, "cursor": first["next_cursor"]}
+            ).json()
+            first_ids = {c["id"] for c in first["customers"]}
+            assert not first_ids & {c["id"] for c in second["customers"]}
+
+
+class TestNotificationCounters:
+    """Unread counters and read-all"""
+    
+    @pytest.fixture(scope="class")
+    def customer(self):
+        """Register a fresh customer"""
+        response = requests.post(f"{BASE_URL}/api/customers/register", json={
+            "name": "TEST Bildirim",
+            "phone": f"TEST_N_{int(time.time())}"
+        })
+        assert response.status_code == 200
+        return response.json()
+    
+    def test_unread_count_and_read_all(self, customer):
+        """Counter follows new notifications and drops to zero on read-all"""
+        headers = {"Authorization": f"Bearer {customer['token']}"}
+        before = requests.get(f"{BASE_URL}/api/customer/notifications/unread-count", headers=headers).json()["unread"]
+        
+        for i in range(2):
+            requests.post(f"{BASE_URL}/api/notifications", json={
+                "title": f"TEST {i}",
+                "message": "Sayaç testi",
+                "type": "customer",
+                "target_id": customer["id"]
+            })
+        after = requests.get(f"{BASE_URL}/api/customer/notifications/unread-count", headers=headers).json()["unread"]
+        assert after == before + 2
+        
+        response = requests.put(f"{BASE_URL}/api/customer/notifications/read-all", headers=headers)
+        assert response.status_code == 200
+        assert requests.get(f"{BASE_URL}/api/customer/notifications/unread-count", headers=headers).json()["unread"] == 0
+    
+    def test_admin_unread_count(self, admin_token):
+        """Admin badge count is available without listing notifications"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/notifications/unread-count",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        assert response.json()["unread"] >= 0
+    
+    def test_reconcile_keeps_counts(self, admin_token, customer):
+        """The on-demand recount agrees with the incrementally kept badge"""
+        headers = {"Authorization": f"Bearer {customer['token']}"}
+        requests.post(f"{BASE_URL}/api/notifications", json={
+            "title": "TEST Sayım", "message": "Sayaç testi", "type": "customer", "target_id": customer["id"]
+        })
+        before = requests.get(f"{BASE_URL}/api/customer/notifications/unread-count", headers=headers).json()["unread"]
+        run_admin_job({"Authorization": f"Bearer {admin_token}"}, "/api/admin/notifications/reconcile-counters")
+        assert requests.get(f"{BASE_URL}/api/customer/notifications/unread-count", headers=headers).json()["unread"] == before
+
+
+class TestBackgroundJobs:
+    """Slow admin actions run as persistent background jobs"""
+    
+    def test_reconcile_runs_as_job(self, admin_token):
+        """Reconcile returns a job id that reaches the done state"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        response = requests.post(f"{BASE_URL}/api/admin/customers/reconcile-stats", headers=headers)
+        assert response.status_code == 200
+        job_id = response.json()["job_id"]
+        
+        status = None
+        for _ in range(20):
+            status = requests.get(f"{BASE_URL}/api/admin/jobs/{job_id}", headers=headers).json()["status"]
+            if status in ("done", "failed"):
+                break
+            time.sleep(0.5)
+        assert status == "done"
+    
+    def test_unknown_job(self, admin_token):
+        """Unknown job ids return 404"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/jobs/000000000000000000000000",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 404
+
+    def test_running_job_keeps_its_lease(self):
+        """A job that outlives lease_timeout is not claimed by a second runner (local)"""
+        from jobs import JobRunner
+
+        async def scenario(db):
+            runs = []
+            runners = [JobRunner(db, concurrency=1, poll_interval=0.05, lease_timeout=0.3) for _ in range(2)]
+            for runner in runners:
+                @runner.task("slow")
+                async def slow():
+                    runs.append(1)
+                    await asyncio.sleep(1.0)
+            job_id = await runners[0].enqueue("slow")
+            for runner in runners:
+                await runner.start()
+            try:
+                for _ in range(60):
+                    job = await db.jobs.find_one({"_id": job_id})
+                    if job["status"] == "done":
+                        break
+                    await asyncio.sleep(0.05)
+            finally:
+                for runner in runners:
+                    await runner.drain(timeout=2)
+            assert job["status"] == "done"
+            assert len(runs) == 1 and job["attempts"] == 1
+        run_on_scratch_db(scenario)
+
+    def test_keyed_job_enqueued_once(self):
+        """Processes enqueuing the same nightly job key create one job (local)"""
+        from jobs import JobRunner
+
+        async def scenario(db):
+            runners = [JobRunner(db) for _ in range(2)]
+            for runner in runners:
+                runner.task("nightly")(asyncio.sleep)
+            await db.jobs.create_index("key", unique=True, partialFilterExpression={"key": {"$exists": True}})
+            ids = [await runner.enqueue("nightly", {"delay": 0}, key="nightly:2031-01-01") for runner in runners]
+            assert ids[0] is not None and ids[1] is None
+            assert await db.jobs.count_documents({"name": "nightly"}) == 1
+        run_on_scratch_db(scenario)
+
+    def test_job_fails_after_lease_expires_too_often(self):
+        """A job whose worker died on its last attempt is failed, not rerun (local)"""
+        from jobs import JobRunner
+
+        async def scenario(db):
+            runs = []
+            runner = JobRunner(db, max_attempts=2)
+
+            @runner.task("crashes")
+            async def crashes():
+                runs.append(1)
+            now = datetime.utcnow()
+            result = await db.jobs.insert_one({
+                "name": "crashes", "payload": {}, "priority": 0, "status": "running",
+                "attempts": 2, "max_attempts": 2, "run_at": now, "created_at": now,
+                "started_at": now - timedelta(hours=1), "lease_until": now - timedelta(minutes=1)
+            })
+            job = await runner.claim()
+            assert job["_id"] == result.inserted_id
+            await runner.execute(job)
+            assert runs == []
+            assert (await db.jobs.find_one({"_id": result.inserted_id}))["status"] == "failed"
+        run_on_scratch_db(scenario)
+
+    def test_retried_status_change_counts_once(self):
+        """Running a booking_status_changed job twice adds to the totals once (local)"""
+        import server
+
+        async def scenario(db):
+            live_db, server.db = server.db, db
+            try:
+                await db.customers.insert_one({"name": "TEST İş", "phone": "TEST_J", "total_spent": 0, "completed_bookings": 0})
+                booking = {
+                    "_id": "TEST_J_1", "customer_phone": "TEST_J", "booking_date": "2031-01-01",
+                    "total_price": 300.0, "status": "confirmed"
+                }
+                await db.bookings.insert_one(dict(booking, status="completed"))
+                for _ in range(2):
+                    await server.booking_status_changed_job(booking, "completed", "event-1")
+                customer = await db.customers.find_one({"phone": "TEST_J"})
+                assert customer["total_spent"] == 300.0
+                assert customer["completed_bookings"] == 1
+            finally:
+                server.db = live_db
+        run_on_scratch_db(scenario)
+
+
+class TestPackageRedemption:
+    """Package bookings consume subscription sessions"""
+    
+    def subscribe(self, headers, dates):
+        """A customer with a one-session package and open slots on dates"""
+        suffix = int(time.time() * 1000)
+        service_id = requests.post(f"{BASE_URL}/api/admin/services", json={
+            "name": f"TEST Paket Hizmeti {suffix}", "description": "test", "price": 100
+        }, headers=headers).json()["id"]
+        package_id = requests.post(f"{BASE_URL}/api/admin/packages", json={
+            "name": f"TEST Paket {suffix}", "description": "test", "service_id": service_id,
+            "frequency": "weekly", "discount_percent": 20, "total_sessions": 1, "price": 80
+        }, headers=headers).json()["id"]
+        phone = f"TEST_P_{suffix}"
+        requests.post(f"{BASE_URL}/api/customers/register", json={"name": "TEST Paket", "phone": phone})
+        requests.post(f"{BASE_URL}/api/packages/subscribe", params={
+            "customer_phone": phone, "package_id": package_id, "auto_schedule": False
+        })
+        
+        slot = f"{suffix % 24:02d}:00"
+        for date in dates:
+            requests.post(f"{BASE_URL}/api/admin/availability", json={
+                "date": date, "available": True, "time_slots": [slot]
+            }, headers=headers)
+        
+        def book(date):
+            return requests.post(f"{BASE_URL}/api/bookings", json={
+                "service_id": service_id, "customer_name": "TEST Paket", "customer_phone": phone,
+                "customer_address": "test", "booking_date": date, "booking_time": slot,
+                "payment_method": "cash", "package_id": package_id
+            })
+        return phone, book
+    
+    def test_sessions_cannot_be_overdrawn(self, admin_token):
+        """A one-session package pays for exactly one booking"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        dates = ["2030-01-07", "2030-01-08"]
+        phone, book = self.subscribe(headers, dates)
+        
+        responses = [book(date) for date in dates]
+        assert responses[0].status_code == 200
+        assert responses[0].json()["total_price"] == 80
+        assert responses[0].json()["sessions_remaining"] == 0
+        assert responses[1].status_code == 400
+    
+    def test_reactivation_takes_session_again(self, admin_token):
+        """A cancelled package booking can only be reactivated with a session to spare"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        dates = ["2030-02-04", "2030-02-05"]
+        phone, book = self.subscribe(headers, dates)
+        
+        def sessions_remaining():
+            subscriptions = requests.get(f"{BASE_URL}/api/packages/my-subscriptions", params={"phone": phone}).json()
+            return sum(s["sessions_remaining"] for s in subscriptions)
+        
+        def set_status(booking_id, status):
+            return requests.put(f"{BASE_URL}/api/admin/bookings/{booking_id}", json={"status": status}, headers=headers)
+        
+        first = book(dates[0]).json()["id"]
+        assert set_status(first, "cancelled").status_code == 200
+        assert wait_until(lambda: sessions_remaining() == 1)
+        second = book(dates[1]).json()["id"]
+        
+        # The session went to the second booking
+        assert set_status(first, "pending").status_code == 400
+        bulk = requests.post(f"{BASE_URL}/api/admin/bookings/bulk-status", json={
+            "booking_ids": [first], "status": "pending"
+        }, headers=headers).json()
+        assert bulk["results"] == [{"id": first, "result": "no_sessions"}]
+        assert set_status(second, "cancelled").status_code == 200
+        assert wait_until(lambda: sessions_remaining() == 1)
+        assert set_status(first, "pending").status_code == 200
+        assert sessions_remaining() == 0
+
+
+class TestPackageScheduling:
+    """Subscribing books the package's sessions in advance"""
+    
+    def test_subscribe_schedules_weekly_sessions(self, admin_token):
+        """Sessions land one week apart at the preferred time"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        suffix = int(time.time())
+        service_id = requests.post(f"{BASE_URL}/api/admin/services", json={
+            "name": f"TEST Plan Hizmeti {suffix}", "description": "test", "price": 100
+        }, headers=headers).json()["id"]
+        package_id = requests.post(f"{BASE_URL}/api/admin/packages", json={
+            "name": f"TEST Plan {suffix}", "description": "test", "service_id": service_id,
+            "frequency": "weekly", "discount_percent": 10, "total_sessions": 3, "price": 270
+        }, headers=headers).json()["id"]
+        preferred = f"{suffix % 24:02d}:15"
+        for day in range(5, 26):
+            requests.post(f"{BASE_URL}/api/admin/availability", json={
+                "date": f"2031-03-{day:02d}", "available": True, "time_slots": [preferred]
+            }, headers=headers)
+        phone = f"TEST_S_{suffix}"
+        requests.post(f"{BASE_URL}/api/customers/register", json={"name": "TEST Plan", "phone": phone})
+        
+        response = requests.post(f"{BASE_URL}/api/packages/subscribe", params={
+            "customer_phone": phone, "package_id": package_id,
+            "start_date": "2031-03-05", "preferred_time": preferred
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["sessions_remaining"] == 0
+        assert [s["booking_time"] for s in data["scheduled_sessions"]] == [preferred] * 3
+        dates = [s["booking_date"] for s in data["scheduled_sessions"]]
+        assert dates == sorted(dates) and len(set(dates)) == 3
+    
+    def test_malformed_start_or_time_rejected(self, admin_token):
+        """Bad dates and times are refused before a subscription is stored"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        suffix = int(time.time())
+        service_id = requests.post(f"{BASE_URL}/api/admin/services", json={
+            "name": f"TEST Hatalı Plan Hizmeti {suffix}", "description": "test", "price": 100
+        }, headers=headers).json()["id"]
+        package_id = requests.post(f"{BASE_URL}/api/admin/packages", json={
+            "name": f"TEST Hatalı Plan {suffix}", "description": "test", "service_id": service_id,
+            "frequency": "weekly", "discount_percent": 0, "total_sessions": 2, "price": 200
+        }, headers=headers).json()["id"]
+        phone = f"TEST_SV_{suffix}"
+        requests.post(f"{BASE_URL}/api/customers/register", json={"name": "TEST Plan", "phone": phone})
+        
+        for start_date, preferred in (("05.03.2031", "10:00"), ("2031-02-30", "10:00"), ("2031-03-05", "25:00"), ("2031-03-05", "9")):
+            response = requests.post(f"{BASE_URL}/api/packages/subscribe", params={
+                "customer_phone": phone, "package_id": package_id,
+                "start_date": start_date, "preferred_time": preferred
+            })
+            assert response.status_code == 400
+        assert requests.get(f"{BASE_URL}/api/packages/my-subscriptions", params={"phone": phone}).json() == []
+
+
+class TestSlotCapacity:
+    """Slots hold as many bookings as there are crews"""
+    
+    def test_capacity_and_release(self, admin_token):
+        """Bookings fill a two-crew slot; a cancellation frees one place"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        suffix = int(time.time())
+        service_id = requests.post(f"{BASE_URL}/api/admin/services", json={
+            "name": f"TEST Ekip Hizmeti {suffix}", "description": "test", "price": 100
+        }, headers=headers).json()["id"]
+        date = f"2032-{suffix % 12 + 1:02d}-{suffix % 28 + 1:02d}"
+        slot = f"{suffix % 24:02d}:45"
+        requests.post(f"{BASE_URL}/api/admin/availability", json={
+            "date": date, "available": True, "time_slots": [slot], "capacity": 2
+        }, headers=headers)
+        
+        responses = []
+        for i in range(3):
+            phone = f"TEST_C_{suffix}_{i}"
+            requests.post(f"{BASE_URL}/api/customers/register", json={"name": "TEST Ekip", "phone": phone})
+            responses.append(requests.post(f"{BASE_URL}/api/bookings", json={
+                "service_id": service_id, "customer_name": "TEST Ekip", "customer_phone": phone,
+                "customer_address": "test", "booking_date": date, "booking_time": slot, "payment_method": "cash"
+            }))
+        assert [r.status_code for r in responses] == [200, 200, 400]
+        slots = requests.get(f"{BASE_URL}/api/availability/slots", params={"date": date}).json()
+        assert slots["remaining"][slot] == 0
+        
+        requests.put(f"{BASE_URL}/api/bookings/{responses[0].json()['id']}/cancel", params={"phone": f"TEST_C_{suffix}_0"})
+        slots = requests.get(f"{BASE_URL}/api/availability/slots", params={"date": date}).json()
+        assert slots["remaining"][slot] == 1
+
+
+class TestWaitlist:
+    """Full slots have a waitlist served on cancellation"""
+    
+    def test_cancellation_notifies_next_customer(self, admin_token):
+        """The first waiting customer is notified when the slot frees up"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        suffix = int(time.time())
+        service_id = requests.post(f"{BASE_URL}/api/admin/services", json={
+            "name": f"TEST Bekleme Hizmeti {suffix}", "description": "test", "price": 100
+        }, headers=headers).json()["id"]
+        date = f"2033-{suffix % 12 + 1:02d}-{suffix % 28 + 1:02d}"
+        slot = f"{suffix % 24:02d}:50"
+        requests.post(f"{BASE_URL}/api/admin/availability", json={
+            "date": date, "available": True, "time_slots": [slot]
+        }, headers=headers)
+        customers = []
+        for i in range(2):
+            phone = f"TEST_W_{suffix}_{i}"
+            customers.append(requests.post(f"{BASE_URL}/api/customers/register", json={"name": "TEST Bekleme", "phone": phone}).json())
+        
+        booking = requests.post(f"{BASE_URL}/api/bookings", json={
+            "service_id": service_id, "customer_name": "TEST Bekleme", "customer_phone": f"TEST_W_{suffix}_0",
+            "customer_address": "test", "booking_date": date, "booking_time": slot, "payment_method": "cash"
+        }).json()
+        response = requests.post(f"{BASE_URL}/api/waitlist", json={
+            "booking_date": date, "booking_time": slot, "customer_phone": f"TEST_W_{suffix}_1"
+        })
+        assert response.status_code == 200
+        assert response.json()["position"] == 1
+        
+        requests.put(f"{BASE_URL}/api/bookings/{booking['id']}/cancel", params={"phone": f"TEST_W_{suffix}_0"})
+        entries = requests.get(f"{BASE_URL}/api/waitlist", params={"phone": f"TEST_W_{suffix}_1"}).json()
+        assert entries[0]["status"] == "notified"
+        notifications = requests.get(
+            f"{BASE_URL}/api/customer/notifications",
+            headers={"Authorization": f"Bearer {customers[1]['token']}"}
+        ).json()
+        assert any(n["title"] == "Beklediğiniz saat açıldı" for n in notifications)
+
+
+class TestBookingArchive:
+    """Old terminal bookings move to the archive without changing totals"""
+    
+    def test_archive_keeps_dashboard_totals(self, admin_token):
+        """Archiving does not change the dashboard booking totals"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        before = requests.get(f"{BASE_URL}/api/admin/stats", headers=headers).json()
+        
+        response = requests.post(f"{BASE_URL}/api/admin/bookings/archive", params={"months": 12}, headers=headers)
+        assert response.status_code == 200
+        job_id = response.json()["job_id"]
+        status = None
+        for _ in range(40):
+            status = requests.get(f"{BASE_URL}/api/admin/jobs/{job_id}", headers=headers).json()["status"]
+            if status in ("done", "failed"):
+                break
+            time.sleep(0.5)
+        assert status == "done"
+        
+        after = requests.get(f"{BASE_URL}/api/admin/stats", headers=headers).json()
+        assert after["total_bookings"] >= before["total_bookings"]
+        assert after["completed_bookings"] >= before["completed_bookings"]
+    
+    def test_archive_rejects_zero_months(self, admin_token):
+        """Archiving needs at least one month of hot history"""
+        response = requests.post(
+            f"{BASE_URL}/api/admin/bookings/archive",
+            params={"months": 0},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 400
+
+
+class TestMigrations:
+    """Versioned schema migrations with status and dry runs"""
+    
+    def test_list_migrations(self, admin_token):
+        """Registered migrations are listed in version order with a status"""
+        response = requests.get(f"{BASE_URL}/api/admin/migrations", headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 200
+        migrations = response.json()
+        assert [m["version"] for m in migrations] == sorted(m["version"] for m in migrations)
+        assert all(m["status"] in ("pending", "running", "applied", "failed") for m in migrations)
+    
+    def test_dry_run_and_unknown_version(self, admin_token):
+        """Dry runs are queued as jobs; unknown versions return 404"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        response = requests.post(f"{BASE_URL}/api/admin/migrations/run", params={"version": 1, "dry_run": True}, headers=headers)
+        assert response.status_code == 200
+        assert "job_id" in response.json()
+        response = requests.post(f"{BASE_URL}/api/admin/migrations/run", params={"version": 9999}, headers=headers)
+        assert response.status_code == 404
+
+
+class TestNativeDates:
+    """Timestamps stored as dates still render as ISO strings"""
+    
+    def test_review_dates_are_iso_strings(self):
+        """Review created_at values parse as ISO timestamps"""
+        response = requests.get(f"{BASE_URL}/api/reviews", params={"limit": 5})
+        assert response.status_code == 200
+        for review in response.json():
+            datetime.fromisoformat(review["created_at"])
+    
+    def test_availability_month_bounds(self):
+        """Only dates inside the requested month are returned"""
+        response = requests.get(f"{BASE_URL}/api/availability", params={"year": 2030, "month": 2})
+        assert response.status_code == 200
+        assert all(d["date"].startswith("2030-02-") for d in response.json()["dates"])
+        response = requests.get(f"{BASE_URL}/api/availability", params={"year": 2030, "month": 13})
+        assert response.status_code == 422
+    
+    def test_export_filters_native_dates(self, admin_token):
+        """Review exports filter created_at by whole local days"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/export/reviews",
+            params={"format": "ndjson", "date_to": "2000-01-01"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        assert response.text.strip() == ""
+
+    def test_export_filters_customer_dates(self, admin_token):
+        """Customer exports filter created_at as dates too"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/export/customers",
+            params={"format": "ndjson", "date_to": "2000-01-01"},
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 200
+        assert response.text.strip() == ""
+
+    def test_legacy_string_timestamps_migrated(self):
+        """Migrations turn the remaining ISO string timestamps into dates (local)"""
+        import server
+
+        async def scenario(db):
+            runner = server.migration_runner
+            live_db, runner.db = runner.db, db
+            try:
+                await db.customers.insert_one({"name": "TEST Eski", "phone": "TEST_D", "created_at": "2024-03-01T08:30:00.123456"})
+                await db.waitlist.insert_one({
+                    "date": "2031-01-01", "time": "10:00", "status": "notified",
+                    "created_at": "2024-03-01T08:30:00", "notified_at": "2024-03-02T09:00:00"
+                })
+                for version in (7, 9):
+                    await runner.run(runner.migrations[version])
+                customer = await db.customers.find_one({"phone": "TEST_D"})
+                assert customer["created_at"] == datetime(2024, 3, 1, 8, 30, 0, 123000)
+                entry = await db.waitlist.find_one({})
+                assert isinstance(entry["created_at"], datetime) and isinstance(entry["notified_at"], datetime)
+            finally:
+                runner.db = live_db
+        run_on_scratch_db(scenario)
+
+
+class TestMetrics:
+    """Prometheus exposition of request and connection pool metrics"""
+    
+    def test_route_templates_in_metrics(self):
+        """Requests are counted under their route template, not the raw path"""
+        requests.put(f"{BASE_URL}/api/bookings/000000000000000000000000/cancel", params={"phone": "0"})
+        response = requests.get(METRICS_URL)
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        body = response.text
+        assert 'route="/api/bookings/{booking_id}/cancel"' in body
+        assert "000000000000000000000000" not in body
+        assert "# TYPE http_request_duration_seconds histogram" in body
+        assert "http_requests_in_flight" in body
+        assert "# TYPE mongodb_pool_checked_out gauge" in body
+
+    def test_render_while_observing_from_threads(self):
+        """Observations from other threads are all counted and renders stay consistent (local)"""
+        import threading
+        from metrics import Histogram, Registry
+
+        registry = Registry()
+        histogram = registry.register(Histogram("test_seconds", "Test histogram.", ("kind",)))
+
+        def observe():
+            for i in range(20000):
+                histogram.observe(0.001 * (i % 50), (f"k{i % 20}",))
+        threads = [threading.Thread(target=observe) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            registry.render()
+        for thread in threads:
+            thread.join()
+
+        counts = [line for line in registry.render().decode().splitlines() if line.startswith("test_seconds_count")]
+        assert sum(int(line.rsplit(" ", 1)[1]) for line in counts) == 80000
+
+
+class TestCommandMonitoring:
+    """Per-request MongoDB call counts and per-command metrics"""
+    
+    def test_db_call_headers(self):
+        """Responses report the MongoDB commands they ran"""
+        response = requests.get(f"{BASE_URL}/api/bookings/check", params={"phone": "05550000000"})
+        assert response.status_code == 200
+        assert int(response.headers["X-DB-Calls"]) >= 1
+        assert float(response.headers["X-DB-Time-Ms"]) >= 0
+    
+    def test_command_metrics_exposed(self):
+        """Command latency is labeled by collection and command"""
+        requests.get(f"{BASE_URL}/api/services")
+        body = requests.get(METRICS_URL).text
+        assert "# TYPE mongodb_command_duration_seconds histogram" in body
+        assert 'command="find"' in body or 'command="aggregate"' in body
+
+
+class TestRequestProfiling:
+    """Admin-triggered sampling profiles of single requests"""
+    
+    def test_profile_flagged_request(self, admin_token):
+        """A flagged admin request is profiled and its stacks can be fetched"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        response = requests.get(f"{BASE_URL}/api/admin/stats", headers={**headers, "X-Profile": "1"})
+        assert response.status_code == 200
+        profile_id = response.headers["X-Profile-Id"]
+        
+        profile = None
+        for _ in range(10):
+            response = requests.get(f"{BASE_URL}/api/admin/profiles/{profile_id}", headers=headers)
+            if response.status_code == 200:
+                profile = response.json()
+                break
+            time.sleep(0.2)
+        assert profile is not None
+        assert profile["route"] == "/api/admin/stats"
+        for field in ("cpu_ms", "mongodb_wait_ms", "waiting_ms", "other_ms"):
+            assert profile[field] >= 0
+        
+        folded = requests.get(f"{BASE_URL}/api/admin/profiles/{profile_id}", params={"format": "folded"}, headers=headers)
+        assert folded.status_code == 200
+        assert folded.headers["content-type"].startswith("text/plain")
+    
+    def test_unflagged_and_anonymous_requests_not_profiled(self):
+        """Requests without the flag or an admin token run unprofiled"""
+        assert "X-Profile-Id" not in requests.get(f"{BASE_URL}/api/services").headers
+        assert "X-Profile-Id" not in requests.get(f"{BASE_URL}/api/services", headers={"X-Profile": "1"}).headers
+
+
+class TestLoopMonitor:
+    """Event loop lag and blocking callbacks exported as metrics"""
+    
+    def test_loop_lag_metrics(self):
+        """Lag histogram, last lag and blocked count are exposed"""
+        body = requests.get(METRICS_URL).text
+        assert "# TYPE event_loop_lag_seconds histogram" in body
+        assert "event_loop_lag_last_seconds" in body
+        assert "# TYPE event_loop_blocked_total counter" in body
+
+
+class TestStructuredLogging:
+    """Request ids on responses and the log queue's drop counter"""
+    
+    def test_request_id_generated_and_echoed(self):
+        """Each response names its request id, keeping a caller-supplied one"""
+        first = requests.get(f"{BASE_URL}/api/services").headers.get("X-Request-ID")
+        second = requests.get(f"{BASE_URL}/api/services").headers.get("X-Request-ID")
+        assert first and second and first != second
+        
+        response = requests.get(f"{BASE_URL}/api/services", headers={"X-Request-ID": "test-trace-1"})
+        assert response.headers.get("X-Request-ID") == "test-trace-1"
+    
+    def test_dropped_log_records_exposed(self):
+        """Records dropped by a full log queue are counted"""
+        body = requests.get(METRICS_URL).text
+        assert "# TYPE log_records_dropped_total counter" in body
+
+
+def run_on_scratch_db(scenario):
+    """Run the coroutine scenario(db) on an emptied scratch database"""
+    async def main():
+        client = AsyncIOMotorClient(LOCAL_MONGO_URL)
+        await client.drop_database(LOCAL_TEST_DB)
+        try:
+            await scenario(client[LOCAL_TEST_DB])
+        finally:
+            await client.drop_database(LOCAL_TEST_DB)
+            client.close()
+    asyncio.run(main())
+
+
+def run_push_worker(scenario, max_attempts=3):
+    """Run scenario(db, worker, gateway) on a scratch database, with the
+    worker sending to the fake push gateway in-process"""
+    async def with_worker(db):
+        gateway = create_push_gateway(record=True)
+        transport = ExpoPushTransport("http://gateway/--/api/v2/push/send")
+        transport.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=gateway), timeout=10)
+        worker = PushDeliveryWorker(db, transport, max_attempts=max_attempts, base_backoff=30)
+        try:
+            await scenario(db, worker, gateway)
+        finally:
+            await transport.close()
+    run_on_scratch_db(with_worker)
+
+
+async def seed_push(db, tokens):
+    """One due customer notification and the customer's device tokens"""
+    now = datetime.utcnow()
+    result = await db.notifications.insert_one({
+        "title": "TEST", "message": "Push testi", "type": "customer", "target_id": "c1",
+        "push_status": "pending", "push_attempts": 0, "push_next_attempt_at": now
+    })
+    await db.push_tokens.insert_many([{"token": token, "target_key": "c1"} for token in tokens])
+    return result.inserted_id
+
+
+async def make_due(db, notification_id):
+    await db.notifications.update_one({"_id": notification_id}, {"$set": {"push_next_attempt_at": datetime.utcnow()}})
+
+
+class TestPushDelivery:
+    """Push worker against the fake gateway: retries, backoff, dead letters"""
+    
+    def test_delivers_to_every_device(self):
+        """All of the target's devices get the message once"""
+        async def scenario(db, worker, gateway):
+            nid = await seed_push(db, ["ok-1", "ok-2"])
+            assert await worker.run_once() == 1
+            notification = await db.notifications.find_one({"_id": nid})
+            assert notification["push_status"] == "sent"
+            assert notification["push_delivered"] == 2
+            assert sorted(m["to"] for m in gateway.state.messages) == ["ok-1", "ok-2"]
+            assert await worker.run_once() == 0
+        run_push_worker(scenario)
+    
+    def test_retry_backs_off_exponentially(self):
+        """Retryable failures are requeued, each wait about twice the last"""
+        async def scenario(db, worker, gateway):
+            nid = await seed_push(db, ["retry-1"])
+            waits = []
+            for attempt in (1, 2):
+                start = datetime.utcnow()
+                assert await worker.run_once() == 1
+                notification = await db.notifications.find_one({"_id": nid})
+                assert notification["push_status"] == "pending"
+                assert notification["push_attempts"] == attempt
+                waits.append((notification["push_next_attempt_at"] - start).total_seconds())
+                # Not due again until the backoff has passed
+                assert await worker.run_once() == 0
+                await make_due(db, nid)
+            assert 24 <= waits[0] <= 36
+            assert 48 <= waits[1] <= 72
+        run_push_worker(scenario)
+    
+    def test_dead_letter_after_max_attempts(self):
+        """A notification failing max_attempts times is dead-lettered"""
+        async def scenario(db, worker, gateway):
+            nid = await seed_push(db, ["retry-1"])
+            for _ in range(3):
+                await make_due(db, nid)
+                assert await worker.run_once() == 1
+            notification = await db.notifications.find_one({"_id": nid})
+            assert notification["push_status"] == "dead"
+            assert notification["push_error"] == "MessageRateExceeded"
+            assert await db.push_dead_letters.count_documents({"_id": nid}) == 1
+            await make_due(db, nid)
+            assert await worker.run_once() == 0
+        run_push_worker(scenario)
+    
+    def test_partial_failure_retries_only_failed_devices(self):
+        """Devices that got the message are not sent it again on retry"""
+        async def scenario(db, worker, gateway):
+            nid = await seed_push(db, ["ok-1", "retry-1", "invalid-1"])
+            assert await worker.run_once() == 1
+            notification = await db.notifications.find_one({"_id": nid})
+            assert notification["push_status"] == "pending"
+            assert notification["push_retry_tokens"] == ["retry-1"]
+            # Unregistered devices are forgotten
+            assert await db.push_tokens.count_documents({"token": "invalid-1"}) == 0
+            
+            for _ in range(2):
+                await make_due(db, nid)
+                assert await worker.run_once() == 1
+            sent_to = [m["to"] for m in gateway.state.messages]
+            assert sent_to.count("ok-1") == 1
+            assert sent_to.count("retry-1") == 3
+            notification = await db.notifications.find_one({"_id": nid})
+            assert notification["push_status"] == "dead"
+            assert notification["push_delivered"] == 1
+        run_push_worker(scenario)
+
+
+CUSTOMER_STAT_FIELDS = ("total_spent", "completed_bookings", "last_booking_date", "average_rating")
+
+
+def wait_until(check, attempts=20, delay=0.5):
+    """Poll check() until it returns a truthy value"""
+    for _ in range(attempts):
+        result = check()
+        if result:
+            return result
+        time.sleep(delay)
+    return check()
+
+
+def run_admin_job(headers, path):
+    """Start an admin job and wait for it to finish"""
+    job_id = requests.post(f"{BASE_URL}{path}", headers=headers).json()["job_id"]
+    
+    def finished():
+        status = requests.get(f"{BASE_URL}/api/admin/jobs/{job_id}", headers=headers).json()["status"]
+        return status if status in ("done", "failed") else None
+    assert wait_until(finished) == "done"
+
+
+class TestCustomerStats:
+    """Counters kept by booking and review events agree with a full recount"""
+    
+    @pytest.fixture(scope="class")
+    def setup(self, admin_token):
+        """A service, open days and a fresh customer"""
+        headers = {"Authorization": f"Bearer {admin_token}"}
+        suffix = int(time.time())
+        service_id = requests.post(f"{BASE_URL}/api/admin/services", json={
+            "name": f"TEST İstatistik Hizmeti {suffix}", "description": "test", "price": 150
+        }, headers=headers).json()["id"]
+        for day in range(10, 20):
+            requests.post(f"{BASE_URL}/api/admin/availability", json={
+                "date": f"2032-01-{day:02d}", "available": True, "time_slots": ["10:00", "11:00", "12:00"]
+            }, headers=headers)
+        # Digits only, so the admin search finds it by phone
+        phone = f"0598{suffix % 10000000:07d}"
+        requests.post(f"{BASE_URL}/api/customers/register", json={"name": "TEST İstatistik", "phone": phone})
+        return {"headers": headers, "service_id": service_id, "phone": phone}
+    
+    def book(self, setup, day, slot):
+        response = requests.post(f"{BASE_URL}/api/bookings", json={
+            "service_id": setup["service_id"], "customer_name": "TEST İstatistik",
+            "customer_phone": setup["phone"], "customer_address": "Test", "booking_date": day,
+            "booking_time": slot, "payment_method": "cash"
+        })
+        assert response.status_code == 200
+        return response.json()
+    
+    def stats(self, setup):
+        response = requests.get(f"{BASE_URL}/api/admin/customers/search", params={"q": setup["phone"]}, headers=setup["headers"])
+        return {field: response.json()["customers"][0].get(field) for field in CUSTOMER_STAT_FIELDS}
+    
+    def assert_matches_reconciliation(self, setup):
+        incremental = self.stats(setup)
+        run_admin_job(setup["headers"], "/api/admin/customers/reconcile-stats")
+        assert self.stats(setup) == incremental
+        return incremental
+    
+    def test_create_and_complete(self, setup):
+        """A new booking moves last_booking_date; completing it adds spend"""
+        booking = self.book(setup, "2032-01-12", "10:00")
+        assert wait_until(lambda: self.stats(setup)["last_booking_date"] == "2032-01-12")
+        requests.put(f"{BASE_URL}/api/admin/bookings/{booking['id']}", json={"status": "completed"}, headers=setup["headers"])
+        assert wait_until(lambda: self.stats(setup)["completed_bookings"] == 1)
+        
+        stats = self.assert_matches_reconciliation(setup)
+        assert stats["total_spent"] == booking["total_price"]
+    
+    def test_cancel_latest_booking(self, setup):
+        """Cancelling the latest booking falls back to the previous date"""
+        booking = self.book(setup, "2032-01-15", "11:00")
+        assert wait_until(lambda: self.stats(setup)["last_booking_date"] == "2032-01-15")
+        requests.put(f"{BASE_URL}/api/bookings/{booking['id']}/cancel", params={"phone": setup["phone"]})
+        assert wait_until(lambda: self.stats(setup)["last_booking_date"] == "2032-01-12")
+        
+        self.assert_matches_reconciliation(setup)
+    
+    def test_uncomplete_and_review(self, setup):
+        """Reviews set average_rating; a completion taken back removes spend"""
+        first = self.book(setup, "2032-01-16", "12:00")
+        second = self.book(setup, "2032-01-17", "12:00")
+        for booking in (first, second):
+            requests.put(f"{BASE_URL}/api/admin/bookings/{booking['id']}", json={"status": "completed"}, headers=setup["headers"])
+        assert wait_until(lambda: self.stats(setup)["completed_bookings"] == 3)
+        
+        for booking, rating in ((first, 5), (second, 2)):
+            response = requests.post(f"{BASE_URL}/api/reviews", json={"booking_id": booking["id"], "rating": rating})
+            assert response.status_code == 200
+        assert wait_until(lambda: self.stats(setup)["average_rating"] == 3.5)
+        
+        requests.put(f"{BASE_URL}/api/admin/bookings/{second['id']}", json={"status": "confirmed"}, headers=setup["headers"])
+        assert wait_until(lambda: self.stats(setup)["completed_bookings"] == 2)
+
+        self.assert_matches_reconciliation(setup)
+
+    def test_bulk_complete(self, setup):
+        """Bulk changes update stats through the same jobs and leave no marker behind"""
+        booking_ids = [self.book(setup, day, "10:00")["id"] for day in ("2032-01-18", "2032-01-19")]
+        response = requests.post(f"{BASE_URL}/api/admin/bookings/bulk-status", json={
+            "booking_ids": booking_ids, "status": "completed"
+        }, headers=setup["headers"])
+        assert response.json()["updated"] == 2
+        assert wait_until(lambda: self.stats(setup)["completed_bookings"] == 4)
+
+        bookings = requests.get(f"{BASE_URL}/api/admin/bookings", headers=setup["headers"]).json()
+        assert not [b for b in bookings if b["id"] in booking_ids and "status_batch" in b]
+        self.assert_matches_reconciliation(setup)
+
+
+class TestBroadcastNotifications:
+    """Broadcasts are stored once but read per customer"""
+    
+    @pytest.fixture(scope="class")
+    def customers(self):
+        """Two fresh customers"""
+        suffix = int(time.time())
+        registered = []
+        for i in range(2):
+            response = requests.post(f"{BASE_URL}/api/customers/register", json={
+                "name": f"TEST Duyuru {i}", "phone": f"TEST_B{i}_{suffix}"
+            })
+            assert response.status_code == 200
+            registered.append(response.json())
+        return registered
+    
+    @pytest.fixture(scope="class")
+    def broadcast_id(self, admin_token):
+        response = requests.post(f"{BASE_URL}/api/admin/notifications/broadcast", json={
+            "title": "TEST Duyuru", "message": "Herkese duyuru"
+        }, headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 200
+        return response.json()["id"]
+    
+    def notifications(self, customer):
+        headers = {"Authorization": f"Bearer {customer['token']}"}
+        return requests.get(f"{BASE_URL}/api/customer/notifications", headers=headers).json()
+    
+    def unread(self, customer):
+        headers = {"Authorization": f"Bearer {customer['token']}"}
+        return requests.get(f"{BASE_URL}/api/customer/notifications/unread-count", headers=headers).json()["unread"]
+    
+    def test_broadcast_listed_once_per_customer(self, customers, broadcast_id):
+        """Every customer sees the broadcast exactly once, unread"""
+        for customer in customers:
+            matches = [n for n in self.notifications(customer) if n["id"] == broadcast_id]
+            assert len(matches) == 1
+            assert matches[0]["type"] == "broadcast"
+            assert matches[0]["read"] is False
+    
+    def test_read_is_per_customer(self, customers, broadcast_id):
+        """One customer reading a broadcast leaves it unread for the other"""
+        reader, other = customers
+        unread_before = [self.unread(c) for c in customers]
+        headers = {"Authorization": f"Bearer {reader['token']}"}
+        for _ in range(2):
+            assert requests.put(f"{BASE_URL}/api/notifications/{broadcast_id}/read", headers=headers).status_code == 200
+        
+        assert [n["read"] for n in self.notifications(reader) if n["id"] == broadcast_id] == [True]
+        assert [n["read"] for n in self.notifications(other) if n["id"] == broadcast_id] == [False]
+        # Reading twice counts once
+        assert self.unread(reader) == unread_before[0] - 1
+        assert self.unread(other) == unread_before[1]
+    
+    def test_broadcast_read_needs_customer_token(self, admin_token, broadcast_id):
+        """Broadcast receipts belong to a customer, so other callers are refused"""
+        assert requests.put(f"{BASE_URL}/api/notifications/{broadcast_id}/read").status_code == 401
+        response = requests.put(
+            f"{BASE_URL}/api/notifications/{broadcast_id}/read",
+            headers={"Authorization": f"Bearer {admin_token}"}
+        )
+        assert response.status_code == 401
+    
+    def test_targeted_notification_stays_private(self, customers):
+        """A notification for one customer never shows in another's list"""
+        target, other = customers
+        response = requests.post(f"{BASE_URL}/api/notifications", json={
+            "title": "TEST Özel", "message": "Sadece bir müşteri", "type": "customer", "target_id": target["id"]
+        })
+        assert response.status_code == 200
+        notification_id = response.json()["id"]
+        assert notification_id in [n["id"] for n in self.notifications(target)]
+        assert notification_id not in [n["id"] for n in self.notifications(other)]
+
+    def test_public_endpoint_cannot_broadcast(self, customers):
+        """Only the admin broadcast endpoint reaches every customer"""
+        response = requests.post(f"{BASE_URL}/api/notifications", json={
+            "title": "TEST Sahte", "message": "Herkese", "type": "broadcast"
+        })
+        assert response.status_code == 422
+        assert "TEST Sahte" not in [n["title"] for n in self.notifications(customers[0])]
+
+
+class TestBookingReminders:
+    """The reminder pass notifies each booking once, even when repeated"""
+    
+    def test_reminder_sent_once(self):
+        """Re-running the pass, even after losing reminder_sent_at, adds no reminder"""
+        import server
+        
+        async def scenario(db):
+            live_db, server.db = server.db, db
+            try:
+                await db.notifications.create_index(
+                    "dedup_key", unique=True, partialFilterExpression={"dedup_key": {"$exists": True}}
+                )
+                customer = await db.customers.insert_one({"name": "TEST Hatırlatma", "phone": "TEST_R"})
+                booking = await db.bookings.insert_one({
+                    "customer_phone": "TEST_R", "service_name": "TEST", "booking_date": "2031-01-01",
+                    "booking_time": "10:00", "status": "confirmed",
+                    "starts_at": datetime.utcnow() + timedelta(hours=2)
+                })
+                assert await server.send_booking_reminders(lead_hours=24) == 1
+                assert await server.send_booking_reminders(lead_hours=24) == 0
+                
+                # As if the process died after notifying but before stamping the booking
+                await db.bookings.update_one({"_id": booking.inserted_id}, {"$unset": {"reminder_sent_at": ""}})
+                assert await server.send_booking_reminders(lead_hours=24) == 0
+                
+                reminders = await db.notifications.find({"booking_id": str(booking.inserted_id)}).to_list(None)
+                assert len(reminders) == 1
+                assert reminders[0]["dedup_key"] == f"reminder:{booking.inserted_id}"
+                counter = await db.notification_counters.find_one({"_id": str(customer.inserted_id)})
+                assert counter["unread"] == 1
+            finally:
+                server.db = live_db
+        run_on_scratch_db(scenario)
+
+
+def assert_serialized(item):
+    """The shape list endpoints have always returned: string ids, ISO dates"""
+    assert isinstance(item["id"], str) and len(item["id"]) == 24
+    assert item["_id"] == item["id"]
+    if item.get("created_at") is not None:
+        datetime.fromisoformat(item["created_at"])
+
+
+class ListCursor:
+    """Stands in for a Motor cursor over a list of documents"""
+    
+    def __init__(self, docs):
+        self.docs = docs
+        self.closed = False
+    
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+    
+    async def close(self):
+        self.closed = True
+
+
+class TestListSerialization:
+    """orjson-rendered and streamed lists keep their response shape"""
+    
+    @pytest.mark.parametrize("path", ["/api/services", "/api/reviews", "/api/admin/services", "/api/admin/packages"])
+    def test_list_shape(self, admin_token, path):
+        """Items carry id and _id as the same string"""
+        response = requests.get(f"{BASE_URL}{path}", headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 200
+        items = response.json()
+        assert items
+        for item in items:
+            assert_serialized(item)
+    
+    @pytest.mark.parametrize("path", ["/api/admin/bookings", "/api/admin/customers", "/api/admin/reviews"])
+    def test_streamed_admin_list_shape(self, admin_token, path):
+        """Streamed admin lists are one JSON array, capped at 1000 newest rows"""
+        response = requests.get(f"{BASE_URL}{path}", headers={"Authorization": f"Bearer {admin_token}"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/json")
+        items = json.loads(response.content)
+        assert isinstance(items, list) and len(items) <= 1000
+        for item in items:
+            assert_serialized(item)
+        created = [item["created_at"] for item in items if isinstance(item.get("created_at"), str)]
+        assert created == sorted(created, reverse=True)
+    
+    def test_stream_json_array_batches(self):
+        """Empty and multi-batch cursors both encode to valid JSON arrays"""
+        from bson import ObjectId
+        from server import stream_json_array
+        
+        async def encode(docs, batch_size):
+            cursor = ListCursor(docs)
+            body = b"".join([chunk async for chunk in stream_json_array(cursor, batch_size)])
+            assert cursor.closed
+            return json.loads(body)
+        
+        assert asyncio.run(encode([], 2)) == []
+        booking_id = ObjectId()
+        docs = [{"n": i, "booking_id": booking_id, "created_at": datetime(2031, 1, 1, 9, 30, 0, 125000)} for i in range(5)]
+        for batch_size in (1, 2, 5, 10):
+            items = asyncio.run(encode(docs, batch_size))
+            assert [item["n"] for item in items] == list(range(5))
+            assert items[0]["booking_id"] == str(booking_id)
+            assert items[0]["created_at"] == "2031-01-01T09:30:00.125000"
+
+
+class TestBulkStatusRace:
+    """Bulk status changes only move slots for rows they actually changed"""
+    
+    def test_concurrent_cancel_not_released_twice(self):
+        """A booking cancelled between the bulk read and write keeps the counters right"""
+        import jwt
+        import server
+        from fastapi.security import HTTPAuthorizationCredentials
+        
+        token = jwt.encode({"admin_id": "test", "exp": datetime.utcnow() + timedelta(hours=1)}, server.JWT_SECRET, algorithm="HS256")
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+        
+        async def scenario(db):
+            live_db, server.db = server.db, db
+            collection_type = type(db.bookings)
+            original_bulk_write = collection_type.bulk_write
+            try:
+                await db.availability.insert_one({
+                    "date": "2031-05-05", "available": True, "time_slots": ["10:00"],
+                    "capacity": 2, "reserved": {"10:00": 2}
+                })
+                booking = {"booking_date": "2031-05-05", "booking_time": "10:00", "status": "confirmed", "customer_phone": "TEST_X"}
+                raced = await db.bookings.insert_one(dict(booking))
+                await db.bookings.insert_one(dict(booking))
+                
+                async def racing_bulk_write(self, requests, **kwargs):
+                    # The customer cancels after the bulk change has read the booking
+                    if self.name == "bookings":
+                        stale = await db.bookings.find_one({"_id": raced.inserted_id})
+                        assert await server.set_booking_status(stale, "cancelled")
+                    return await original_bulk_write(self, requests, **kwargs)
+                collection_type.bulk_write = racing_bulk_write
+                
+                result = await server.bulk_update_booking_status(
+                    server.BulkBookingStatusUpdate(booking_ids=[str(raced.inserted_id)], status="cancelled"),
+                    credentials=credentials
+                )
+                assert result["updated"] == 0
+                assert result["results"][0]["result"] == "conflict"
+                # Only the concurrent cancellation gave a place back
+                availability = await db.availability.find_one({"date": "2031-05-05"})
+                assert availability["reserved"]["10:00"] == 1
+            finally:
+                collection_type.bulk_write = original_bulk_write
+                server.db = live_db
+        run_on_scratch_db(scenario)
+
+
+class TestNotificationRetention:
+    """Hourly trimming touches only trimmed targets; old rows get expire_at"""
+    
+    def test_trim_recounts_trimmed_targets(self):
+        """Trimming recounts the trimmed target and leaves the rest to reconciliation"""
+        import server
+        
+        async def scenario(db):
+            live_db, live_cap = server.db, server.NOTIFICATION_MAX_PER_TARGET
+            server.db, server.NOTIFICATION_MAX_PER_TARGET = db, 3
+            try:
+                await db.notifications.insert_many([{
+                    "type": "customer", "target_id": "c1", "read": i < 2,
+                    "created_at": datetime(2031, 1, 1) + timedelta(minutes=i)
+                } for i in range(5)])
+                await db.notification_counters.insert_many([
+                    {"_id": "c1", "unread": 3, "total": 5},
+                    # Drifted: its notifications were removed by the TTL index
+                    {"_id": "c2", "unread": 1, "total": 1}
+                ])
+                await server.enforce_notification_retention()
+                assert await db.notifications.count_documents({"target_id": "c1"}) == 3
+                assert await db.notification_counters.find_one({"_id": "c1"}) == {"_id": "c1", "unread": 3, "total": 3}
+                assert (await db.notification_counters.find_one({"_id": "c2"}))["total"] == 1
+                
+                await server.reconcile_notification_counters()
+                assert await db.notification_counters.find_one({"_id": "c2"}) == {"_id": "c2", "unread": 0, "total": 0}
+                assert await db.notification_counters.find_one({"_id": "c1"}) == {"_id": "c1", "unread": 3, "total": 3}
+            finally:
+                server.db, server.NOTIFICATION_MAX_PER_TARGET = live_db, live_cap
+        run_on_scratch_db(scenario)
+    
+    def test_expiry_backfill(self):
+        """Notifications without expire_at expire the retention period after creation"""
+        import server
+        
+        retention = timedelta(days=server.NOTIFICATION_RETENTION_DAYS)
+        created_at = datetime(2031, 1, 1, 12, 0)
+        assert server.add_notification_expiry({"created_at": created_at}) == {"$set": {"expire_at": created_at + retention}}
+        assert server.add_notification_expiry({"created_at": "2031-01-01T12:00:00"}) == {"$set": {"expire_at": created_at + retention}}
+        expire_at = server.add_notification_expiry({})["$set"]["expire_at"]
+        assert abs(expire_at - (datetime.utcnow() + retention)) < timedelta(minutes=1)
+
@@ -0,0 +1,87 @@
+"""
+Unit tests for RFM segmentation scoring (segmentation.py)
+Run locally, no server needed: pytest tests/test_segmentation.py
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from segmentation import quintile_scores, score_customers  # noqa: E402
+
+TODAY = 740000
+
+
+def columns(bookings):
+    """(customer count, codes, days, prices) from (code, days ago, price) tuples"""
+    codes = np.array([b[0] for b in bookings], dtype=np.int32)
+    days = np.array([TODAY - b[1] for b in bookings], dtype=np.int32)
+    prices = np.array([b[2] for b in bookings], dtype=np.float64)
+    return int(codes.max()) + 1, codes, days, prices
+
+
+class TestQuintileScores:
+    """Percentile-rank scoring"""
+
+    def test_distinct_values_fill_all_quintiles(self):
+        """Ten distinct values get two of each score, in order"""
+        assert quintile_scores(np.arange(10)).tolist() == [1, 1, 2, 2, 3, 3, 4, 4, 5, 5]
+
+    def test_tied_values_share_a_score(self):
+        """Equal values always get the same score"""
+        scores = quintile_scores(np.array([3, 1, 3, 2, 3]))
+        assert scores[0] == scores[2] == scores[4]
+        assert scores[1] < scores[3] < scores[0]
+
+    def test_majority_tie_not_scored_high(self):
+        """A value most customers share is not pushed into the top quintiles"""
+        values = np.array([1] * 70 + [2] * 20 + [5] * 10)
+        scores = quintile_scores(values)
+        assert scores[0] <= 2
+        assert scores[-1] == 5
+
+    def test_all_equal_and_empty(self):
+        """All-equal input scores the middle; empty input scores nothing"""
+        assert set(quintile_scores(np.full(4, 7)).tolist()) == {3}
+        assert quintile_scores(np.empty(0)).size == 0
+
+
+class TestScoreCustomers:
+    """Per-customer RFM values and segment labels"""
+
+    def test_rfm_values(self):
+        """Recency, frequency and monetary come from each customer's bookings"""
+        count, codes, days, prices = columns([(0, 10, 100.0), (0, 3, 50.0), (1, 40, 80.0)])
+        scores = score_customers(count, codes, days, prices, TODAY)
+        assert scores["recency_days"].tolist() == [3, 40]
+        assert scores["frequency"].tolist() == [2, 1]
+        assert scores["monetary"].tolist() == [150.0, 80.0]
+
+    def test_skewed_tied_distribution(self):
+        """Mostly one-time customers are not all labelled champions"""
+        bookings = []
+        for code in range(100):
+            visits = 1 if code < 70 else 2 if code < 90 else 5
+            for visit in range(visits):
+                bookings.append((code, 5 + visit * 30, 100.0))
+        count, codes, days, prices = columns(bookings)
+        scores = score_customers(count, codes, days, prices, TODAY)
+
+        one_time = scores["f"][:70]
+        assert set(one_time.tolist()) == {int(one_time[0])} and one_time[0] <= 2
+        assert (scores["f"][90:] == 5).all()
+        segments = scores["segment"].tolist()
+        assert "champions" not in segments[:70]
+        assert segments.count("champions") < 100
+
+    def test_segments(self):
+        """Recent frequent big spenders are champions; old one-timers lapsed"""
+        bookings = [(0, 1, 500.0), (0, 20, 500.0), (0, 40, 500.0)]
+        bookings += [(code, 300 + code, 50.0) for code in range(1, 5)]
+        count, codes, days, prices = columns(bookings)
+        scores = score_customers(count, codes, days, prices, TODAY)
+        assert scores["segment"][0] == "champions"
+        assert scores["segment"][4] == "lapsed"
@@ -0,0 +1,84 @@
+"""
+Timestamp model.
+
+Instants (created_at, starts_at, reminder_sent_at, ...) are stored as native
+BSON dates in UTC. pymongo returns them as naive UTC datetimes, so that is
+the form used in code too; utc_now() produces it at the millisecond
+precision BSON keeps, so a value returned right after an insert matches the
+one read back later.
+
+Business dates stay local: booking_date ("YYYY-MM-DD") and booking_time
+("HH:MM") are Europe/Istanbul wall-clock values, the keys of availability
+and slot counters. Every booking also carries starts_at, the same moment as
+a UTC date, so time-window queries are single index range scans. Responses
+keep rendering dates as ISO strings.
+"""
+
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from zoneinfo import ZoneInfo
+
+LOCAL_TZ = ZoneInfo("Europe/Istanbul")
+
+
+def utc_now() -> datetime:
+    """Naive UTC now, truncated to milliseconds"""
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def to_utc(moment: datetime) -> datetime:
+    """Naive UTC datetime for an aware datetime or a naive local (Istanbul) one"""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=LOCAL_TZ)
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def local_day_start(day: date) -> datetime:
+    """UTC moment of local midnight on day"""
+    return to_utc(datetime.combine(day, datetime.min.time()))
+
+
+def booking_starts_at(booking_date: str, booking_time: str) -> Optional[datetime]:
+    """UTC moment a booking starts; None if its date or time does not parse"""
+    try:
+        return to_utc(datetime.strptime(f"{booking_date} {booking_time}", "%Y-%m-%d %H:%M"))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_timestamp(value) -> Optional[datetime]:
+    """Naive UTC datetime from a stored value.
+
+    Legacy ISO strings were written with datetime.utcnow().isoformat(), so a
+    string without an offset is already UTC.
+    """
+    if isinstance(value, datetime):
+        return value if value.tzinfo is None else value.astimezone(timezone.utc).replace(tzinfo=None)
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.replace(microsecond=parsed.microsecond // 1000 * 1000)
+
+
+def month_range(year: int, month: int) -> Tuple[str, str]:
+    """First day of the month and of the next one, as YYYY-MM-DD; end exclusive"""
+    first = date(year, month, 1)
+    following = date(year + month // 12, month % 12 + 1, 1)
+    return first.isoformat(), following.isoformat()
+
+
+def day_range(date_from: Optional[date], date_to: Optional[date]) -> dict:
+    """UTC range covering whole local days, date_to inclusive"""
+    bounds = {}
+    if date_from:
+        bounds["$gte"] = local_day_start(date_from)
+    if date_to:
+        bounds["$lt"] = local_day_start(date_to + timedelta(days=1))
+    return bounds